@@ -0,0 +1,65 @@
+"""
+Compare parsing a publish cycle's payloads into full models and into lazy
+records, selecting on score and validating only the selected items.
+
+    python -m benchmarks.bench_items
+"""
+import random
+import time
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from hnread import filters, items, services
+
+
+def payloads(n: int = 500):
+    now = time.time()
+    return [
+        {
+            "id": i,
+            "type": "story",
+            "by": f"user{i}",
+            "time": int(now - random.uniform(0, 2 * 24 * 3600)),
+            "title": f"Story {i}",
+            "score": random.randint(1, 1000),
+            "descendants": random.randint(0, 500),
+            "kids": list(range(i * 1000, i * 1000 + random.randint(0, 300))),
+            "url": f"https://example.com/{i}",
+        }
+        for i in range(n)
+    ]
+
+
+def cycle(item_factory: items.ItemFactory, data: list):
+    stories = [item_factory.from_dict(d) for d in data]
+    recent = [
+        s for s in stories if datetime.now(timezone.utc) - s.time <= timedelta(days=1)
+    ]
+    selected = filters.NormalDistributionFilter(threshold=0.9)(
+        services.filter_only_scoreable(recent)
+    )
+    return [str(items.TopStoryDisplay(s)) for s in selected]
+
+
+def main():
+    data = payloads()
+    for name, item_factory in [
+        ("full", items.ItemFactory()),
+        ("lazy", items.LazyItemFactory()),
+    ]:
+        parse = min(
+            timeit.repeat(
+                lambda: [item_factory.from_dict(d) for d in data], number=10, repeat=3
+            )
+        )
+        full_cycle = min(
+            timeit.repeat(lambda: cycle(item_factory, data), number=10, repeat=3)
+        )
+        print(
+            f"{name}: parse {parse * 100:.2f} ms, "
+            f"cycle {full_cycle * 100:.2f} ms per {len(data)} items"
+        )
+
+
+if __name__ == "__main__":
+    main()
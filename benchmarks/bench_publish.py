@@ -0,0 +1,308 @@
+"""
+Drive publish and cleanup cycles against a local stand-in of the HN API, a
+recording bot and fakeredis.
+
+    python -m benchmarks.bench_publish --stories 500 --subscribers 100
+
+`--async` publishes with `apublish_stories` on one event loop, as the bot does.
+
+The fake API runs in this process, its allocations count in the peak memory.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import fakeredis
+
+from hnread import delivery, filters, items, repos, services
+from hnread.topics import Topic
+
+
+class FakeHNServer:
+    """
+    Serves `stories` top and best stories, as many new stories, and their
+    items, all posted within the last day. Every response waits `latency`
+    seconds, a share `error_rate` of them fails with a 503.
+    """
+
+    def __init__(
+        self, stories: int = 500, latency: float = 0.0, error_rate: float = 0.0
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        now = int(time.time())
+        self.items = {
+            id: {
+                "id": id,
+                "type": "story",
+                "by": f"user{id}",
+                "time": now - random.randint(0, 20 * 3600),
+                "title": f"Story {id}",
+                "score": random.randint(1, 1000),
+                "descendants": random.randint(0, 300),
+                "kids": list(range(id * 1000, id * 1000 + random.randint(0, 200))),
+                "url": f"https://example.com/{id}",
+            }
+            for id in range(1, 2 * stories + 1)
+        }
+        self.lists = {
+            "topstories": list(range(1, stories + 1)),
+            "beststories": list(range(1, stories + 1)),
+            "newstories": list(range(stories + 1, 2 * stories + 1)),
+        }
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._server.handle_error = lambda request, client_address: None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v0"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                status, body = server.respond(self.path)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path: str):
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return 503, {"error": "Service Unavailable"}
+        resource = path[len("/v0/") :] if path.startswith("/v0/") else path
+        if resource.endswith(".json"):
+            resource = resource[: -len(".json")]
+        if resource in self.lists:
+            return 200, self.lists[resource]
+        elif resource == "maxitem":
+            return 200, max(self.items)
+        elif resource.startswith("item/"):
+            return 200, self.items.get(int(resource[len("item/") :]))
+        return 404, None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        with self._lock:
+            self.sent += 1
+
+
+class BenchEventHandler(services.EventHandler):
+    """
+    Renders and sends stories like the bot's handlers.
+    """
+
+    def __init__(
+        self, bot: FakeBot, engine: Optional[delivery.DeliveryEngine] = None
+    ) -> None:
+        self.bot = bot
+        self.engine = engine
+
+    def handle(self, subscribers: List[repos.Subscriber], item):
+        self.handle_many(subscribers, [item])
+
+    def handle_many(self, subscribers: List[repos.Subscriber], stories):
+        texts = items.display_cache.render_many(items.TopStoryDisplay, stories)
+        if self.engine is None:
+            for text in texts:
+                for subscriber in subscribers:
+                    self.bot.send_message(subscriber.id, text, parse_mode="HTML")
+            return
+        self.engine.deliver(
+            [
+                delivery.Message(subscriber.id, text, parse_mode="HTML")
+                for text in texts
+                for subscriber in subscribers
+            ]
+        )
+
+
+def percentile(values: List[float], p: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def run_benchmark(
+    stories: int = 500,
+    subscribers: int = 100,
+    cycles: int = 10,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    threshold: float = 0.5,
+    lazy: bool = True,
+    delivery_workers: int = 0,
+    use_async: bool = False,
+) -> dict:
+    """
+    Run `cycles` publish cycles of the top stories, each from an empty
+    published set, then one cleanup of the published ids. `use_async` runs
+    the cycles with `apublish_stories` on a single event loop.
+    """
+    tracemalloc.start()
+    bot = FakeBot()
+    engine = (
+        delivery.DeliveryEngine(
+            bot.send_message,
+            workers=delivery_workers,
+            global_rate=1e9,
+            per_chat_rate=1e9,
+        )
+        if delivery_workers
+        else None
+    )
+    pubsub_repo = repos.RedisPubSubRepository(r=fakeredis.FakeRedis())
+    for id in range(subscribers):
+        pubsub_repo.for_topic(Topic.top).add_subscriber(id)
+
+    latencies: List[float] = []
+    failed = 0
+    with FakeHNServer(stories, latency, error_rate) as server:
+        hn_repo = repos.HNRepository(
+            base_url=server.base_url,
+            item_factory=items.LazyItemFactory() if lazy else None,
+        )
+        publish_service = services.NHPublishService(
+            hn_repo=hn_repo,
+            pubsub_repo=pubsub_repo,
+            filters=filters.NormalDistributionFilter(threshold=threshold),
+        ).add_handler(Topic.top, BenchEventHandler(bot, engine))
+
+        async def apublish_cycles():
+            nonlocal failed
+            try:
+                for _ in range(cycles):
+                    pubsub_repo.for_topic(Topic.top).clear_published()
+                    cycle_started_at = time.perf_counter()
+                    try:
+                        await publish_service.apublish_stories(Topic.top)
+                    except Exception:
+                        failed += 1
+                    latencies.append(time.perf_counter() - cycle_started_at)
+            finally:
+                await hn_repo.aclose()
+
+        started_at = time.perf_counter()
+        if use_async:
+            asyncio.run(apublish_cycles())
+        else:
+            for _ in range(cycles):
+                pubsub_repo.for_topic(Topic.top).clear_published()
+                cycle_started_at = time.perf_counter()
+                try:
+                    publish_service.publish_stories(Topic.top)
+                except Exception:
+                    failed += 1
+                latencies.append(time.perf_counter() - cycle_started_at)
+        elapsed = time.perf_counter() - started_at
+
+        cleanup_started_at = time.perf_counter()
+        services.BackgroundService(
+            hn_repo, pubsub_repo, retention=timedelta(0)
+        ).reduce_published_set_size(Topic.top)
+        cleanup = time.perf_counter() - cleanup_started_at
+
+        hn_repo.close()
+        requests, errors = server.requests, server.errors
+    if engine is not None:
+        engine.close()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "cycles": cycles,
+        "failed_cycles": failed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "sent": bot.sent,
+        "throughput": bot.sent / elapsed if elapsed else 0.0,
+        "requests": requests,
+        "errors": errors,
+        "cleanup": cleanup,
+        "peak_memory": peak_memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stories", type=int, default=500)
+    parser.add_argument("--subscribers", type=int, default=100)
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--full-models", action="store_true")
+    parser.add_argument("--delivery-workers", type=int, default=0)
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        stories=args.stories,
+        subscribers=args.subscribers,
+        cycles=args.cycles,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        threshold=args.threshold,
+        lazy=not args.full_models,
+        delivery_workers=args.delivery_workers,
+        use_async=args.use_async,
+    )
+    print(
+        f"{report['cycles']} cycles ({report['failed_cycles']} failed), "
+        f"p50 {report['p50'] * 1000:.1f} ms, p99 {report['p99'] * 1000:.1f} ms\n"
+        f"{report['sent']} messages, {report['throughput']:.0f} messages/s, "
+        f"{report['requests']} HN requests ({report['errors']} failed)\n"
+        f"cleanup {report['cleanup'] * 1000:.1f} ms, "
+        f"peak memory {report['peak_memory'] / 2**20:.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
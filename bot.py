@@ -1,10 +1,18 @@
 import argparse
+import asyncio
 import logging
-from datetime import timedelta
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
 from enum import IntEnum, auto
 from functools import partial
-from typing import List, Type, Union
+from typing import Callable, Dict, List, Optional, Type, Union
+from urllib.parse import urlsplit
 
+import telegram.error
 from decouple import config
 from telegram import Bot, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
@@ -15,7 +23,23 @@ from telegram.ext import (
     Updater,
 )
 
-from hnread import filters, items, repos, services
+from hnread import (
+    caches,
+    coordination,
+    delivery,
+    feeds,
+    filters,
+    items,
+    loops,
+    metrics,
+    outbox,
+    repos,
+    schedulers,
+    series,
+    services,
+    snapshots,
+    webhooks,
+)
 from hnread.topics import Topic
 
 # Enable logging
@@ -27,11 +51,87 @@ logger = logging.getLogger(__name__)
 
 BOT_TOKEN = config("BOT_TOKEN")
 REDIS_URL = config("REDIS_URL")
+REDIS_MAX_CONNECTIONS = config("REDIS_MAX_CONNECTIONS", default=50, cast=int)
+PUBLISHED_STORE = config("PUBLISHED_STORE", default="sorted_set")
+STORY_FILTER = config("STORY_FILTER", default="normal")
+MIN_VELOCITY = config("MIN_VELOCITY", default=10.0, cast=float)
+ITEM_CACHE_SIZE = config("ITEM_CACHE_SIZE", default=10000, cast=int)
+ITEM_CACHE_REDIS = config("ITEM_CACHE_REDIS", default=False, cast=bool)
+HN_STREAMING = config("HN_STREAMING", default=False, cast=bool)
+DELIVERY_WORKERS = config("DELIVERY_WORKERS", default=8, cast=int)
+DELIVERY_GLOBAL_RATE = config("DELIVERY_GLOBAL_RATE", default=30.0, cast=float)
+DELIVERY_PER_CHAT_RATE = config("DELIVERY_PER_CHAT_RATE", default=1.0, cast=float)
+DIGEST_MODE = config("DIGEST_MODE", default=False, cast=bool)
+DIGEST_WINDOW = config("DIGEST_WINDOW", default=0, cast=int)
+FILTER_SNAPSHOT_DIR = config("FILTER_SNAPSHOT_DIR", default="")
+FILTER_SNAPSHOT_INTERVAL = config("FILTER_SNAPSHOT_INTERVAL", default=300, cast=int)
+METRICS_PORT = config("METRICS_PORT", default=0, cast=int)
+PUBLISH_JITTER = config("PUBLISH_JITTER", default=0.1, cast=float)
+SNAPSHOT_MAX_AGE = config("SNAPSHOT_MAX_AGE", default=30.0, cast=float)
+REPLICAS = config("REPLICAS", default=False, cast=bool)
+OUTBOX = config("OUTBOX", default=False, cast=bool)
+OUTBOX_CONSUMERS = config("OUTBOX_CONSUMERS", default=2, cast=int)
+REPLICA_LEASE = config("REPLICA_LEASE", default=30, cast=int)
+KEYWORD_INTERVAL = config("KEYWORD_INTERVAL", default=60, cast=int)
+COMMENT_PREVIEWS = config("COMMENT_PREVIEWS", default=0, cast=int)
+COMMENT_PREVIEW_DEADLINE = config("COMMENT_PREVIEW_DEADLINE", default=2.0, cast=float)
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+WEBHOOK_PORT = config("WEBHOOK_PORT", default=8443, cast=int)
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="")
+
+event_loop = loops.EventLoopThread()
+redis_client = metrics.InstrumentedRedis(
+    connection_pool=repos.connection_pool(REDIS_URL, REDIS_MAX_CONNECTIONS)
+)
+pubsub_repo = (
+    repos.BitmapPubSubRepository(r=redis_client)
+    if PUBLISHED_STORE == "bitmap"
+    else repos.RedisPubSubRepository(r=redis_client)
+)
+keyword_repo = repos.RedisKeywordRepository(r=redis_client)
+sub_service = services.HNSubscribeService(pubsub_repo, keyword_repo)
+item_cache_tiers: List[caches.IItemCache] = [caches.LRUItemCache(ITEM_CACHE_SIZE)]
+if ITEM_CACHE_REDIS:
+    item_cache_tiers.append(caches.RedisItemCache(redis_client))
+hn_repo = repos.HNRepository(
+    cache=caches.ItemCache(item_cache_tiers), item_factory=items.LazyItemFactory()
+)
+change_feed = feeds.ChangeFeed(hn_repo)
+filter_snapshot_store: snapshots.ISnapshotStore = (
+    snapshots.FileSnapshotStore(FILTER_SNAPSHOT_DIR)
+    if FILTER_SNAPSHOT_DIR
+    else snapshots.RedisSnapshotStore(redis_client)
+)
+coordinator: Optional[coordination.Coordinator] = (
+    coordination.Coordinator(redis_client, lease=REPLICA_LEASE) if REPLICAS else None
+)
+delivery_outbox: Optional[outbox.Outbox] = (
+    outbox.Outbox(redis_client) if OUTBOX else None
+)
+delivery_engine: Optional[delivery.DeliveryEngine] = None
+publish_services: Dict[Topic, services.NHPublishService] = {}
+keyword_service: Optional[services.KeywordPublishService] = None
 
 
 class BaseStoriesEventHandler(services.EventHandler):
-    def __init__(self, bot: Bot) -> None:
+    topic: Topic
+
+    @property
+    def label(self) -> str:
+        """
+        The topic label of the handler's metrics and outbox jobs.
+        """
+        return self.topic.value
+
+    def __init__(
+        self,
+        bot: Bot,
+        engine: Optional[delivery.DeliveryEngine] = None,
+        delivery_outbox: Optional[outbox.Outbox] = None,
+    ) -> None:
         self.bot = bot
+        self.engine = engine
+        self.outbox = delivery_outbox
 
     def get_display_class(self) -> Type[items.StoryDisplay]:
         pass
@@ -41,21 +141,97 @@ class BaseStoriesEventHandler(services.EventHandler):
         subscribers: List[repos.Subscriber],
         item: Union[items.Story, items.Job, items.Poll],
     ):
-        display_text = str(self.get_display_class()(item))
-        for subscriber in subscribers:
-            self.bot.send_message(subscriber.id, display_text, parse_mode="HTML")
+        self.handle_many(subscribers, [item])
+
+    def handle_many(
+        self,
+        subscribers: List[repos.Subscriber],
+        stories: List[Union[items.Story, items.Job, items.Poll]],
+    ):
+        display_texts = self.render(stories)
+        self.send(subscribers, display_texts)
+
+    def handle_digest(
+        self,
+        subscribers: List[repos.Subscriber],
+        stories: List[Union[items.Story, items.Job, items.Poll]],
+    ):
+        display_texts = self.render(stories)
+        self.send(subscribers, items.split_messages(display_texts))
+
+    def render(
+        self, stories: List[Union[items.Story, items.Job, items.Poll]]
+    ) -> List[str]:
+        with metrics.timer("hnread_stage_seconds", topic=self.label, stage="render"):
+            return items.display_cache.render_many(self.get_display_class(), stories)
+
+    def send(self, subscribers: List[repos.Subscriber], texts: List[str]):
+        """
+        Publish services claim the stories once this returns, a crash before
+        the outbox jobs are written leaves them unclaimed for the next cycle.
+        """
+        if self.outbox is not None:
+            self.outbox.enqueue(
+                [
+                    delivery.Message(subscriber.id, text, parse_mode="HTML")
+                    for text in texts
+                    for subscriber in subscribers
+                ],
+                topic=self.label,
+            )
+            return
+
+        if self.engine is None:
+            for text in texts:
+                for subscriber in subscribers:
+                    self.bot.send_message(subscriber.id, text, parse_mode="HTML")
+            metrics.increment(
+                "hnread_messages_total",
+                len(texts) * len(subscribers),
+                topic=self.label,
+                status="sent",
+            )
+            return
+
+        report = self.engine.deliver(
+            [
+                delivery.Message(subscriber.id, text, parse_mode="HTML")
+                for text in texts
+                for subscriber in subscribers
+            ]
+        )
+        for status in ["sent", "failed", "retried"]:
+            metrics.increment(
+                "hnread_messages_total",
+                getattr(report, status),
+                topic=self.label,
+                status=status,
+            )
 
 
 class TopStoriesEventHandler(BaseStoriesEventHandler):
+    topic = Topic.top
+
     def get_display_class(self) -> Type[items.TopStoryDisplay]:
         return items.TopStoryDisplay
 
 
 class BestStoriesEventHandler(BaseStoriesEventHandler):
+    topic = Topic.best
+
     def get_display_class(self) -> Type[items.BestStoryDisplay]:
         return items.BestStoryDisplay
 
 
+class KeywordStoriesEventHandler(BaseStoriesEventHandler):
+    @property
+    def label(self) -> str:
+        return "keywords"
+
+    def get_display_class(self) -> Type[items.NewStoryDisplay]:
+        return items.NewStoryDisplay
+
+
 def help_command(update: Update, context: CallbackContext) -> None:
     if (message := update.message) is not None:
         message.reply_text("help")
@@ -75,7 +251,6 @@ class UnSubscribeState(IntEnum):
 
 
 def list_topic(update: Update, context: CallbackContext) -> int:
-    sub_service = services.HNSubscribeService(repos.RedisPubSubRepository(REDIS_URL))
     inline_keyboard_bottons = [
         InlineKeyboardButton(text, callback_data=f"{enum}")
         for enum, text, in sub_service.list_topic().items()
@@ -89,7 +264,6 @@ def list_topic(update: Update, context: CallbackContext) -> int:
 
 
 def list_subscribed_topic(update: Update, context: CallbackContext):
-    sub_service = services.HNSubscribeService(repos.RedisPubSubRepository(REDIS_URL))
     inline_keyboard_bottons = [
         InlineKeyboardButton(text, callback_data=f"{enum}")
         for enum, text in sub_service.list_subscribed_topic(
@@ -113,7 +287,6 @@ def subscribe(
     query = update.callback_query
     query.answer()
 
-    sub_service = services.HNSubscribeService(repos.RedisPubSubRepository(REDIS_URL))
     sub_service.subscribe(topic, repos.Subscriber(id=query.message.chat_id))
 
     query.edit_message_text(f"Subscribed {sub_service.list_topic()[topic]} !")
@@ -128,51 +301,180 @@ def unsubscribe(
     query = update.callback_query
     query.answer()
 
-    sub_service = services.HNSubscribeService(repos.RedisPubSubRepository(REDIS_URL))
     sub_service.unsubscribe(topic, repos.Subscriber(id=query.message.chat_id))
 
     query.edit_message_text(f"Unsubscribed {sub_service.list_topic()[topic]} !")
     return ConversationHandler.END
 
 
-def publish_topstories(context: CallbackContext):
-    (
-        services.NHPublishService(
-            hn_repo=repos.HNRepository(),
-            pubsub_repo=repos.RedisPubSubRepository(REDIS_URL),
-            filters=filters.norm_filter,
+def watch_command(update: Update, context: CallbackContext) -> None:
+    if (message := update.message) is None:
+        return
+    if not context.args:
+        message.reply_text(
+            "Usage: /watch <keyword>, or /watch site:<domain> for a domain"
         )
-        .add_handler(Topic.top, TopStoriesEventHandler(context.bot))
-        .publish_stories(Topic.top)
-    )
+        return
+    try:
+        term = sub_service.watch(
+            " ".join(context.args), repos.Subscriber(id=message.chat_id)
+        )
+    except ValueError:
+        message.reply_text("Keywords cannot be empty")
+        return
+    message.reply_text(f"Watching {term} !")
+
+
+def unwatch_command(update: Update, context: CallbackContext) -> None:
+    if (message := update.message) is None:
+        return
+    if not context.args:
+        message.reply_text("Usage: /unwatch <keyword>")
+        return
+    keyword = " ".join(context.args)
+    term = sub_service.unwatch(keyword, repos.Subscriber(id=message.chat_id))
+    if term is None:
+        message.reply_text(f"You are not watching {keyword}.")
+        return
+    message.reply_text(f"Stopped watching {term} !")
+
+
+def watching_command(update: Update, context: CallbackContext) -> None:
+    if (message := update.message) is None:
+        return
+    if terms := sub_service.list_watched(message.chat_id):
+        message.reply_text("Watching:\n" + "\n".join(terms))
+    else:
+        message.reply_text("You are not watching any keyword.")
+
+
+def build_publish_services(bot: Bot) -> Dict[Topic, services.NHPublishService]:
+    story_filters: Dict[Topic, filters.AbstractFilter] = dict(filters.norm_filters)
+    if STORY_FILTER == "velocity":
+        score_series = series.ScoreSeriesStore()
+        for topic in story_filters:
+            story_filters[topic] = filters.VelocityFilter(score_series, MIN_VELOCITY)
+    handlers = {
+        Topic.top: TopStoriesEventHandler(bot, delivery_engine, delivery_outbox),
+        Topic.best: BestStoriesEventHandler(bot, delivery_engine, delivery_outbox),
+    }
+    publish_services = {}
+    for topic, handler in handlers.items():
+        publish_service = services.NHPublishService(
+            hn_repo=hn_repo,
+            pubsub_repo=pubsub_repo,
+            filters=story_filters[topic],
+            feed=change_feed,
+            coordinator=coordinator,
+        ).add_handler(topic, handler)
+        publish_service.share_snapshots(SNAPSHOT_MAX_AGE)
+        if DIGEST_MODE:
+            publish_service.enable_digest(timedelta(seconds=DIGEST_WINDOW))
+        if COMMENT_PREVIEWS:
+            publish_service.enable_comment_previews(
+                COMMENT_PREVIEWS, deadline=COMMENT_PREVIEW_DEADLINE
+            )
+        publish_services[topic] = publish_service
+    return publish_services
+
+
+async def apublish_stories(topic: Topic) -> Optional[int]:
+    return await publish_services[topic].apublish_stories(topic)
+
+
+publish_scheduler = schedulers.PublishScheduler(
+    apublish_stories,
+    {
+        Topic.top: schedulers.AdaptiveInterval(60, 30, 300, jitter=PUBLISH_JITTER),
+        Topic.best: schedulers.AdaptiveInterval(360, 180, 1800, jitter=PUBLISH_JITTER),
+    },
+)
 
 
-def publish_beststories(context: CallbackContext):
-    (
-        services.NHPublishService(
-            hn_repo=repos.HNRepository(),
-            pubsub_repo=repos.RedisPubSubRepository(REDIS_URL),
-            filters=filters.norm_filter,
-        )
-        .add_handler(Topic.best, BestStoriesEventHandler(context.bot))
-        .publish_stories(Topic.best)
+async def stream_stories():
+    await hn_repo.astart_streaming(
+        *[
+            resource
+            for topic, serv in publish_services.items()
+            for resource in serv.stream_resources[topic]
+        ]
+    )
+    await asyncio.gather(
+        *[
+            serv.apublish_on_change(topic, trigger=publish_scheduler.trigger)
+            for topic, serv in publish_services.items()
+        ]
     )
 
 
+def publish_keywords(context: CallbackContext):
+    event_loop.run(keyword_service.apublish())
+
+
+def log_failure(name: str) -> Callable[[Future], None]:
+    """
+    A done callback logging the exception a background future ended with.
+    """
+
+    def callback(future: Future):
+        if not future.cancelled() and (e := future.exception()) is not None:
+            logger.error(f"{name} stopped", exc_info=e)
+
+    return callback
+
+
 def clear_old_published(context: CallbackContext):
     background_serv = services.BackgroundService(
-        hn_repo=repos.HNRepository(),
-        pubsub_repo=repos.RedisPubSubRepository(REDIS_URL),
+        hn_repo=hn_repo,
+        pubsub_repo=pubsub_repo,
     )
     for topic in Topic:
-        background_serv.reduce_published_set_size(topic)
+        event_loop.run(background_serv.areduce_published_set_size(topic))
+    oldest = datetime.now(timezone.utc) - background_serv.retention
+    keyword_repo.delete_routed_before(oldest.timestamp())
+
+
+def heartbeat(context: CallbackContext):
+    coordinator.heartbeat()
+
+
+def save_filters(context: CallbackContext):
+    filters.save_filters(filter_snapshot_store, filters.norm_filters)
+
+
+def start_webhook(updater: Updater) -> webhooks.WebhookServer:
+    """
+    Receive updates on the shared event loop instead of long polling.
+    """
+    updater.job_queue.start()
+    threading.Thread(
+        target=updater.dispatcher.start, name="dispatcher", daemon=True
+    ).start()
+    webhook_server = event_loop.run(
+        webhooks.WebhookServer(
+            updater.bot,
+            updater.dispatcher.update_queue,
+            path=urlsplit(WEBHOOK_URL).path or "/",
+            secret_token=WEBHOOK_SECRET or None,
+            port=WEBHOOK_PORT,
+        ).astart()
+    )
+    updater.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+    return webhook_server
+
+
+def wait_for_stop_signal():
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    stopped.wait()
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--reset_db",
-        default=lambda: repos.RedisPubSubRepository(REDIS_URL).flush(),
+        default=lambda: pubsub_repo.flush(),
         help="reset db",
         action="store_true",
     )
@@ -183,16 +485,80 @@ def main() -> None:
 
     updater = Updater(BOT_TOKEN)
 
+    metrics_server: Optional[metrics.MetricsServer] = None
+    if METRICS_PORT:
+        metrics_sink = metrics.PrometheusSink()
+        metrics.set_sink(metrics_sink)
+        metrics_server = metrics.MetricsServer(metrics_sink, port=METRICS_PORT)
+        metrics_server.start()
+
+    global delivery_engine
+    delivery_engine = delivery.DeliveryEngine(
+        updater.bot.send_message,
+        workers=DELIVERY_WORKERS,
+        global_rate=DELIVERY_GLOBAL_RATE,
+        per_chat_rate=DELIVERY_PER_CHAT_RATE,
+    )
+    publish_services.update(build_publish_services(updater.bot))
+    global keyword_service
+    keyword_service = services.KeywordPublishService(
+        hn_repo,
+        keyword_repo,
+        KeywordStoriesEventHandler(updater.bot, delivery_engine, delivery_outbox),
+    ).share_snapshots(SNAPSHOT_MAX_AGE)
+    keyword_repo.load()
+    outbox_workers: List[outbox.OutboxWorker] = []
+    if delivery_outbox is not None:
+        delivery_outbox.create_group()
+        replica_id = (
+            coordinator.replica_id
+            if coordinator is not None
+            else f"{socket.gethostname()}:{os.getpid()}"
+        )
+        outbox_workers = [
+            outbox.OutboxWorker(
+                delivery_outbox,
+                delivery_engine,
+                f"{replica_id}:{i}",
+                permanent_errors=(
+                    telegram.error.Unauthorized,
+                    telegram.error.BadRequest,
+                ),
+            )
+            for i in range(OUTBOX_CONSUMERS)
+        ]
+        for worker in outbox_workers:
+            worker.start()
+    try:
+        filters.restore_filters(filter_snapshot_store, filters.norm_filters)
+    except Exception as e:
+        logger.error("Failed to restore filters, starting empty", exc_info=e)
+        for topic_filter in filters.norm_filters.values():
+            topic_filter.reset()
+    for topic in Topic:
+        topic_pubsub_repo = pubsub_repo.for_topic(topic)
+        if migrated := topic_pubsub_repo.migrate_published():
+            logger.info(f"Migrated {migrated} {topic.name} published ids")
+        logger.info(
+            f"{topic.name} published ids use {topic_pubsub_repo.memory_usage()} bytes"
+        )
+
     updater.bot.set_my_commands(
         [
             BotCommand("ping", "ping"),
             BotCommand("subscribe", "subscribe topics"),
             BotCommand("list_subscribed", "list subscribed topics"),
+            BotCommand("watch", "watch a keyword or site:domain"),
+            BotCommand("unwatch", "stop watching a keyword"),
+            BotCommand("watching", "list watched keywords"),
         ]
     )
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
     dispatcher.add_handler(CommandHandler("ping", ping_command))
+    dispatcher.add_handler(CommandHandler("watch", watch_command))
+    dispatcher.add_handler(CommandHandler("unwatch", unwatch_command))
+    dispatcher.add_handler(CommandHandler("watching", watching_command))
     dispatcher.add_handler(
         ConversationHandler(
             entry_points=[CommandHandler("subscribe", list_topic)],
@@ -240,29 +606,68 @@ def main() -> None:
         )
     )
 
+    if coordinator is not None:
+        coordinator.join()
+        logger.info(f"Joined as replica {coordinator.replica_id}")
+
+    event_loop.start()
+    scheduler_future = event_loop.submit(publish_scheduler.arun())
+    scheduler_future.add_done_callback(log_failure("Publish scheduler"))
+    stream_future: Optional[Future] = None
+    if HN_STREAMING:
+        stream_future = event_loop.submit(stream_stories())
+        stream_future.add_done_callback(log_failure("Story streaming"))
+
     job_queue = updater.job_queue
     job_queue.run_repeating(
-        publish_topstories,
-        interval=timedelta(seconds=60),
-        name="publish_topstories",
+        clear_old_published,
+        interval=timedelta(days=1),
+        name="clear_old_published",
     )
+    if coordinator is not None:
+        job_queue.run_repeating(
+            heartbeat,
+            interval=timedelta(seconds=REPLICA_LEASE / 3),
+            name="heartbeat",
+        )
     job_queue.run_repeating(
-        publish_beststories,
-        interval=timedelta(seconds=360),
-        name="publish_beststories",
+        publish_keywords,
+        interval=timedelta(seconds=KEYWORD_INTERVAL),
+        name="publish_keywords",
     )
     job_queue.run_repeating(
-        clear_old_published,
-        interval=timedelta(days=1),
-        name="clear_old_published",
+        save_filters,
+        interval=timedelta(seconds=FILTER_SNAPSHOT_INTERVAL),
+        name="save_filters",
     )
     # Start the Bot
-    updater.start_polling()
-
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    if WEBHOOK_URL:
+        webhook_server = start_webhook(updater)
+        wait_for_stop_signal()
+        event_loop.run(webhook_server.astop())
+        updater.stop()
+    else:
+        updater.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+
+    scheduler_future.cancel()
+    if stream_future is not None:
+        stream_future.cancel()
+    if coordinator is not None:
+        coordinator.leave()
+    filters.save_filters(filter_snapshot_store, filters.norm_filters)
+    event_loop.run(hn_repo.aclose())
+    event_loop.stop()
+    hn_repo.close()
+    for worker in outbox_workers:
+        worker.stop()
+    delivery_engine.close()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import redis
+
+# (max item age in seconds, ttl in seconds), young items change score quickly.
+AGE_TTLS: List[Tuple[float, float]] = [
+    (2 * 3600, 60),
+    (24 * 3600, 300),
+    (5 * 24 * 3600, 3600),
+]
+MAX_TTL = 24 * 3600
+
+
+def age_based_ttl(data: dict) -> float:
+    if data.get("deleted") or data.get("dead"):
+        return MAX_TTL
+    if "time" not in data:
+        return AGE_TTLS[0][1]
+    age = time.time() - data["time"]
+    for max_age, ttl in AGE_TTLS:
+        if age < max_age:
+            return ttl
+    return MAX_TTL
+
+
+class IItemCache(ABC):
+    """
+    Caches raw item payloads, as returned by the HN API, by item id.
+    `blocking` caches do I/O and are kept off the event loop.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def get(self, id: int) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def set(self, id: int, data: dict, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete(self, id: int):
+        pass
+
+
+class LRUItemCache(IItemCache):
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self._data: OrderedDict[int, Tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, id: int) -> Optional[dict]:
+        with self._lock:
+            if (entry := self._data.get(id)) is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                del self._data[id]
+                return None
+            self._data.move_to_end(id)
+            return data
+
+    def set(self, id: int, data: dict, ttl: float):
+        with self._lock:
+            self._data[id] = (time.monotonic() + ttl, data)
+            self._data.move_to_end(id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, id: int):
+        with self._lock:
+            self._data.pop(id, None)
+
+
+class RedisItemCache(IItemCache):
+    blocking = True
+
+    def __init__(self, r: redis.Redis, prefix: str = "item") -> None:
+        self.r = r
+        self.prefix = prefix
+
+    def _item_key(self, id: int) -> str:
+        return f"{self.prefix}:{id}"
+
+    def get(self, id: int) -> Optional[dict]:
+        if (raw := self.r.get(self._item_key(id))) is None:
+            return None
+        return json.loads(raw)
+
+    def set(self, id: int, data: dict, ttl: float):
+        self.r.set(self._item_key(id), json.dumps(data), px=max(int(ttl * 1000), 1))
+
+    def delete(self, id: int):
+        self.r.delete(self._item_key(id))
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def count(self, hits: int = 0, misses: int = 0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def hit_ratio(self) -> float:
+        with self._lock:
+            total = self.hits + self.misses
+            return self.hits / total if total else 0.0
+
+    def __repr__(self) -> str:
+        return f"CacheStats(hits={self.hits}, misses={self.misses})"
+
+
+class ItemCache:
+    """
+    Looks items up through a list of tiers, fastest first. A hit in a slower
+    tier is copied into the faster ones.
+    """
+
+    def __init__(
+        self,
+        tiers: List[IItemCache],
+        ttl: Callable[[dict], float] = age_based_ttl,
+    ) -> None:
+        self.tiers = tiers
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    @property
+    def blocking(self) -> bool:
+        return any(tier.blocking for tier in self.tiers)
+
+    def get(self, id: int) -> Optional[dict]:
+        for i, tier in enumerate(self.tiers):
+            if (data := tier.get(id)) is not None:
+                self.stats.count(hits=1)
+                for faster_tier in self.tiers[:i]:
+                    faster_tier.set(id, data, self.ttl(data))
+                return data
+        self.stats.count(misses=1)
+        return None
+
+    def set(self, id: int, data: dict):
+        ttl = self.ttl(data)
+        for tier in self.tiers:
+            tier.set(id, data, ttl)
+
+    def delete(self, id: int):
+        for tier in self.tiers:
+            tier.delete(id)
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis
+
+from . import metrics, repos
+from .topics import Topic
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+elseif owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def rendezvous_owner(key: int, replicas: List[str]) -> str:
+    """
+    The replica with the highest hash for `key`, only the keys of a replica
+    leaving or joining move.
+    """
+    return max(
+        replicas,
+        key=lambda replica: hashlib.blake2b(
+            f"{replica}:{key}".encode(), digest_size=8
+        ).digest(),
+    )
+
+
+class Coordinator:
+    """
+    Coordinates replicas of the bot through Redis.
+
+    Each topic has a leader, holding a lease renewed by `heartbeat`, which
+    fetches and filters stories, then claims them and announces the claimed
+    ones with the live replicas in one transaction, see `claim_and_announce`.
+    Every replica reads the announced batches and delivers them to the
+    subscribers it owns among the batch's replicas, so a batch reaches each
+    subscriber at most once even while replicas join or leave. A replica
+    moves past a batch once it is `delivered`, a failed delivery is retried.
+    """
+
+    def __init__(
+        self,
+        r: redis.Redis,
+        replica_id: Optional[str] = None,
+        lease: float = 30.0,
+        max_batches: int = 1000,
+    ) -> None:
+        self.r = r
+        self.replica_id = replica_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self.lease = lease
+        self.max_batches = max_batches
+        self.leading: Set[Topic] = set()
+        self.last_batch_ids: Dict[Topic, str] = {}
+        self._acquire_lease = self.r.register_script(ACQUIRE_LEASE_SCRIPT)
+        self._release_lease = self.r.register_script(RELEASE_LEASE_SCRIPT)
+
+    @property
+    def _replicas_key(self) -> str:
+        return "replicas"
+
+    def _leader_key(self, topic: Topic) -> str:
+        return f"{topic.value}:leader"
+
+    def _batches_key(self, topic: Topic) -> str:
+        return f"{topic.value}:batches"
+
+    def join(self):
+        """
+        Register the replica, it delivers the batches announced from now on.
+
+        Stream positions are read before registering, a batch announced in
+        between may count this replica among its owners.
+        """
+        for topic in Topic:
+            last = self.r.xrevrange(self._batches_key(topic), count=1)
+            self.last_batch_ids[topic] = last[0][0].decode() if last else "0-0"
+        self.heartbeat()
+
+    def leave(self):
+        self.r.zrem(self._replicas_key, self.replica_id)
+        for topic in self.leading:
+            self._release_lease(keys=[self._leader_key(topic)], args=[self.replica_id])
+        self.leading = set()
+
+    def heartbeat(self):
+        now = time.time()
+        with self.r.pipeline() as pipe:
+            pipe.zadd(self._replicas_key, {self.replica_id: now})
+            pipe.zremrangebyscore(self._replicas_key, "-inf", now - self.lease)
+            pipe.execute()
+        for topic in list(self.leading):
+            self.is_leader(topic)
+        metrics.set_gauge("hnread_replicas", len(self.replicas()))
+
+    def replicas(self) -> List[str]:
+        return sorted(
+            replica.decode()
+            for replica in self.r.zrangebyscore(
+                self._replicas_key, time.time() - self.lease, "+inf"
+            )
+        )
+
+    def is_leader(self, topic: Topic) -> bool:
+        """
+        Take or renew the topic's lease.
+        """
+        leader = bool(
+            self._acquire_lease(
+                keys=[self._leader_key(topic)],
+                args=[self.replica_id, int(self.lease * 1000)],
+            )
+        )
+        if leader and topic not in self.leading:
+            logger.info(f"Replica {self.replica_id} leads {topic.name}")
+            self.leading.add(topic)
+        elif not leader and topic in self.leading:
+            logger.info(f"Replica {self.replica_id} lost {topic.name} lead")
+            self.leading.discard(topic)
+        metrics.set_gauge("hnread_leader", int(leader), topic=topic.value)
+        return leader
+
+    def _replicas_field(self) -> str:
+        return json.dumps(self.replicas() or [self.replica_id])
+
+    def announce(self, topic: Topic, ids: List[int]):
+        if not ids:
+            return
+        self.r.xadd(
+            self._batches_key(topic),
+            {"ids": json.dumps(ids), "replicas": self._replicas_field()},
+            maxlen=self.max_batches,
+            approximate=True,
+        )
+
+    def claim_and_announce(
+        self,
+        topic: Topic,
+        pubsub_repo: repos.IPubSubRepository,
+        ids: List[int],
+        times: Optional[List[float]] = None,
+    ) -> List[int]:
+        """
+        Claim `ids` in `pubsub_repo` and announce the claimed ones atomically,
+        so a leader failing midway neither loses nor repeats stories.
+        """
+        return pubsub_repo.claim_and_announce(
+            ids,
+            times,
+            self._batches_key(topic),
+            {"replicas": self._replicas_field()},
+            self.max_batches,
+        )
+
+    def announced(self, topic: Topic) -> List[Tuple[str, List[int], List[str]]]:
+        """
+        The (batch id, ids, replicas) batches announced after the last one
+        `delivered`.
+        """
+        last_batch_id = self.last_batch_ids.get(topic, "0-0")
+        res = self.r.xread({self._batches_key(topic): last_batch_id})
+        if not res:
+            return []
+        return [
+            (
+                batch_id.decode(),
+                json.loads(fields[b"ids"]),
+                json.loads(fields[b"replicas"]),
+            )
+            for batch_id, fields in res[0][1]
+        ]
+
+    def delivered(self, topic: Topic, batch_id: str):
+        self.last_batch_ids[topic] = batch_id
+
+    def owns(self, subscriber_id: int, replicas: List[str]) -> bool:
+        return rendezvous_owner(subscriber_id, replicas) == self.replica_id
@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        """
+        Take a token, return how many seconds to wait before using it.
+        """
+        with self._lock:
+            self._refill(self.clock())
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self):
+        if (wait := self.reserve()) > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Hand out no token for `seconds`, as asked by a 429 `retry_after`.
+        """
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0)
+            self.updated_at = max(self.updated_at, now + seconds)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill(max(self.clock(), self.updated_at))
+            return self.tokens >= self.capacity
+
+
+class Message:
+    def __init__(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+
+
+class DeliveryReport:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.elapsed = 0.0
+        self.failures: List[Message] = []
+        self.errors: List[Exception] = []
+        self._lock = threading.Lock()
+
+    def count(self, sent: int = 0, failed: int = 0, retried: int = 0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            self.retried += retried
+
+    def fail(self, message: Message, error: Exception):
+        """
+        Count a failed message, `errors` holds its error at the same index.
+        """
+        with self._lock:
+            self.failed += 1
+            self.failures.append(message)
+            self.errors.append(error)
+
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f"DeliveryReport(sent={self.sent}, failed={self.failed}, "
+            f"retried={self.retried}, elapsed={self.elapsed:.2f}s, "
+            f"throughput={self.throughput():.1f}/s)"
+        )
+
+
+class _ChatSchedule:
+    """
+    The chats of a delivery with messages left, in a heap by the time their
+    bucket lets them send next. A chat taken by a worker leaves the heap
+    until `done`, so its messages go out one at a time and in order.
+    """
+
+    def __init__(self, chats: Dict[int, Deque[list]], ready_at: Dict[int, float]):
+        self.queues = chats
+        self.heap = [(ready_at[chat_id], chat_id) for chat_id in chats]
+        heapq.heapify(self.heap)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def take(self) -> Optional[Tuple[int, list]]:
+        """
+        Wait for the next sendable chat, None once every message is sent.
+        """
+        with self._cond:
+            while True:
+                if not self.heap:
+                    if not self.in_flight:
+                        return None
+                    self._cond.wait()
+                    continue
+                ready_at, chat_id = self.heap[0]
+                if (wait := ready_at - time.monotonic()) > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+                self.in_flight += 1
+                return chat_id, self.queues[chat_id].popleft()
+
+    def has_more(self, chat_id: int) -> bool:
+        return bool(self.queues[chat_id])
+
+    def done(
+        self, chat_id: int, ready_at: Optional[float], retry: Optional[list] = None
+    ):
+        with self._cond:
+            self.in_flight -= 1
+            if retry is not None:
+                self.queues[chat_id].appendleft(retry)
+            if ready_at is not None and self.queues[chat_id]:
+                heapq.heappush(self.heap, (ready_at, chat_id))
+            self._cond.notify_all()
+
+
+class DeliveryEngine:
+    """
+    Sends messages from a pool of workers under Telegram's rate limits, a
+    global token bucket for the bot and one token bucket per chat.
+
+    Messages of the same chat are sent in order, one at a time. Workers take
+    the chat whose bucket is ready first, so none of them waits on a chat
+    while others could send and throughput follows the global rate. Errors
+    carrying a `retry_after`, like telegram.error.RetryAfter, pause the
+    buckets for that long and the message is sent again.
+    """
+
+    def __init__(
+        self,
+        send: Callable[..., Any],
+        workers: int = 8,
+        global_rate: float = 30.0,
+        per_chat_rate: float = 1.0,
+        max_retries: int = 3,
+        max_chat_buckets: int = 10000,
+    ) -> None:
+        self.send = send
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._chat_buckets_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="delivery"
+            )
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._chat_buckets_lock:
+            if (bucket := self._chat_buckets.get(chat_id)) is None:
+                bucket = TokenBucket(self.per_chat_rate, capacity=1)
+                self._chat_buckets[chat_id] = bucket
+            self._chat_buckets.move_to_end(chat_id)
+            while len(self._chat_buckets) > self.max_chat_buckets:
+                oldest_chat_id, oldest_bucket = next(iter(self._chat_buckets.items()))
+                if not oldest_bucket.is_full():
+                    break
+                del self._chat_buckets[oldest_chat_id]
+            return bucket
+
+    def _send(self, job: list, report: DeliveryReport) -> bool:
+        """
+        Send a [message, attempt] job, return whether to send it again.
+        """
+        message, attempt = job
+        self.global_bucket.acquire()
+        try:
+            self.send(message.chat_id, message.text, **message.kwargs)
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is None or attempt == self.max_retries:
+                logger.warning(f"Failed to send to {message.chat_id}: {e!r}")
+                report.fail(message, e)
+                return False
+            logger.info(f"Rate limited, retry {message.chat_id} in {retry_after}s")
+            report.count(retried=1)
+            self._chat_bucket(message.chat_id).pause(float(retry_after))
+            self.global_bucket.pause(float(retry_after))
+            job[1] += 1
+            return True
+        report.count(sent=1)
+        return False
+
+    def _add_pending(self, count: int):
+        with self._pending_lock:
+            self._pending += count
+            metrics.set_gauge("hnread_delivery_pending", self._pending)
+
+    def _ready_at(self, chat_id: int) -> float:
+        return time.monotonic() + self._chat_bucket(chat_id).reserve()
+
+    def _run(self, schedule: _ChatSchedule, report: DeliveryReport):
+        while (task := schedule.take()) is not None:
+            chat_id, job = task
+            retry = False
+            ready_at = None
+            try:
+                retry = self._send(job, report)
+                if not retry:
+                    self._add_pending(-1)
+                if retry or schedule.has_more(chat_id):
+                    ready_at = self._ready_at(chat_id)
+            finally:
+                schedule.done(chat_id, ready_at, job if retry else None)
+
+    def deliver(self, messages: List[Message]) -> DeliveryReport:
+        report = DeliveryReport()
+        started_at = time.monotonic()
+
+        chats: Dict[int, Deque[list]] = {}
+        for message in messages:
+            chats.setdefault(message.chat_id, deque()).append([message, 0])
+        self._add_pending(len(messages))
+        schedule = _ChatSchedule(
+            chats, {chat_id: self._ready_at(chat_id) for chat_id in chats}
+        )
+        futures = [
+            self.executor.submit(self._run, schedule, report)
+            for _ in range(min(self.workers, len(chats)))
+        ]
+        for future in futures:
+            future.result()
+
+        report.elapsed = time.monotonic() - started_at
+        if messages:
+            logger.info(f"Delivered {len(messages)} messages: {report}")
+        return report
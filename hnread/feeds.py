@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from . import items, repos
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("data", "fetched_at", "read_at")
+
+    def __init__(self, data: dict, now: float) -> None:
+        self.data = data
+        self.fetched_at = now
+        self.read_at = now
+
+
+class ItemStore:
+    """
+    Item payloads by id, with the times each one was fetched and last read.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self._data: Dict[int, _Entry] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._data
+
+    def ids(self) -> Set[int]:
+        return set(self._data)
+
+    def get(self, id: int, max_staleness: Optional[float] = None) -> Optional[dict]:
+        if (entry := self._data.get(id)) is None:
+            return None
+        now = self.clock()
+        if max_staleness is not None and now - entry.fetched_at > max_staleness:
+            return None
+        entry.read_at = now
+        return entry.data
+
+    def put(self, id: int, data: dict):
+        self._data[id] = _Entry(data, self.clock())
+
+    def discard(self, id: int):
+        self._data.pop(id, None)
+
+    def prune(self, max_idle: timedelta) -> int:
+        """
+        Drop items not read for `max_idle`, those no longer in any list.
+        """
+        oldest = self.clock() - max_idle.total_seconds()
+        idle_ids = [id for id, entry in self._data.items() if entry.read_at < oldest]
+        for id in idle_ids:
+            del self._data[id]
+        return len(idle_ids)
+
+
+class ChangeFeed:
+    """
+    Keeps an ItemStore fresh from the `updates` endpoint.
+
+    Each `apoll` refreshes only the stored items HN reports as changed, so a
+    publish cycle fetches the items it has never seen, through the item
+    cache, plus the changed ones. The `updates` endpoint only lists recent
+    changes, entries older than `max_staleness` seconds are fetched again as
+    a safety net. Items not read for `max_idle` are dropped.
+    """
+
+    def __init__(
+        self,
+        hn_repo: repos.HNRepository,
+        store: Optional[ItemStore] = None,
+        max_idle: timedelta = timedelta(days=2),
+        max_staleness: float = 30 * 60,
+    ) -> None:
+        self.hn_repo = hn_repo
+        self.store = store if store is not None else ItemStore()
+        self.max_idle = max_idle
+        self.max_staleness = max_staleness
+
+    async def _arefresh(self, ids: Iterable[int], refresh: bool = True):
+        """
+        Fetch `ids` into the store, `refresh` skips the item cache. Ids failing
+        to fetch keep their stored payload, those not found are dropped.
+        """
+        ids = list(ids)
+        payloads = await asyncio.gather(
+            *[self.hn_repo.aitem_payload(id, refresh=refresh) for id in ids],
+            return_exceptions=True,
+        )
+        for id, data in zip(ids, payloads):
+            if isinstance(data, Exception):
+                logger.warning(f"Failed to fetch item {id}: {data!r}")
+            elif isinstance(data, dict) and "id" in data:
+                self.store.put(id, data)
+            else:
+                self.store.discard(id)
+
+    async def apoll(self) -> Set[int]:
+        """
+        Refresh the stored items changed since the last poll, return their ids.
+        """
+        updates = await self.hn_repo.aupdates_id()
+
+        changed_ids = set(updates["items"]) & self.store.ids()
+        await self._arefresh(changed_ids)
+
+        pruned = self.store.prune(self.max_idle)
+        logger.info(
+            f"Change feed refreshed {len(changed_ids)} items, pruned {pruned}, "
+            f"{len(self.store)} stored"
+        )
+        return changed_ids
+
+    async def aofIds(self, *ids: int, sort: bool = False) -> List[items.Item]:
+        missing_ids = [id for id in ids if id not in self.store]
+        stale_ids = [
+            id
+            for id in ids
+            if id in self.store and self.store.get(id, self.max_staleness) is None
+        ]
+        await asyncio.gather(
+            self._arefresh(missing_ids, refresh=False), self._arefresh(stale_ids)
+        )
+
+        res = []
+        for id in ids:
+            if (data := self.store.get(id)) is None:
+                continue
+            try:
+                res.append(self.hn_repo.item_factory.from_dict(data))
+            except (items.ObjectNotDefinedError, KeyError, ValueError) as e:
+                logger.warning(f"Dropping undecodable item {id}: {e!r}")
+                self.store.discard(id)
+        if sort:
+            res = sorted(res, key=lambda items: items.time)
+        return res
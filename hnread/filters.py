@@ -1,13 +1,19 @@
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
-from queue import PriorityQueue
-from statistics import NormalDist, StatisticsError, mean, variance
-from typing import Callable, List
+from array import array
+from statistics import NormalDist
+from typing import Dict, List, Optional
 
+from hnread import series, snapshots
 from hnread.items import ScoreableItem
+from hnread.topics import Topic
 
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_VERSION = 1
+
 
 class AbstractFilter(ABC):
     @abstractmethod
@@ -15,36 +21,207 @@ class AbstractFilter(ABC):
         pass
 
 
+class RunningStats:
+    """
+    Mean and variance of the last `capacity` values, kept in a ring buffer and
+    updated in O(1) per value with Welford's algorithm.
+
+    Removing values lets rounding errors build up, the aggregates are
+    recomputed from the buffer once every `capacity` evictions.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _push(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def _pop(self, x: float):
+        self.count -= 1
+        if self.count == 0:
+            self.mean, self.m2 = 0.0, 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (x - self.mean), 0.0)
+
+    def _recompute(self):
+        values = self.window()
+        self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        for x in values:
+            self._push(x)
+
+    def add(self, x: float):
+        if self.count == self.capacity:
+            self._pop(self.values[self.start])
+            self.values[self.start] = x
+            self.start = (self.start + 1) % self.capacity
+            self._push(x)
+            self._evictions += 1
+            if self._evictions >= self.capacity:
+                self._evictions = 0
+                self._recompute()
+        else:
+            self.values[(self.start + self.count) % self.capacity] = x
+            self._push(x)
+
+    def window(self) -> List[float]:
+        """
+        The values in insertion order.
+        """
+        return [
+            self.values[(self.start + i) % self.capacity] for i in range(self.count)
+        ]
+
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "values": self.window(),
+            "mean": self.mean,
+            "m2": self.m2,
+        }
+
+    def restore(self, data: dict):
+        """
+        Replace the window by a snapshot's, keeping its latest `capacity`
+        values. Aggregates are reused when the capacity did not change.
+        """
+        values = data["values"][-self.capacity :]
+        self.start, self.count, self.mean, self.m2 = 0, 0, 0.0, 0.0
+        self._evictions = 0
+        for i, x in enumerate(values):
+            self.values[i] = x
+        if data["capacity"] == self.capacity:
+            self.count, self.mean, self.m2 = len(values), data["mean"], data["m2"]
+        else:
+            for x in values:
+                self._push(x)
+
+
 class NormalDistributionFilter(AbstractFilter):
+    """
+    Keeps the items scoring above `threshold` in the normal distribution of
+    the last `capacity` scores.
+
+    The distribution is queried once per call for the score at `threshold`,
+    so filtering a batch is one comparison per item whatever the capacity.
+    """
+
     def __init__(self, capacity: int = 100, threshold: float = 0.5) -> None:
-        self.q: PriorityQueue = PriorityQueue(maxsize=capacity)
+        self.stats = RunningStats(capacity)
         self.threshold = threshold
+        self._lock = threading.Lock()
 
     def add(self, item: ScoreableItem):
-        if self.q.full():
-            self.q.get()
-        self.q.put((item.time.timestamp(), item))
+        with self._lock:
+            self.stats.add(item.score)
 
     def set_threshold(self, threshold: float):
         self.threshold = threshold
 
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"version": SNAPSHOT_VERSION, "stats": self.stats.snapshot()}
+
+    def restore(self, data: dict) -> bool:
+        if data.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Ignore filter snapshot version {data.get('version')}")
+            return False
+        with self._lock:
+            self.stats.restore(data["stats"])
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.stats = RunningStats(self.stats.capacity)
+
+    def cutoff(self) -> float:
+        """
+        The score whose CDF is `threshold`, the variance is used as sigma.
+        """
+        if self.threshold <= 0:
+            return float("-inf")
+        elif self.threshold >= 1:
+            return float("inf")
+        sigma = self.stats.variance()
+        if sigma == 0:
+            return self.stats.mean
+        return NormalDist(mu=self.stats.mean, sigma=sigma).inv_cdf(self.threshold)
+
     def __call__(self, items: List[ScoreableItem]) -> List[ScoreableItem]:
-        for item in items:
-            self.add(item)
+        with self._lock:
+            for item in items:
+                self.stats.add(item.score)
 
-        logger.info(f"Filter queue has {len(self.q.queue)} data")
+            logger.info(f"Filter window has {len(self.stats)} data")
 
-        nums = [item.score for _, item in self.q.queue]
+            if len(self.stats) < 2:
+                return items
+            cutoff = self.cutoff()
+        return [item for item in items if item.score > cutoff]
 
-        try:
-            rv = NormalDist(mu=mean(nums), sigma=variance(nums))
-        except StatisticsError:
-            return items
-        else:
-            threshold_func: Callable[[ScoreableItem], bool] = (
-                lambda item: rv.cdf(item.score) > self.threshold
-            )
-            return list(filter(threshold_func, items))
 
+class VelocityFilter(AbstractFilter):
+    """
+    Keeps the items gaining at least `min_velocity` points per hour.
+
+    Every call records the items' scores in `store`, so the publish cycles
+    build the time series without extra API calls.
+    """
+
+    def __init__(
+        self,
+        store: Optional[series.ScoreSeriesStore] = None,
+        min_velocity: float = 10.0,
+    ) -> None:
+        self.store = store if store is not None else series.ScoreSeriesStore()
+        self.min_velocity = min_velocity
 
-norm_filter = NormalDistributionFilter()
+    def __call__(self, items: List[ScoreableItem]) -> List[ScoreableItem]:
+        now = time.time()
+        self.store.record(items, now)
+        return [
+            item
+            for item in items
+            if self.store.velocity(item, now) >= self.min_velocity
+        ]
+
+
+norm_filters: Dict[Topic, NormalDistributionFilter] = {
+    topic: NormalDistributionFilter() for topic in Topic
+}
+
+
+def save_filters(
+    store: snapshots.ISnapshotStore,
+    topic_filters: Dict[Topic, NormalDistributionFilter],
+):
+    for topic, topic_filter in topic_filters.items():
+        store.save(f"{topic.value}:norm_filter", topic_filter.snapshot())
+
+
+def restore_filters(
+    store: snapshots.ISnapshotStore,
+    topic_filters: Dict[Topic, NormalDistributionFilter],
+):
+    for topic, topic_filter in topic_filters.items():
+        data = store.load(f"{topic.value}:norm_filter")
+        if data is not None and topic_filter.restore(data):
+            logger.info(
+                f"Restored {topic.name} filter with {len(topic_filter.stats)} data"
+            )
@@ -1,7 +1,11 @@
+import html
+import re
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import List, Optional, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 from pydantic import BaseModel, HttpUrl
 
@@ -103,6 +107,170 @@ class ItemFactory:
             raise ObjectNotDefinedError(f"{data}")
 
 
+class ItemRecord:
+    """
+    An item decoded up to its id, type, time, score and comment count, the
+    fields publishing selects on. Other attributes come from the full model,
+    validated on first access.
+    """
+
+    __slots__ = ("id", "type", "time", "score", "descendants", "_data", "_model")
+
+    def __init__(self, data: dict) -> None:
+        self.id: int = data["id"]
+        self.type = Type(data["type"])
+        self.time = datetime.fromtimestamp(data["time"], tz=timezone.utc)
+        if (score := data.get("score")) is not None:
+            self.score: int = score
+        if (descendants := data.get("descendants")) is not None:
+            self.descendants: int = descendants
+        self._data = data
+        self._model: Optional[Item] = None
+
+    def model(self) -> Item:
+        if self._model is None:
+            self._model = _item_factory.from_dict(self._data)
+        return self._model
+
+    def __getattr__(self, name: str):
+        # Decoded fields missing from the payload are absent, not validated.
+        if name.startswith("_") or name in self.__slots__:
+            raise AttributeError(name)
+        return getattr(self.model(), name)
+
+    def __gt__(self, other: "ItemRecord"):
+        return self.time > other.time
+
+    def __repr__(self) -> str:
+        return f"ItemRecord(id={self.id}, type={self.type.value})"
+
+
+class LazyItemFactory(ItemFactory):
+    """
+    Builds `ItemRecord`s, deleted and dead items are still validated at once.
+    """
+
+    def from_dict(self, data: dict) -> Union[ItemRecord, DeletedItem, DeadItem]:
+        if data.get("deleted") or data.get("dead"):
+            return super().from_dict(data)
+        try:
+            return ItemRecord(data)
+        except ValueError:
+            raise ObjectNotDefinedError(f"{data}")
+
+
+_item_factory = ItemFactory()
+
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit for a text message.
+
+_HTML_TOKEN = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+
+
+def _closing_tags(open_tags: List[str]) -> str:
+    return "".join(f"</{tag}>" for tag in reversed(open_tags))
+
+
+def truncate_html(text: str, limit: int) -> str:
+    """
+    Cut HTML `text` to at most `limit` characters, between tags and entities,
+    ending it with an ellipsis and closing the tags left open.
+    """
+    if len(text) <= limit:
+        return text
+    cut = ""
+    open_tags: List[str] = []
+    for token in _HTML_TOKEN.findall(text):
+        if (tag := re.match(r"<(/?)(\w+)", token)) is not None:
+            closing, name = tag.groups()
+            if closing and name in open_tags:
+                tags = open_tags[: len(open_tags) - open_tags[::-1].index(name) - 1]
+            else:
+                tags = open_tags + [name]
+            if len(cut) + len(token) + 1 + len(_closing_tags(tags)) > limit:
+                break
+            cut += token
+            open_tags = tags
+            continue
+        room = limit - len(cut) - 1 - len(_closing_tags(open_tags))
+        if token.startswith("&") and len(token) > 1:
+            if len(token) > room:
+                break
+            cut += token
+        elif len(token) > room:
+            cut += token[: max(room, 0)]
+            break
+        else:
+            cut += token
+    return cut + "…" + _closing_tags(open_tags)
+
+
+def split_messages(texts: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Join HTML texts into as few messages as possible, each at most `limit`
+    long. Longer texts are cut with `truncate_html`.
+    """
+    messages: List[str] = []
+    current = ""
+    for text in texts:
+        text = truncate_html(text, limit)
+        if current and len(current) + 1 + len(text) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{text}" if current else text
+    if current:
+        messages.append(current)
+    return messages
+
+
+def comment_snippet(comment: Comment, limit: int = 160) -> str:
+    """
+    The comment's text as escaped plain text, cut to `limit` characters.
+    """
+    text = re.sub(r"<p>", " ", comment.text)
+    text = " ".join(html.unescape(re.sub(r"<[^>]+>", "", text)).split())
+    if len(text) > limit:
+        text = text[: limit - 1].rstrip() + "…"
+    return html.escape(text, quote=False)
+
+
+class CommentPreviews:
+    """
+    The top comments shown under stories, by story id, with the story's
+    comment count when they were crawled.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max_size
+        self._previews: OrderedDict[int, Tuple[int, List[Comment]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id: int) -> List[Comment]:
+        with self._lock:
+            if (preview := self._previews.get(id)) is None:
+                return []
+            self._previews.move_to_end(id)
+            return preview[1]
+
+    def set(self, id: int, descendants: int, comments: List[Comment]):
+        with self._lock:
+            self._previews[id] = (descendants, comments)
+            self._previews.move_to_end(id)
+            while len(self._previews) > self.max_size:
+                self._previews.popitem(last=False)
+
+    def fresh(self, id: int, descendants: int) -> bool:
+        """
+        Whether the story's preview was crawled at its current comment count.
+        """
+        with self._lock:
+            preview = self._previews.get(id)
+        return preview is not None and preview[0] == descendants
+
+
+comment_previews = CommentPreviews()
+
+
 class PublishedItems:
     def __init__(self, items: List[Item]) -> None:
         self.items = sorted(items, key=lambda items: items.time)
@@ -131,6 +299,9 @@ class StoryDisplay(ItemDisplay):
         self.item = item
 
     def __str__(self) -> str:
+        return self.render()
+
+    def render(self, now: Optional[datetime] = None) -> str:
         points = self.item.score
         title = self.item.title
         url = self.url()
@@ -138,12 +309,17 @@ class StoryDisplay(ItemDisplay):
         topic = self.topic()
 
         fixed_width_text = (
-            f"{points} points | {num_comments} comments | {topic} | {self.time_age()}"
+            f"{points} points | {num_comments} comments | {topic} | "
+            f"{self.time_age(now)}"
         )
         text = (
             f'<a href="{url}"><b>{title}</b></a>\n'
             f'<a href="{self.hn_url()}">{fixed_width_text}</a>\n'
         )
+        for comment in comment_previews.get(self.item.id):
+            if comment.by:
+                by = html.escape(comment.by)
+                text += f"<i>{by}</i>: {comment_snippet(comment)}\n"
         return text
 
     def url(self) -> str:
@@ -161,8 +337,8 @@ class StoryDisplay(ItemDisplay):
         else:
             return 0
 
-    def time_age(self) -> str:
-        time_ago = datetime.now(tz=timezone.utc) - self.item.time
+    def time_age(self, now: Optional[datetime] = None) -> str:
+        time_ago = (now or datetime.now(tz=timezone.utc)) - self.item.time
         hours = time_ago.seconds // 3600
         if time_ago.days > 1:
             return f"{time_ago.days} days ago"
@@ -183,3 +359,66 @@ class TopStoryDisplay(StoryDisplay):
 class BestStoryDisplay(StoryDisplay):
     def topic(self) -> str:
         return "Best"
+
+
+class NewStoryDisplay(StoryDisplay):
+    def topic(self) -> str:
+        return "New"
+
+
+class DisplayCache:
+    """
+    Rendered display texts, shared by every handler and subscriber.
+
+    Texts are keyed by what they show, the displayed age is bucketed by hour,
+    so a story keeps the same text until its score, comments or age change.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._texts: OrderedDict[Tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(
+        self,
+        display_class: Callable[[Union[Story, Job, Poll]], StoryDisplay],
+        item: Union[Story, Job, Poll],
+        now: Optional[datetime] = None,
+    ) -> str:
+        display = display_class(item)
+        now = now or datetime.now(tz=timezone.utc)
+        key = (
+            display_class,
+            item.id,
+            item.score,
+            item.title,
+            display.num_comments(),
+            display.time_age(now),
+            tuple(comment.id for comment in comment_previews.get(item.id)),
+        )
+        with self._lock:
+            if (text := self._texts.get(key)) is not None:
+                self.hits += 1
+                self._texts.move_to_end(key)
+                return text
+            self.misses += 1
+
+        text = display.render(now)
+        with self._lock:
+            self._texts[key] = text
+            while len(self._texts) > self.max_size:
+                self._texts.popitem(last=False)
+        return text
+
+    def render_many(
+        self,
+        display_class: Callable[[Union[Story, Job, Poll]], StoryDisplay],
+        items: List[Union[Story, Job, Poll]],
+    ) -> List[str]:
+        now = datetime.now(tz=timezone.utc)
+        return [self.render(display_class, item, now) for item in items]
+
+
+display_cache = DisplayCache()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class EventLoopThread:
+    """
+    A long-lived event loop running in a daemon thread.
+
+    Scheduled jobs run on their own worker threads, they hand coroutines over
+    with `run` so every job shares the same loop and the clients bound to it.
+    """
+
+    def __init__(self, name: str = "hnread-event-loop") -> None:
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self) -> EventLoopThread:
+        if not self.is_running():
+            self._thread.start()
+        return self
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        if not self.is_running():
+            raise RuntimeError("Event loop thread is not running")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        logger.info("Event loop thread stopped")
+
+    def __enter__(self) -> EventLoopThread:
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
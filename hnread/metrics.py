@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import redis
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class IMetricsSink(ABC):
+    @abstractmethod
+    def increment(self, name: str, value: float = 1.0, **labels: str):
+        pass
+
+    @abstractmethod
+    def set_gauge(self, name: str, value: float, **labels: str):
+        pass
+
+    @abstractmethod
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+
+class NullSink(IMetricsSink):
+    def increment(self, name: str, value: float = 1.0, **labels: str):
+        pass
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        pass
+
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class PrometheusSink(IMetricsSink):
+    """
+    Keeps counters, gauges and histograms in memory and renders them in the
+    Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1.0, **labels: str):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self.gauges.setdefault(name, {})[tuple(labels.items())] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if (histogram := series.get(key)) is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in histograms.items():
+                    cumulative = 0
+                    for bucket, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = _format_labels(labels, (("le", f"{bucket}"),))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    le = _format_labels(labels, (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{le} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+sink: IMetricsSink = NullSink()
+
+
+def set_sink(new_sink: IMetricsSink):
+    global sink
+    sink = new_sink
+
+
+def increment(name: str, value: float = 1.0, **labels: str):
+    sink.increment(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels: str):
+    sink.set_gauge(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels: str):
+    sink.observe(name, value, **labels)
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """
+    Observe the seconds spent in the block.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink.observe(name, time.perf_counter() - started_at, **labels)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Counts and times every command, pipelines count as one "PIPELINE" op.
+    """
+
+    def execute_command(self, *args, **options):
+        with timer("hnread_redis_op_seconds", command=str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with timer("hnread_redis_op_seconds", command="PIPELINE"):
+            return super().execute(raise_on_error)
+
+
+class MetricsServer:
+    """
+    Serves the sink's text exposition at /metrics from a daemon thread.
+    """
+
+    def __init__(self, sink: PrometheusSink, host: str = "", port: int = 9100) -> None:
+        self.sink = sink
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler_class(self):
+        metrics_sink = self.sink
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics_sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
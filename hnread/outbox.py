@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import json
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple, Type
+
+import redis
+
+from . import delivery, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Delivery jobs in a Redis Stream, drained by a consumer group.
+
+    A job is acknowledged once sent. Failed jobs stay pending and are
+    claimed again after `min_idle` seconds, like the jobs of a crashed
+    consumer, and move to the dead letter stream after `max_attempts`.
+    Entries that cannot be decoded are dead lettered as they are read.
+    """
+
+    def __init__(
+        self,
+        r: redis.Redis,
+        stream: str = "outbox",
+        group: str = "delivery",
+        max_len: int = 100000,
+        min_idle: float = 60.0,
+        max_attempts: int = 5,
+    ) -> None:
+        self.r = r
+        self.stream = stream
+        self.group = group
+        self.max_len = max_len
+        self.min_idle = min_idle
+        self.max_attempts = max_attempts
+
+    @property
+    def _attempts_key(self) -> str:
+        return f"{self.stream}:attempts"
+
+    @property
+    def dead_letter_stream(self) -> str:
+        return f"{self.stream}:dead"
+
+    def create_group(self):
+        try:
+            self.r.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def enqueue(self, messages: List[delivery.Message], topic: str = ""):
+        """
+        Add the messages as jobs in one transaction, all or none of them.
+        """
+        with self.r.pipeline() as pipe:
+            for message in messages:
+                pipe.xadd(
+                    self.stream,
+                    {
+                        "chat_id": message.chat_id,
+                        "text": message.text,
+                        "kwargs": json.dumps(message.kwargs),
+                        "topic": topic,
+                    },
+                    maxlen=self.max_len,
+                    approximate=True,
+                )
+            pipe.execute()
+        metrics.increment("hnread_outbox_enqueued_total", len(messages), topic=topic)
+
+    def _decode(self, entries: list) -> List[Tuple[str, delivery.Message, str]]:
+        jobs = []
+        trimmed_ids = []
+        for entry_id, fields in entries:
+            if not fields:
+                trimmed_ids.append(entry_id.decode())
+                continue
+            try:
+                jobs.append(
+                    (
+                        entry_id.decode(),
+                        delivery.Message(
+                            int(fields[b"chat_id"]),
+                            fields[b"text"].decode(),
+                            **json.loads(fields[b"kwargs"]),
+                        ),
+                        fields[b"topic"].decode(),
+                    )
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Dead letter malformed job {entry_id!r}: {e!r}")
+                self.r.xadd(
+                    self.dead_letter_stream,
+                    {**fields, b"id": entry_id},
+                    maxlen=self.max_len,
+                    approximate=True,
+                )
+                trimmed_ids.append(entry_id.decode())
+                metrics.increment("hnread_outbox_dead_lettered_total")
+        self.ack(trimmed_ids)
+        return jobs
+
+    def read(
+        self, consumer: str, count: int = 100, block: Optional[float] = None
+    ) -> List[Tuple[str, delivery.Message, str]]:
+        """
+        Up to `count` (entry id, message, topic) jobs, the stale pending jobs
+        first.
+        """
+        _, entries, *_ = self.r.xautoclaim(
+            self.stream,
+            self.group,
+            consumer,
+            int(self.min_idle * 1000),
+            count=count,
+        )
+        if entries:
+            metrics.increment("hnread_outbox_reclaimed_total", len(entries))
+            return self._decode(entries)
+
+        res = self.r.xreadgroup(
+            self.group,
+            consumer,
+            {self.stream: ">"},
+            count=count,
+            block=int(block * 1000) if block else None,
+        )
+        return self._decode(res[0][1]) if res else []
+
+    def ack(self, entry_ids: List[str]):
+        if not entry_ids:
+            return
+        with self.r.pipeline() as pipe:
+            pipe.xack(self.stream, self.group, *entry_ids)
+            pipe.xdel(self.stream, *entry_ids)
+            pipe.hdel(self._attempts_key, *entry_ids)
+            pipe.execute()
+
+    def fail(self, jobs: List[Tuple[str, delivery.Message, str]]) -> int:
+        """
+        Count an attempt for each job, dead letter those out of attempts.
+        """
+        if not jobs:
+            return 0
+        with self.r.pipeline(transaction=False) as pipe:
+            for entry_id, _, _ in jobs:
+                pipe.hincrby(self._attempts_key, entry_id, 1)
+            attempts = pipe.execute()
+
+        return self.dead_letter(
+            [job for job, n in zip(jobs, attempts) if n >= self.max_attempts]
+        )
+
+    def dead_letter(self, dead_jobs: List[Tuple[str, delivery.Message, str]]) -> int:
+        if dead_jobs:
+            with self.r.pipeline() as pipe:
+                for entry_id, message, topic in dead_jobs:
+                    pipe.xadd(
+                        self.dead_letter_stream,
+                        {
+                            "id": entry_id,
+                            "chat_id": message.chat_id,
+                            "text": message.text,
+                            "kwargs": json.dumps(message.kwargs),
+                            "topic": topic,
+                        },
+                        maxlen=self.max_len,
+                        approximate=True,
+                    )
+                pipe.execute()
+            self.ack([entry_id for entry_id, _, _ in dead_jobs])
+            logger.warning(f"Dead lettered {len(dead_jobs)} delivery jobs")
+            metrics.increment("hnread_outbox_dead_lettered_total", len(dead_jobs))
+        return len(dead_jobs)
+
+    def backlog(self) -> Dict[str, int]:
+        """
+        Jobs not yet read by the group (lag), read but not acknowledged
+        (pending) and dead lettered (dead).
+        """
+        with self.r.pipeline(transaction=False) as pipe:
+            pipe.xlen(self.stream)
+            pipe.xpending(self.stream, self.group)
+            pipe.xlen(self.dead_letter_stream)
+            length, pending, dead = pipe.execute()
+        # Acknowledged jobs are deleted, the stream holds the lag and pending.
+        return {
+            "lag": length - pending["pending"],
+            "pending": pending["pending"],
+            "dead": dead,
+        }
+
+
+class OutboxWorker:
+    """
+    Drains an outbox through a delivery engine from a thread.
+
+    Jobs failing with one of `permanent_errors`, like a chat that blocked
+    the bot, are dead lettered without further attempts.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        engine: delivery.DeliveryEngine,
+        consumer: str,
+        batch_size: int = 100,
+        block: float = 1.0,
+        permanent_errors: Tuple[Type[Exception], ...] = (),
+    ) -> None:
+        self.outbox = outbox
+        self.permanent_errors = permanent_errors
+        self.engine = engine
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block = block
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        """
+        Deliver one batch, return the number of jobs read.
+        """
+        jobs = self.outbox.read(self.consumer, self.batch_size, self.block)
+        if not jobs:
+            return 0
+
+        report = self.engine.deliver([message for _, message, _ in jobs])
+        errors = {
+            id(message): error for message, error in zip(report.failures, report.errors)
+        }
+        sent_jobs, failed_jobs, dead_jobs = [], [], []
+        for job in jobs:
+            if id(job[1]) not in errors:
+                sent_jobs.append(job)
+            elif isinstance(errors[id(job[1])], self.permanent_errors):
+                dead_jobs.append(job)
+            else:
+                failed_jobs.append(job)
+        self.outbox.ack([entry_id for entry_id, _, _ in sent_jobs])
+        self.outbox.fail(failed_jobs)
+        self.outbox.dead_letter(dead_jobs)
+
+        for status, status_jobs in [
+            ("sent", sent_jobs),
+            ("failed", failed_jobs + dead_jobs),
+        ]:
+            for _, _, topic in status_jobs:
+                metrics.increment("hnread_messages_total", topic=topic, status=status)
+        backlog = self.outbox.backlog()
+        metrics.set_gauge("hnread_outbox_lag", backlog["lag"])
+        metrics.set_gauge("hnread_outbox_pending", backlog["pending"])
+        metrics.set_gauge("hnread_outbox_dead", backlog["dead"])
+        return len(jobs)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Failed to drain the outbox")
+                metrics.increment("hnread_outbox_errors_total")
+                self._stop.wait(self.block)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name=f"outbox-{self.consumer}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -1,61 +1,451 @@
 from __future__ import annotations
 
 import asyncio
+import copy
+import logging
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import deque
 from itertools import compress
-from typing import List, Tuple
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
 
 import httpx
 import redis
 from pydantic import BaseModel
 
-from . import items
+from . import caches, items, metrics, streams
 from .topics import Topic
 
+logger = logging.getLogger(__name__)
+
+
+class _LoopState:
+    """
+    Async clients, semaphores and futures are bound to an event loop, one
+    state is kept per loop that uses a HNRepository.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore) -> None:
+        self.client = client
+        self.semaphore = semaphore
+        self.in_flight: Dict[int, asyncio.Future] = {}
+        self.snapshots: Dict[Tuple[str, ...], asyncio.Future] = {}
+        self.lists: Dict[str, asyncio.Future] = {}
+
+
+class ListSnapshot:
+    """
+    List resources fetched together for a publish cycle.
+
+    Items are resolved through `afetch` at most once per snapshot, whatever
+    the number of topics reading them.
+    """
+
+    def __init__(
+        self,
+        lists: Dict[str, List[int]],
+        afetch: Callable[..., Awaitable[List[items.Item]]],
+    ) -> None:
+        self.lists = lists
+        self.afetch = afetch
+        self.taken_at = time.monotonic()
+        self.items: Dict[int, items.Item] = {}
+        self._lock = asyncio.Lock()
+
+    def ids(self, resource_name: str) -> List[int]:
+        return self.lists[resource_name]
+
+    async def aresolve(self, ids: Iterable[int]) -> List[items.Item]:
+        """
+        The items of `ids`, missing items are skipped.
+        """
+        ids = list(ids)
+        async with self._lock:
+            missing_ids = [id for id in ids if id not in self.items]
+            if missing_ids:
+                for item in await self.afetch(*missing_ids):
+                    self.items[item.id] = item
+        return [self.items[id] for id in ids if id in self.items]
+
 
 class HNRepository:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 20,
+        max_in_flight: int = 20,
+        timeout: float = 10.0,
+        transport: Optional[Any] = None,
+        cache: Optional[caches.ItemCache] = None,
+        stream_read_timeout: float = 90.0,
+        item_factory: Optional[items.ItemFactory] = None,
+        base_url: Optional[str] = None,
+    ) -> None:
         self.domain = "hacker-news.firebaseio.com"
-        self.base_url = f"https://{self.domain}/v0"
-        self.item_factory = items.ItemFactory()
+        self.base_url = (
+            base_url if base_url is not None else f"https://{self.domain}/v0"
+        )
+        self.item_factory = (
+            item_factory if item_factory is not None else items.ItemFactory()
+        )
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.timeout = httpx.Timeout(timeout)
+        self.max_in_flight = max_in_flight
+        self.transport = transport
+        self.cache = cache
+        self.stream_read_timeout = stream_read_timeout
+        self._client: Optional[httpx.Client] = None
+        self.streams: Dict[str, streams.ListStream] = {}
+        self._stream_tasks: List[asyncio.Task] = []
+        self._loop_states: WeakKeyDictionary[
+            asyncio.AbstractEventLoop, _LoopState
+        ] = WeakKeyDictionary()
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(
+                limits=self.limits, timeout=self.timeout, transport=self.transport
+            )
+        return self._client
+
+    def _loop_state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        if loop not in self._loop_states:
+            self._loop_states[loop] = _LoopState(
+                httpx.AsyncClient(
+                    limits=self.limits, timeout=self.timeout, transport=self.transport
+                ),
+                asyncio.Semaphore(self.max_in_flight),
+            )
+        return self._loop_states[loop]
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        return self._loop_state().client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        await self.astop_streaming()
+        loop = asyncio.get_running_loop()
+        if loop in self._loop_states:
+            await self._loop_states.pop(loop).client.aclose()
+
+    def __enter__(self) -> HNRepository:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self) -> HNRepository:
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
     def _get_resource(self, resource_name: str) -> httpx.Response:
-        return httpx.get(f"{self.base_url}/{resource_name}.json")
+        endpoint = resource_name.split("/")[0]
+        with metrics.timer("hnread_hn_request_seconds", endpoint=endpoint):
+            resp = self.client.get(f"{self.base_url}/{resource_name}.json")
+        metrics.increment(
+            "hnread_hn_responses_total", endpoint=endpoint, status=f"{resp.status_code}"
+        )
+        return resp
 
     async def _aget_resource(self, resource_name: str) -> httpx.Response:
-        async with httpx.AsyncClient() as client:
-            return await client.get(f"{self.base_url}/{resource_name}.json")
+        endpoint = resource_name.split("/")[0]
+        state = self._loop_state()
+        async with state.semaphore:
+            with metrics.timer("hnread_hn_request_seconds", endpoint=endpoint):
+                resp = await state.client.get(f"{self.base_url}/{resource_name}.json")
+        metrics.increment(
+            "hnread_hn_responses_total", endpoint=endpoint, status=f"{resp.status_code}"
+        )
+        return resp
+
+    async def astream(
+        self, resource_name: str
+    ) -> AsyncIterator[streams.ServerSentEvent]:
+        """
+        Server-sent events of a resource from the Firebase streaming API.
+        """
+        client = self._loop_state().client
+        async with client.stream(
+            "GET",
+            f"{self.base_url}/{resource_name}.json",
+            headers={"Accept": "text/event-stream"},
+            timeout=httpx.Timeout(self.timeout.connect, read=self.stream_read_timeout),
+            follow_redirects=True,
+        ) as resp:
+            resp.raise_for_status()
+            async for event in streams.aiter_sse(resp.aiter_lines()):
+                yield event
+
+    async def astart_streaming(self, *resource_names: str):
+        """
+        Keep live snapshots of list resources, list fetches of a streamed
+        resource are then answered from its snapshot once it has one.
+        """
+        for resource_name in resource_names:
+            if resource_name in self.streams:
+                continue
+            stream = streams.ListStream(resource_name, self.astream)
+            self.streams[resource_name] = stream
+            self._stream_tasks.append(asyncio.ensure_future(stream.run()))
+
+    async def astop_streaming(self):
+        for task in self._stream_tasks:
+            task.cancel()
+        await asyncio.gather(*self._stream_tasks, return_exceptions=True)
+        self._stream_tasks = []
+        self.streams = {}
+
+    async def _afetch_ids(self, resource_name: str) -> Tuple[float, List[int]]:
+        return time.monotonic(), await self._aget_ids(resource_name)
+
+    async def _ashared_ids(self, resource_name: str, max_age: float) -> List[int]:
+        """
+        The ids of a list resource, shared with the callers fetching it or
+        having fetched it less than `max_age` seconds ago.
+        """
+        lists = self._loop_state().lists
+        future = lists.get(resource_name)
+        if (
+            future is None
+            or future.cancelled()
+            or (
+                future.done()
+                and (
+                    future.exception() is not None
+                    or time.monotonic() - future.result()[0] >= max_age
+                )
+            )
+        ):
+            future = asyncio.ensure_future(self._afetch_ids(resource_name))
+            lists[resource_name] = future
+        return (await asyncio.shield(future))[1]
+
+    async def _atake_snapshot(
+        self,
+        resource_names: Tuple[str, ...],
+        afetch: Callable[..., Awaitable[List[items.Item]]],
+        max_age: float,
+    ) -> ListSnapshot:
+        lists = await asyncio.gather(
+            *[self._ashared_ids(name, max_age) for name in resource_names]
+        )
+        return ListSnapshot(dict(zip(resource_names, lists)), afetch)
+
+    async def asnapshot(
+        self,
+        *resource_names: str,
+        afetch: Optional[Callable[..., Awaitable[List[items.Item]]]] = None,
+        max_age: float = 0.0,
+    ) -> ListSnapshot:
+        """
+        Fetch list resources concurrently, items are fetched with `afetch`,
+        `aofIds` by default.
+
+        Callers asking for the same resources share the snapshot being taken,
+        or the last one if taken less than `max_age` seconds ago. Snapshots of
+        other resources share the lists they have in common the same way.
+        """
+        key = tuple(sorted(resource_names))
+        snapshots = self._loop_state().snapshots
+        future = snapshots.get(key)
+        if (
+            future is None
+            or future.cancelled()
+            or (
+                future.done()
+                and (
+                    future.exception() is not None
+                    or time.monotonic() - future.result().taken_at >= max_age
+                )
+            )
+        ):
+            future = asyncio.ensure_future(
+                self._atake_snapshot(key, afetch or self.aofIds, max_age)
+            )
+            snapshots[key] = future
+        return await asyncio.shield(future)
+
+    async def _aget_ids(self, resource_name: str) -> List[int]:
+        stream = self.streams.get(resource_name)
+        if stream is not None and stream.ids is not None:
+            return list(stream.ids)
+        return (await self._aget_resource(resource_name)).json()
+
+    @staticmethod
+    def _item_json(resp: httpx.Response) -> Optional[dict]:
+        resp.raise_for_status()
+        return resp.json()
+
+    def _cacheable(self, data: Optional[dict]) -> bool:
+        """
+        Whether `data` is an item to cache, not null or an error body.
+        """
+        return self.cache is not None and isinstance(data, dict) and "id" in data
+
+    def item_payload(self, id: int) -> dict:
+        if self.cache is not None and (data := self.cache.get(id)) is not None:
+            return data
+        data = self._item_json(self._get_resource(f"item/{id}"))
+        if self._cacheable(data):
+            self.cache.set(id, data)
+        return data
+
+    async def _acache(self, f: Callable[..., Any], *args: Any) -> Any:
+        """
+        Call a cache method, in the loop's executor when the cache does I/O.
+        """
+        if not self.cache.blocking:
+            return f(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+    async def _afetch_item_payload(self, id: int) -> dict:
+        data = self._item_json(await self._aget_resource(f"item/{id}"))
+        if self._cacheable(data):
+            await self._acache(self.cache.set, id, data)
+        return data
+
+    async def aitem_payload(self, id: int, refresh: bool = False) -> dict:
+        """
+        Concurrent requests for the same id share a single HTTP request,
+        `refresh` skips the cache lookup.
+        """
+        if (
+            not refresh
+            and self.cache is not None
+            and (data := await self._acache(self.cache.get, id)) is not None
+        ):
+            return data
+
+        in_flight = self._loop_state().in_flight
+        if (future := in_flight.get(id)) is None:
+            future = asyncio.ensure_future(self._afetch_item_payload(id))
+            in_flight[id] = future
+            future.add_done_callback(lambda _: in_flight.pop(id, None))
+        return await asyncio.shield(future)
 
     def ofId(self, id: int) -> items.Item:
-        resp = self._get_resource(f"item/{id}")
-        item = self.item_factory.from_dict(resp.json())
+        item = self.item_factory.from_dict(self.item_payload(id))
         return item
 
     async def aofId(self, id: int) -> items.Item:
-        resp = await self._aget_resource(f"item/{id}")
-        item = self.item_factory.from_dict(resp.json())
+        item = self.item_factory.from_dict(await self.aitem_payload(id))
         return item
 
-    def ofIds(self, *ids: int, sort: bool = False) -> List[items.Item]:
-        tasks = [self.aofId(i) for i in ids]
-
-        async def f():
-            return await asyncio.gather(*tasks)
-
-        items = asyncio.run(f())
+    async def aofIds(self, *ids: int, sort: bool = False) -> List[items.Item]:
+        items = await asyncio.gather(*[self.aofId(i) for i in ids])
 
         if sort:
             items = sorted(items, key=lambda items: items.time)
         return items
 
+    def ofIds(self, *ids: int, sort: bool = False) -> List[items.Item]:
+        async def f():
+            try:
+                return await self.aofIds(*ids, sort=sort)
+            finally:
+                await self.aclose()
+
+        return asyncio.run(f())
+
+    async def acomment_trees(
+        self,
+        kids: Dict[int, List[int]],
+        max_depth: int = 1,
+        max_fanout: int = 3,
+        max_concurrency: int = 5,
+        deadline: float = 2.0,
+    ) -> Dict[int, List[items.Comment]]:
+        """
+        The comments under each item of `kids`, walked breadth first in ranked
+        order from the item's kid ids.
+
+        Only the first `max_fanout` kids of an item are followed, down to
+        `max_depth` levels, so a walk fetches a bounded number of comments
+        whatever the thread size. Comments come from the item cache when
+        they can, at most `max_concurrency` are fetched at once. Levels not
+        completed within `deadline` seconds are left out.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        trees: Dict[int, List[items.Comment]] = {id: [] for id in kids}
+
+        async def afetch(id: int) -> Optional[dict]:
+            async with semaphore:
+                return await self.aitem_payload(id)
+
+        async def acrawl():
+            level = [
+                (root, kid)
+                for root, root_kids in kids.items()
+                for kid in root_kids[:max_fanout]
+            ]
+            for depth in range(1, max_depth + 1):
+                if not level:
+                    break
+                payloads = await asyncio.gather(
+                    *[afetch(id) for _, id in level], return_exceptions=True
+                )
+                next_level = []
+                for (root, _), data in zip(level, payloads):
+                    if not isinstance(data, dict) or data.get("deleted"):
+                        continue
+                    if data.get("dead") or data.get("type") != "comment":
+                        continue
+                    if "text" not in data:
+                        continue
+                    trees[root].append(items.Comment(**data))
+                    if depth < max_depth:
+                        next_kids = data.get("kids", [])[:max_fanout]
+                        next_level.extend((root, kid) for kid in next_kids)
+                level = next_level
+
+        try:
+            await asyncio.wait_for(acrawl(), deadline)
+        except asyncio.TimeoutError:
+            logger.info(f"Comment crawl of {len(kids)} items hit its deadline")
+            metrics.increment("hnread_comment_crawl_timeouts_total")
+        return trees
+
     def max_id(self) -> int:
         resp = self._get_resource("maxitem")
         return int(resp.text)
 
+    async def amax_id(self) -> int:
+        resp = await self._aget_resource("maxitem")
+        return int(resp.text)
+
     def beststories_id(self) -> List[int]:
         """ """
         return self._get_resource("beststories").json()
 
+    async def abeststories_id(self) -> List[int]:
+        return await self._aget_ids("beststories")
+
     def topstories_id(self) -> List[int]:
         """
         Up to 500 top and new stories
@@ -65,10 +455,19 @@ class HNRepository:
         real_topstories = list(set(topstories) - set(newstories))
         return real_topstories
 
+    async def atopstories_id(self) -> List[int]:
+        topstories, newstories = await asyncio.gather(
+            self._aget_ids("topstories"), self.anewstories_id()
+        )
+        return list(set(topstories) - set(newstories))
+
     def newstories_id(self) -> List[int]:
         """ """
         return self._get_resource("newstories").json()
 
+    async def anewstories_id(self) -> List[int]:
+        return await self._aget_ids("newstories")
+
     def askstories_id(self) -> List[int]:
         """
         Up to 200 of the latest Ask HN Stories
@@ -87,13 +486,16 @@ class HNRepository:
         """
         return self._get_resource("jobstories").json()
 
-    def updates_id(self) -> Tuple[List[int], List[str]]:
+    def updates_id(self) -> Dict[str, list]:
         """
-        The item and profile changes are at
-        https://hacker-news.firebaseio.com/v0/updates.
+        The changed item ids and profile names, under "items" and "profiles",
+        from https://hacker-news.firebaseio.com/v0/updates.
         """
         return self._get_resource("updates").json()
 
+    async def aupdates_id(self) -> Dict[str, list]:
+        return (await self._aget_resource("updates")).json()
+
 
 class Subscriber(BaseModel):
     id: int
@@ -108,6 +510,13 @@ class IPubSubRepository(ABC):
     def set_topic(self, topic: Topic) -> IPubSubRepository:
         pass
 
+    @abstractmethod
+    def for_topic(self, topic: Topic) -> IPubSubRepository:
+        """
+        A view of this repository scoped to `topic`, sharing its connections.
+        """
+        pass
+
     @abstractmethod
     def get_published(self) -> List[int]:
         pass
@@ -125,7 +534,41 @@ class IPubSubRepository(ABC):
         pass
 
     @abstractmethod
-    def mark_published(self, ids: List[int]):
+    def mark_published(self, ids: List[int], times: Optional[List[float]] = None):
+        """
+        `times` are the items' unix times used for retention, default to now.
+        """
+        pass
+
+    @abstractmethod
+    def claim_unpublished(
+        self, ids: List[int], times: Optional[List[float]] = None
+    ) -> List[int]:
+        """
+        Mark ids as published, return the ones that were not published yet.
+        """
+        pass
+
+    @abstractmethod
+    def claim_and_announce(
+        self,
+        ids: List[int],
+        times: Optional[List[float]],
+        stream: str,
+        fields: Dict[str, str],
+        maxlen: int,
+    ) -> List[int]:
+        """
+        Same as `claim_unpublished`, and in the same transaction add the
+        claimed ids to `stream`, as a JSON list under "ids" next to `fields`.
+        """
+        pass
+
+    @abstractmethod
+    def delete_published_before(self, timestamp: float) -> int:
+        """
+        Forget published ids whose time is before `timestamp`, return how many.
+        """
         pass
 
     @abstractmethod
@@ -153,14 +596,114 @@ class IPubSubRepository(ABC):
         pass
 
 
+CLAIM_UNPUBLISHED_SCRIPT = """
+local claimed = {}
+for i = 1, #ARGV, 2 do
+    if redis.call('ZADD', KEYS[1], 'NX', ARGV[i + 1], ARGV[i]) == 1 then
+        table.insert(claimed, ARGV[i])
+    end
+end
+return claimed
+"""
+
+
+# Appended to claim scripts: XADD the claimed ids, as a JSON list under
+# "ids", to stream KEYS[1] capped at ARGV[1] entries, with ARGV[2] more
+# field/value pairs following in ARGV.
+ANNOUNCE_CLAIMED_LUA = """
+if #claimed > 0 then
+    local entry = {'ids', '[' .. table.concat(claimed, ',') .. ']'}
+    for i = 3, 2 + 2 * tonumber(ARGV[2]) do
+        table.insert(entry, ARGV[i])
+    end
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', unpack(entry))
+end
+return claimed
+"""
+
+# KEYS[2] is the published sorted set, (id, time) pairs follow the fields.
+CLAIM_AND_ANNOUNCE_SCRIPT = (
+    """
+local unpack = unpack or table.unpack
+local claimed = {}
+for i = 3 + 2 * tonumber(ARGV[2]), #ARGV, 2 do
+    if redis.call('ZADD', KEYS[2], 'NX', ARGV[i + 1], ARGV[i]) == 1 then
+        table.insert(claimed, ARGV[i])
+    end
+end
+"""
+    + ANNOUNCE_CLAIMED_LUA
+)
+
+# KEYS[2] is the segments index, then one segment key per id. (id, offset,
+# segment, time) tuples follow the fields.
+CLAIM_BITS_AND_ANNOUNCE_SCRIPT = (
+    """
+local unpack = unpack or table.unpack
+local claimed = {}
+local first = 3 + 2 * tonumber(ARGV[2])
+for i = first, #ARGV, 4 do
+    local key = KEYS[3 + (i - first) / 4]
+    if redis.call('SETBIT', key, ARGV[i + 1], 1) == 0 then
+        table.insert(claimed, ARGV[i])
+    end
+    redis.call('ZADD', KEYS[2], 'GT', ARGV[i + 3], ARGV[i + 2])
+end
+"""
+    + ANNOUNCE_CLAIMED_LUA
+)
+
+
+def _announce_args(fields: Dict[str, str], maxlen: int) -> List[Any]:
+    return [maxlen, len(fields), *[arg for field in fields.items() for arg in field]]
+
+
+_connection_pools: Dict[str, redis.ConnectionPool] = {}
+_connection_pools_lock = threading.Lock()
+
+
+def connection_pool(
+    url: str, max_connections: int = 50, timeout: float = 20.0
+) -> redis.ConnectionPool:
+    """
+    The process wide connection pool of a Redis url, created on first use.
+    Callers wait up to `timeout` seconds for a connection when it is exhausted.
+    """
+    with _connection_pools_lock:
+        if url not in _connection_pools:
+            _connection_pools[url] = redis.BlockingConnectionPool.from_url(
+                url, max_connections=max_connections, timeout=timeout
+            )
+        return _connection_pools[url]
+
+
 class RedisPubSubRepository(IPubSubRepository):
-    def __init__(self, url: str, topic: Topic = None) -> None:
+    def __init__(
+        self, url: str = None, topic: Topic = None, r: redis.Redis = None
+    ) -> None:
         self.topic = topic
-        self.r = redis.Redis.from_url(url)
+        self.r = (
+            r if r is not None else redis.Redis(connection_pool=connection_pool(url))
+        )
+        self._claim_unpublished = self.r.register_script(CLAIM_UNPUBLISHED_SCRIPT)
+        self._claim_and_announce = self.r.register_script(CLAIM_AND_ANNOUNCE_SCRIPT)
 
     def _published_set_key(self) -> str:
+        """
+        Legacy SET of published ids, see `migrate_published`.
+        """
         return f"{self.topic}:published"
 
+    def _published_zset_key(self) -> str:
+        return f"{self.topic}:published_at"
+
+    def _published_scores(
+        self, ids: List[int], times: Optional[List[float]]
+    ) -> Dict[int, float]:
+        if times is None:
+            times = [time.time()] * len(ids)
+        return dict(zip(ids, times))
+
     def _topic_subscribers_set_key(self) -> str:
         return f"{self.topic}:subscribers"
 
@@ -168,22 +711,57 @@ class RedisPubSubRepository(IPubSubRepository):
         return f"chat_id:{id}:subscribed:topics"
 
     def _has_published(self, ids: List[int]) -> List[bool]:
-        return self.r.smismember(self._published_set_key(), ids)
+        if not ids:
+            return []
+        scores = self.r.zmscore(self._published_zset_key(), ids)
+        return [score is not None for score in scores]
 
     def set_topic(self, topic: Topic) -> RedisPubSubRepository:
+        """
+        Prefer `for_topic`, this mutates a repository other threads may share.
+        """
         self.topic = topic
         return self
 
+    def for_topic(self, topic: Topic) -> RedisPubSubRepository:
+        view = copy.copy(self)
+        view.topic = topic
+        return view
+
     def flush(self):
         self.r.flushdb()
 
+    def migrate_published(self) -> int:
+        """
+        Move ids of the legacy published SET into the time-indexed ZSET. Their
+        item times are unknown, they are kept as if published now.
+        """
+        ids = [int(i.decode()) for i in self.r.smembers(self._published_set_key())]
+        if ids:
+            with self.r.pipeline() as pipe:
+                pipe.zadd(
+                    self._published_zset_key(),
+                    self._published_scores(ids, None),
+                    nx=True,
+                )
+                pipe.delete(self._published_set_key())
+                pipe.execute()
+        return len(ids)
+
     def get_published(self) -> List[int]:
-        return [int(i.decode()) for i in self.r.smembers(self._published_set_key())]
+        return [
+            int(i.decode()) for i in self.r.zrange(self._published_zset_key(), 0, -1)
+        ]
 
     def delete_published(self, ids: List[int]):
         if not ids:
             return
-        self.r.srem(self._published_set_key(), *ids)
+        self.r.zrem(self._published_zset_key(), *ids)
+
+    def delete_published_before(self, timestamp: float) -> int:
+        return self.r.zremrangebyscore(
+            self._published_zset_key(), "-inf", f"({timestamp}"
+        )
 
     def has_published(self, ids: List[int]) -> List[int]:
         published_selectors = self._has_published(ids)
@@ -194,24 +772,68 @@ class RedisPubSubRepository(IPubSubRepository):
         unpublished_selectors = [not b for b in published_selectors]
         return list(compress(ids, unpublished_selectors))
 
-    def mark_published(self, ids: List[int]):
+    def mark_published(self, ids: List[int], times: Optional[List[float]] = None):
         if not ids:
             return
-        self.r.sadd(self._published_set_key(), *ids)
+        self.r.zadd(self._published_zset_key(), self._published_scores(ids, times))
+
+    def claim_unpublished(
+        self, ids: List[int], times: Optional[List[float]] = None
+    ) -> List[int]:
+        if not ids:
+            return []
+        args = [
+            arg
+            for id_time in self._published_scores(ids, times).items()
+            for arg in id_time
+        ]
+        claimed = self._claim_unpublished(keys=[self._published_zset_key()], args=args)
+        return [int(i) for i in claimed]
+
+    def claim_and_announce(
+        self,
+        ids: List[int],
+        times: Optional[List[float]],
+        stream: str,
+        fields: Dict[str, str],
+        maxlen: int,
+    ) -> List[int]:
+        if not ids:
+            return []
+        args = [
+            arg
+            for id_time in self._published_scores(ids, times).items()
+            for arg in id_time
+        ]
+        claimed = self._claim_and_announce(
+            keys=[stream, self._published_zset_key()],
+            args=_announce_args(fields, maxlen) + args,
+        )
+        return [int(i) for i in claimed]
 
     def clear_published(self):
-        self.r.delete(self._published_set_key())
+        self.r.delete(self._published_zset_key(), self._published_set_key())
+
+    def memory_usage(self) -> int:
+        """
+        Bytes Redis uses to store this topic's published ids.
+        """
+        return self.r.memory_usage(self._published_zset_key()) or 0
 
     def empty_published(self) -> bool:
-        return self.r.exists(self._published_set_key()) == 0
+        return self.r.exists(self._published_zset_key(), self._published_set_key()) == 0
 
     def add_subscriber(self, id: int):
-        self.r.sadd(self._user_subscribed_topics_list_key(id), f"{self.topic}")
-        self.r.sadd(self._topic_subscribers_set_key(), id)
+        with self.r.pipeline() as pipe:
+            pipe.sadd(self._user_subscribed_topics_list_key(id), self.topic.value)
+            pipe.sadd(self._topic_subscribers_set_key(), id)
+            pipe.execute()
 
     def remove_subscriber(self, id: int):
-        self.r.srem(self._user_subscribed_topics_list_key(id), f"{self.topic}")
-        self.r.srem(self._topic_subscribers_set_key(), id)
+        with self.r.pipeline() as pipe:
+            pipe.srem(self._user_subscribed_topics_list_key(id), self.topic.value)
+            pipe.srem(self._topic_subscribers_set_key(), id)
+            pipe.execute()
 
     def get_subscribers(self) -> List[Subscriber]:
         subscribers = []
@@ -224,3 +846,500 @@ class RedisPubSubRepository(IPubSubRepository):
         for topic in self.r.smembers(self._user_subscribed_topics_list_key(id)):
             subscribed_topics.append(Topic(topic.decode()))
         return subscribed_topics
+
+
+class BitmapPubSubRepository(RedisPubSubRepository):
+    """
+    Stores published ids as bits instead of SET members.
+
+    HN ids are dense and increasing, so ids are split into segments of
+    `segment_size` ids. Each segment is a bitmap at offset `id - base`, where
+    `base` is the segment's first id. A sorted set indexes the segments by
+    the latest item time written to them, and retention drops whole
+    segments. Subscribers are stored as in RedisPubSubRepository.
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        topic: Topic = None,
+        r: redis.Redis = None,
+        segment_size: int = 1 << 16,
+    ) -> None:
+        super().__init__(url, topic, r)
+        self.segment_size = segment_size
+        self._claim_bits_and_announce = self.r.register_script(
+            CLAIM_BITS_AND_ANNOUNCE_SCRIPT
+        )
+
+    def _segments_key(self) -> str:
+        return f"{self.topic}:published_bitmap:segments"
+
+    def _segment_key(self, segment: int) -> str:
+        return f"{self.topic}:published_bitmap:{segment}"
+
+    def _segments(self, min_time: str = "-inf", max_time: str = "+inf") -> List[int]:
+        return [
+            int(i)
+            for i in self.r.zrangebyscore(self._segments_key(), min_time, max_time)
+        ]
+
+    def _has_published(self, ids: List[int]) -> List[bool]:
+        with self.r.pipeline(transaction=False) as pipe:
+            for id in ids:
+                segment, offset = divmod(id, self.segment_size)
+                pipe.getbit(self._segment_key(segment), offset)
+            return [bool(bit) for bit in pipe.execute()]
+
+    def _set_bits(self, ids: List[int], times: Optional[List[float]]) -> List[bool]:
+        """
+        Set the bits of ids in one MULTI, return whether each one was unset.
+        """
+        segment_times: Dict[int, float] = {}
+        with self.r.pipeline() as pipe:
+            if times is None:
+                times = [time.time()] * len(ids)
+            for id, t in zip(ids, times):
+                segment, offset = divmod(id, self.segment_size)
+                pipe.setbit(self._segment_key(segment), offset, 1)
+                segment_times[segment] = max(t, segment_times.get(segment, t))
+            pipe.zadd(self._segments_key(), segment_times, gt=True)
+            return [not bit for bit in pipe.execute()[: len(ids)]]
+
+    def migrate_published(self) -> int:
+        """
+        Move ids of the SET and sorted set stores into bitmaps.
+        """
+        legacy = RedisPubSubRepository(topic=self.topic, r=self.r)
+        ids_with_times = self.r.zrange(
+            legacy._published_zset_key(), 0, -1, withscores=True
+        )
+        ids = [int(i) for i, _ in ids_with_times]
+        times = [t for _, t in ids_with_times]
+        set_ids = [int(i) for i in self.r.smembers(legacy._published_set_key())]
+        ids += set_ids
+        times += [time.time()] * len(set_ids)
+        if ids:
+            self._set_bits(ids, times)
+            legacy.clear_published()
+        return len(ids)
+
+    def get_published(self) -> List[int]:
+        ids = []
+        for segment in self._segments():
+            bitmap = self.r.get(self._segment_key(segment)) or b""
+            base = segment * self.segment_size
+            for i, byte in enumerate(bitmap):
+                if not byte:
+                    continue
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        ids.append(base + i * 8 + bit)
+        return ids
+
+    def delete_published(self, ids: List[int]):
+        if not ids:
+            return
+        with self.r.pipeline(transaction=False) as pipe:
+            for id in ids:
+                segment, offset = divmod(id, self.segment_size)
+                pipe.setbit(self._segment_key(segment), offset, 0)
+            pipe.execute()
+
+    def delete_published_before(self, timestamp: float) -> int:
+        """
+        Drop the segments whose items are all older than `timestamp`.
+        """
+        segments = self._segments(max_time=f"({timestamp}")
+        if not segments:
+            return 0
+        keys = [self._segment_key(segment) for segment in segments]
+        with self.r.pipeline() as pipe:
+            for key in keys:
+                pipe.bitcount(key)
+            pipe.delete(*keys)
+            pipe.zrem(self._segments_key(), *segments)
+            return sum(pipe.execute()[: len(keys)])
+
+    def mark_published(self, ids: List[int], times: Optional[List[float]] = None):
+        if not ids:
+            return
+        self._set_bits(ids, times)
+
+    def claim_unpublished(
+        self, ids: List[int], times: Optional[List[float]] = None
+    ) -> List[int]:
+        if not ids:
+            return []
+        return list(compress(ids, self._set_bits(ids, times)))
+
+    def claim_and_announce(
+        self,
+        ids: List[int],
+        times: Optional[List[float]],
+        stream: str,
+        fields: Dict[str, str],
+        maxlen: int,
+    ) -> List[int]:
+        if not ids:
+            return []
+        keys = [stream, self._segments_key()]
+        args = _announce_args(fields, maxlen)
+        for id, t in self._published_scores(ids, times).items():
+            segment, offset = divmod(id, self.segment_size)
+            keys.append(self._segment_key(segment))
+            args.extend([id, offset, segment, t])
+        claimed = self._claim_bits_and_announce(keys=keys, args=args)
+        return [int(i) for i in claimed]
+
+    def clear_published(self):
+        keys = [self._segment_key(segment) for segment in self._segments()]
+        self.r.delete(self._segments_key(), *keys)
+
+    def empty_published(self) -> bool:
+        return self.r.zcard(self._segments_key()) == 0
+
+    def memory_usage(self) -> int:
+        keys = [self._segment_key(segment) for segment in self._segments()]
+        with self.r.pipeline(transaction=False) as pipe:
+            for key in keys + [self._segments_key()]:
+                pipe.memory_usage(key)
+            return sum(usage or 0 for usage in pipe.execute())
+
+
+class KeywordIndex:
+    """
+    Aho-Corasick automaton over keywords, finding all of them in a text in one
+    pass over it.
+
+    Adding a keyword extends the trie, removing one unmarks its node. The
+    failure links are rebuilt on the next search after a change, the trie is
+    rebuilt once removed keywords leave more dead nodes than live ones.
+    """
+
+    def __init__(self, keywords: Iterable[str] = ()) -> None:
+        self._reset()
+        for keyword in keywords:
+            self.add(keyword)
+
+    def _reset(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._keyword: List[Optional[str]] = [None]
+        self._fail: List[int] = [0]
+        self._output: List[int] = [0]
+        self._size = 0
+        self._dead = 0
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, keyword: str) -> bool:
+        node = self._node(keyword)
+        return node is not None and self._keyword[node] is not None
+
+    def __iter__(self):
+        return (keyword for keyword in self._keyword if keyword is not None)
+
+    def _node(self, keyword: str) -> Optional[int]:
+        node = 0
+        for char in keyword:
+            if (node := self._goto[node].get(char)) is None:
+                return None
+        return node
+
+    def add(self, keyword: str):
+        if not keyword:
+            raise ValueError("Empty keyword")
+        node = 0
+        for char in keyword:
+            if (child := self._goto[node].get(char)) is None:
+                child = self._goto[node][char] = len(self._goto)
+                self._goto.append({})
+                self._keyword.append(None)
+            node = child
+        if self._keyword[node] is None:
+            self._keyword[node] = keyword
+            self._size += 1
+            self._dirty = True
+
+    def remove(self, keyword: str):
+        node = self._node(keyword)
+        if node is None or self._keyword[node] is None:
+            return
+        self._keyword[node] = None
+        self._size -= 1
+        self._dead += len(keyword)
+        self._dirty = True
+        if self._dead > len(self._goto) - self._dead:
+            keywords = list(self)
+            self._reset()
+            for keyword in keywords:
+                self.add(keyword)
+
+    def _build(self):
+        """
+        Breadth first, a node's failure link is the longest proper suffix of
+        its path in the trie, its output link the longest one that is a
+        keyword.
+        """
+        self._fail = [0] * len(self._goto)
+        self._output = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail
+                self._output[child] = (
+                    fail if self._keyword[fail] is not None else self._output[fail]
+                )
+                queue.append(child)
+        self._dirty = False
+
+    def find(self, text: str) -> Set[str]:
+        """
+        The keywords found in `text` as whole words.
+        """
+        if self._dirty:
+            self._build()
+        goto, fail, keywords, output = (
+            self._goto,
+            self._fail,
+            self._keyword,
+            self._output,
+        )
+        found = set()
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if keywords[node] is not None else output[node]
+            while match:
+                keyword = keywords[match]
+                start = end - len(keyword)
+                if (start == 0 or not text[start - 1].isalnum()) and (
+                    end == len(text) or not text[end].isalnum()
+                ):
+                    found.add(keyword)
+                match = output[match]
+        return found
+
+
+def _stream_id(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+REMOVE_KEYWORD_SCRIPT = """
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[2])
+if redis.call('SCARD', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+redis.call(
+    'XADD', KEYS[4], 'MAXLEN', '~', ARGV[3], '*',
+    'op', 'remove', 'term', ARGV[1], 'id', ARGV[2]
+)
+return 1
+"""
+
+
+class RedisKeywordRepository:
+    """
+    Keyword and domain subscriptions, routed through an in-memory index.
+
+    Terms starting with "site:" match the story's url host and its parent
+    domains, other terms match whole words of the title, case insensitively.
+    Subscriptions are stored in Redis and each change is appended to a
+    stream, `refresh` applies the changes made since the last call, by any
+    replica, to the index.
+    """
+
+    def __init__(
+        self, url: str = None, r: redis.Redis = None, max_changes: int = 10000
+    ) -> None:
+        self.r = (
+            r if r is not None else redis.Redis(connection_pool=connection_pool(url))
+        )
+        self.max_changes = max_changes
+        self.index = KeywordIndex()
+        self.subscribers: Dict[str, Set[int]] = {}
+        self.last_change_id: Optional[str] = None
+        self._lock = threading.Lock()
+        self._claim_unrouted = self.r.register_script(CLAIM_UNPUBLISHED_SCRIPT)
+        self._remove_keyword = self.r.register_script(REMOVE_KEYWORD_SCRIPT)
+
+    @staticmethod
+    def normalize(term: str) -> str:
+        term = " ".join(term.casefold().split())
+        if term.startswith("site:"):
+            host = term[len("site:") :].strip()
+            host = host.split("://")[-1].split("/")[0]
+            if host.startswith("www."):
+                host = host[4:]
+            term = f"site:{host}" if host else ""
+        return term
+
+    @property
+    def _keywords_key(self) -> str:
+        return "keywords"
+
+    @property
+    def _changes_key(self) -> str:
+        return "keywords:changes"
+
+    @property
+    def _routed_zset_key(self) -> str:
+        return "keywords:routed_at"
+
+    def _keyword_subscribers_set_key(self, term: str) -> str:
+        return f"keyword:{term}:subscribers"
+
+    def _user_subscribed_keywords_set_key(self, id: int) -> str:
+        return f"chat_id:{id}:subscribed:keywords"
+
+    def add_keyword(self, id: int, term: str) -> str:
+        """
+        Subscribe `id` to `term`, return the term as matched.
+        """
+        if not (term := self.normalize(term)):
+            raise ValueError("Empty keyword")
+        with self.r.pipeline() as pipe:
+            pipe.sadd(self._user_subscribed_keywords_set_key(id), term)
+            pipe.sadd(self._keyword_subscribers_set_key(term), id)
+            pipe.sadd(self._keywords_key, term)
+            pipe.xadd(
+                self._changes_key,
+                {"op": "add", "term": term, "id": id},
+                maxlen=self.max_changes,
+            )
+            pipe.execute()
+        return term
+
+    def remove_keyword(self, id: int, term: str) -> Optional[str]:
+        """
+        Unsubscribe `id` from `term`, return the term as matched or None when
+        `id` was not subscribed to it.
+        """
+        term = self.normalize(term)
+        removed = self._remove_keyword(
+            keys=[
+                self._user_subscribed_keywords_set_key(id),
+                self._keyword_subscribers_set_key(term),
+                self._keywords_key,
+                self._changes_key,
+            ],
+            args=[term, id, self.max_changes],
+        )
+        return term if removed else None
+
+    def subscribed_keywords(self, id: int) -> List[str]:
+        return sorted(
+            term.decode()
+            for term in self.r.smembers(self._user_subscribed_keywords_set_key(id))
+        )
+
+    def _add(self, term: str, id: int):
+        self.subscribers.setdefault(term, set()).add(id)
+        if not term.startswith("site:"):
+            self.index.add(term)
+
+    def _remove(self, term: str, id: int):
+        if (subscribers := self.subscribers.get(term)) is None:
+            return
+        subscribers.discard(id)
+        if not subscribers:
+            del self.subscribers[term]
+            self.index.remove(term)
+
+    def load(self):
+        """
+        Rebuild the index from the stored subscriptions.
+        """
+        last = self.r.xrevrange(self._changes_key, count=1)
+        terms = [term.decode() for term in self.r.smembers(self._keywords_key)]
+        with self.r.pipeline(transaction=False) as pipe:
+            for term in terms:
+                pipe.smembers(self._keyword_subscribers_set_key(term))
+            term_subscribers = pipe.execute()
+
+        with self._lock:
+            self.index = KeywordIndex()
+            self.subscribers = {}
+            for term, subscribers in zip(terms, term_subscribers):
+                for id in subscribers:
+                    self._add(term, int(id))
+            # Changes after `last` are applied again by `refresh`, they are
+            # idempotent.
+            self.last_change_id = last[0][0].decode() if last else "0-0"
+        logger.info(f"Loaded {len(self.subscribers)} keywords")
+
+    def refresh(self):
+        """
+        Apply the subscription changes made since the last call.
+        """
+        if self.last_change_id is None:
+            self.load()
+            return
+        with self.r.pipeline(transaction=False) as pipe:
+            pipe.xrange(self._changes_key, count=1)
+            pipe.xlen(self._changes_key)
+            pipe.xread({self._changes_key: self.last_change_id})
+            first, length, res = pipe.execute()
+        if not res:
+            return
+        if length >= self.max_changes and _stream_id(first[0][0].decode()) > _stream_id(
+            self.last_change_id
+        ):
+            # Changes were trimmed before this replica read them.
+            self.load()
+            return
+        with self._lock:
+            for change_id, fields in res[0][1]:
+                apply = self._add if fields[b"op"] == b"add" else self._remove
+                apply(fields[b"term"].decode(), int(fields[b"id"]))
+                self.last_change_id = change_id.decode()
+
+    def match(self, title: str, url: Optional[str] = None) -> Dict[int, List[str]]:
+        """
+        The subscribers of the terms matching a story, with those terms.
+        """
+        terms = []
+        if url and (host := urlsplit(str(url)).hostname):
+            labels = (host[4:] if host.startswith("www.") else host).split(".")
+            terms = [f"site:{'.'.join(labels[i:])}" for i in range(len(labels))]
+
+        matches: Dict[int, List[str]] = {}
+        with self._lock:
+            terms = [term for term in terms if term in self.subscribers]
+            terms.extend(self.index.find(title.casefold()))
+            for term in sorted(terms):
+                for id in self.subscribers[term]:
+                    matches.setdefault(id, []).append(term)
+        return matches
+
+    def has_not_routed(self, ids: List[int]) -> List[int]:
+        if not ids:
+            return []
+        scores = self.r.zmscore(self._routed_zset_key, ids)
+        return [id for id, score in zip(ids, scores) if score is None]
+
+    def claim_unrouted(self, ids: List[int], times: List[float]) -> List[int]:
+        """
+        Mark ids as routed, return the ones that were not routed yet.
+        """
+        if not ids:
+            return []
+        args = [arg for id_time in zip(ids, times) for arg in id_time]
+        claimed = self._claim_unrouted(keys=[self._routed_zset_key], args=args)
+        return [int(i) for i in claimed]
+
+    def delete_routed_before(self, timestamp: float) -> int:
+        return self.r.zremrangebyscore(self._routed_zset_key, "-inf", f"({timestamp}")
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Dict, Optional
+
+from . import metrics
+from .topics import Topic
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveInterval:
+    """
+    The delay between two publish cycles of a topic.
+
+    Cycles finding no new ids stretch the interval by `backoff`, cycles
+    finding at least `busy_new_ids` shrink it by the same factor, within
+    [`min_interval`, `max_interval`]. The delay is never shorter than the
+    last cycle took, and is spread by +/- `jitter` of itself.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        min_interval: float,
+        max_interval: float,
+        busy_new_ids: int = 5,
+        backoff: float = 1.5,
+        jitter: float = 0.1,
+        random: Callable[[], float] = random.random,
+    ) -> None:
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_new_ids = busy_new_ids
+        self.backoff = backoff
+        self.jitter = jitter
+        self.random = random
+
+    def update(self, new_ids: Optional[int], duration: float) -> float:
+        """
+        Adapt the interval to a cycle's outcome, return the next delay.
+        `new_ids` is None when the cycle had nothing to compare with.
+        """
+        if new_ids == 0:
+            self.interval *= self.backoff
+        elif new_ids is not None and new_ids >= self.busy_new_ids:
+            self.interval /= self.backoff
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+
+        delay = max(self.interval, duration)
+        return delay * (1 + self.jitter * (2 * self.random() - 1))
+
+
+class PublishScheduler:
+    """
+    Runs `publish(topic)` for every topic, one run at a time per topic, with
+    an `AdaptiveInterval` between the end of a run and the next.
+
+    `trigger` asks for a run before the delay is over, triggers arriving
+    during a run are coalesced into a single run after it, no sooner than
+    `min_interval` after the previous run started.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[Topic], Awaitable[Optional[int]]],
+        intervals: Dict[Topic, AdaptiveInterval],
+    ) -> None:
+        self.publish = publish
+        self.intervals = intervals
+        self._triggers: Dict[Topic, asyncio.Event] = {}
+
+    def trigger(self, topic: Topic):
+        """
+        Must be called from the loop running the scheduler.
+        """
+        if (event := self._triggers.get(topic)) is not None:
+            event.set()
+
+    async def _arun_once(self, topic: Topic) -> float:
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        try:
+            new_ids = await self.publish(topic)
+        except Exception:
+            logger.exception(f"Failed to publish {topic.name} stories")
+            new_ids = None
+        duration = loop.time() - started_at
+
+        delay = self.intervals[topic].update(new_ids, duration)
+        logger.info(
+            f"Publish {topic.name} took {duration:.1f}s, found {new_ids} new ids, "
+            f"next in {delay:.0f}s"
+        )
+        metrics.set_gauge("hnread_publish_delay_seconds", delay, topic=topic.value)
+        return delay
+
+    async def arun_topic(self, topic: Topic):
+        loop = asyncio.get_running_loop()
+        trigger = self._triggers.setdefault(topic, asyncio.Event())
+        while True:
+            trigger.clear()
+            started_at = loop.time()
+            delay = await self._arun_once(topic)
+            try:
+                await asyncio.wait_for(trigger.wait(), delay)
+            except asyncio.TimeoutError:
+                continue
+            min_interval = self.intervals[topic].min_interval
+            await asyncio.sleep(max(started_at + min_interval - loop.time(), 0))
+
+    async def arun(self):
+        await asyncio.gather(*[self.arun_topic(topic) for topic in self.intervals])
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from .items import ScoreableItem
+
+
+class ScoreSeries:
+    """
+    The last `max_points` (timestamp, score, descendants) snapshots of an item,
+    in a ring of three arrays.
+    """
+
+    __slots__ = ("times", "scores", "descendants", "start", "count")
+
+    def __init__(self, max_points: int) -> None:
+        self.times = array("d", bytes(8 * max_points))
+        self.scores = array("l", [0]) * max_points
+        self.descendants = array("l", [0]) * max_points
+        self.start = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _index(self, i: int) -> int:
+        return (self.start + i) % len(self.times)
+
+    def append(self, timestamp: float, score: int, descendants: int):
+        if self.count == len(self.times):
+            index = self.start
+            self.start = self._index(1)
+        else:
+            index = self._index(self.count)
+            self.count += 1
+        self.times[index] = timestamp
+        self.scores[index] = score
+        self.descendants[index] = descendants
+
+    def first(self) -> Tuple[float, int, int]:
+        i = self.start
+        return self.times[i], self.scores[i], self.descendants[i]
+
+    def last(self) -> Tuple[float, int, int]:
+        i = self._index(self.count - 1)
+        return self.times[i], self.scores[i], self.descendants[i]
+
+    def points(self) -> List[Tuple[float, int, int]]:
+        return [
+            (self.times[i], self.scores[i], self.descendants[i])
+            for i in map(self._index, range(self.count))
+        ]
+
+
+class ScoreSeriesStore:
+    """
+    Score snapshots of the most recently recorded `max_items` items.
+    """
+
+    def __init__(
+        self,
+        max_points: int = 16,
+        max_items: int = 5000,
+        min_interval: float = 30.0,
+        min_age: float = 30 * 60,
+    ) -> None:
+        self.max_points = max_points
+        self.max_items = max_items
+        self.min_interval = min_interval
+        self.min_age = min_age
+        self._series: OrderedDict[int, ScoreSeries] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def get(self, id: int) -> Optional[ScoreSeries]:
+        return self._series.get(id)
+
+    def record(self, items: Iterable[ScoreableItem], now: Optional[float] = None):
+        """
+        Snapshot the items, skipping those snapshotted less than
+        `min_interval` seconds ago.
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            for item in items:
+                if (series := self._series.get(item.id)) is None:
+                    series = ScoreSeries(self.max_points)
+                    self._series[item.id] = series
+                else:
+                    self._series.move_to_end(item.id)
+                    if now - series.last()[0] < self.min_interval:
+                        continue
+                series.append(now, item.score, getattr(item, "descendants", 0) or 0)
+            while len(self._series) > self.max_items:
+                self._series.popitem(last=False)
+
+    def velocity(self, item: ScoreableItem, now: Optional[float] = None) -> float:
+        """
+        Points per hour across the recorded snapshots. With a single snapshot,
+        the average since the item was created, counting at least `min_age`.
+        """
+        series = self._series.get(item.id)
+        if series is not None and len(series) > 1:
+            first_time, first_score, _ = series.first()
+            last_time, last_score, _ = series.last()
+            return (last_score - first_score) * 3600 / (last_time - first_time)
+
+        now = now if now is not None else time.time()
+        age = max(now - item.time.timestamp(), self.min_age)
+        return max(item.score - 1, 0) * 3600 / age
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
-from . import filters, items, repos
+from pydantic import ValidationError
+
+from . import coordination, feeds, filters, items, metrics, repos
 from .topics import Topic
 
 logger = logging.getLogger(__name__)
@@ -17,6 +20,24 @@ def filter_only_scoreable(
     return list(filter(lambda x: hasattr(x, "score"), stories))
 
 
+def filter_valid(stories: List[Any]) -> List[Any]:
+    """
+    Validate lazily decoded items, dropping those whose full model is
+    invalid so they are never claimed and then fail at render.
+    """
+    valid_stories = []
+    for story in stories:
+        if isinstance(story, items.ItemRecord):
+            try:
+                story.model()
+            except ValidationError as e:
+                logger.warning(f"Skip invalid item {story.id}: {e}")
+                metrics.increment("hnread_invalid_items_total")
+                continue
+        valid_stories.append(story)
+    return valid_stories
+
+
 class EventHandler(ABC):
     @abstractmethod
     def handle(
@@ -26,19 +47,29 @@ class EventHandler(ABC):
     ):
         pass
 
+    def handle_many(self, subscribers: List[repos.Subscriber], stories: List[Any]):
+        for story in stories:
+            self.handle(subscribers, story)
+
+    def handle_digest(self, subscribers: List[repos.Subscriber], stories: List[Any]):
+        self.handle_many(subscribers, stories)
+
 
 class HNSubscribeService:
-    def __init__(self, pubsub_repo: repos.IPubSubRepository) -> None:
+    def __init__(
+        self,
+        pubsub_repo: repos.IPubSubRepository,
+        keyword_repo: Optional[repos.RedisKeywordRepository] = None,
+    ) -> None:
         self.pubsub_repo = pubsub_repo
+        self.keyword_repo = keyword_repo
 
     def subscribe(self, topic: Topic, subscriber: repos.Subscriber) -> bool:
-        self.pubsub_repo.set_topic(topic)
-        self.pubsub_repo.add_subscriber(subscriber.id)
+        self.pubsub_repo.for_topic(topic).add_subscriber(subscriber.id)
         return True
 
     def unsubscribe(self, topic: Topic, subscriber: repos.Subscriber) -> bool:
-        self.pubsub_repo.set_topic(topic)
-        self.pubsub_repo.remove_subscriber(subscriber.id)
+        self.pubsub_repo.for_topic(topic).remove_subscriber(subscriber.id)
         return True
 
     def list_topic(self) -> Dict[Topic, str]:
@@ -52,6 +83,21 @@ class HNSubscribeService:
             res[topic] = all_topics[topic]
         return res
 
+    def watch(self, term: str, subscriber: repos.Subscriber) -> str:
+        """
+        Subscribe to stories matching `term`, return the term as matched.
+        """
+        return self.keyword_repo.add_keyword(subscriber.id, term)
+
+    def unwatch(self, term: str, subscriber: repos.Subscriber) -> Optional[str]:
+        """
+        Unsubscribe from `term`, None when the subscriber was not watching it.
+        """
+        return self.keyword_repo.remove_keyword(subscriber.id, term)
+
+    def list_watched(self, chat_id: int) -> List[str]:
+        return self.keyword_repo.subscribed_keywords(chat_id)
+
 
 class NHPublishService:
     def __init__(
@@ -59,63 +105,476 @@ class NHPublishService:
         hn_repo: repos.HNRepository,
         pubsub_repo: repos.IPubSubRepository,
         filters: filters.AbstractFilter,
+        feed: Optional[feeds.ChangeFeed] = None,
+        coordinator: Optional[coordination.Coordinator] = None,
     ) -> None:
         self.hn_repo = hn_repo
+        self.feed = feed
+        self.coordinator = coordinator
         self.pubsub_repo = pubsub_repo
         self.filter = filters
+        self.topic_filters: Dict[Topic, filters.AbstractFilter] = {}
         self.handlers: Dict[Topic, EventHandler] = {}
+        self.digest_window: Optional[timedelta] = None
+        self.digests: Dict[Topic, List[items.ScoreableItem]] = {}
+        self.digest_started_at: Dict[Topic, datetime] = {}
         self.stories = {
             Topic.top: self.hn_repo.topstories_id,
             Topic.best: self.hn_repo.beststories_id,
         }
+        self.astories = {
+            Topic.top: self.hn_repo.atopstories_id,
+            Topic.best: self.hn_repo.abeststories_id,
+        }
+        self.seen_stories_ids: Dict[Topic, Set[int]] = {}
+        self.stream_resources = {
+            Topic.top: ["topstories", "newstories"],
+            Topic.best: ["beststories"],
+        }
+        self.snapshot_ids: Dict[Topic, Callable[[repos.ListSnapshot], List[int]]] = {
+            Topic.top: lambda snapshot: list(
+                set(snapshot.ids("topstories")) - set(snapshot.ids("newstories"))
+            ),
+            Topic.best: lambda snapshot: snapshot.ids("beststories"),
+        }
+        self.snapshot_max_age = 0.0
+        self.preview_comments = 0
+        self.preview_deadline = 2.0
+        self.preview_concurrency = 5
 
-    def add_handler(self, topic: Topic, handler: EventHandler) -> NHPublishService:
+    def add_handler(
+        self,
+        topic: Topic,
+        handler: EventHandler,
+        topic_filter: Optional[filters.AbstractFilter] = None,
+    ) -> NHPublishService:
+        """
+        `topic_filter` selects the topic's stories instead of the service's
+        filter, topics have their own score distributions.
+        """
         self.handlers[topic] = handler
+        if topic_filter is not None:
+            self.topic_filters[topic] = topic_filter
+        return self
+
+    def enable_digest(self, window: timedelta = timedelta(0)) -> NHPublishService:
+        """
+        Send the stories selected within `window` as one digest per subscriber,
+        the default window sends one digest per publish cycle.
+        """
+        self.digest_window = window
+        return self
+
+    def share_snapshots(self, max_age: float) -> NHPublishService:
+        """
+        Reuse list snapshots, and the items they resolved, for `max_age`
+        seconds. Services on the same HNRepository share them, and the lists
+        their snapshots have in common.
+        """
+        self.snapshot_max_age = max_age
+        return self
+
+    def enable_comment_previews(
+        self, count: int = 3, deadline: float = 2.0, max_concurrency: int = 5
+    ) -> NHPublishService:
+        """
+        Show the top `count` comments under delivered stories. Comments are
+        crawled for at most `deadline` seconds per cycle, stories keep their
+        previews while their comment count does not change.
+        """
+        self.preview_comments = count
+        self.preview_deadline = deadline
+        self.preview_concurrency = max_concurrency
         return self
 
-    def publish_stories(self, topic: Topic):
-        stories_ids = self.stories[topic]()
+    def _stage(self, topic: Topic, stage: str):
+        return metrics.timer("hnread_stage_seconds", topic=topic.value, stage=stage)
 
-        self.pubsub_repo.set_topic(topic)
+    def _count_new_ids(self, topic: Topic, stories_ids: List[int]) -> Optional[int]:
+        """
+        How many ids were not in the topic's previous list, None for the
+        first list.
+        """
+        last_stories_ids = self.seen_stories_ids.get(topic)
+        self.seen_stories_ids[topic] = set(stories_ids)
+        if last_stories_ids is None:
+            return None
+        return len(self.seen_stories_ids[topic] - last_stories_ids)
 
-        unpublished_stories_ids = self.pubsub_repo.has_not_published(stories_ids)
-        unpublished_stories = self.hn_repo.ofIds(*unpublished_stories_ids, sort=True)
-        unpublished_stories = list(
+    def _select_stories(
+        self, topic: Topic, stories: List[items.Item]
+    ) -> List[items.ScoreableItem]:
+        recent_stories = list(
             filter(
                 lambda item: datetime.now(timezone.utc) - item.time
                 <= timedelta(days=1),
-                unpublished_stories,
+                stories,
+            )
+        )
+
+        with self._stage(topic, "filter"):
+            topic_filter = self.topic_filters.get(topic, self.filter)
+            selected_stories = topic_filter(filter_only_scoreable(recent_stories))
+        selected_stories = filter_valid(selected_stories)
+
+        logger.info(f"Found {len(selected_stories)} {topic.name} stories")
+        return selected_stories
+
+    def _claim(
+        self,
+        topic: Topic,
+        stories: List[items.ScoreableItem],
+        announce: bool = False,
+    ) -> List[items.ScoreableItem]:
+        """
+        Claim unpublished stories, `announce` the claimed ones to the replicas
+        in the same transaction.
+        """
+        pubsub_repo = self.pubsub_repo.for_topic(topic)
+        ids = [s.id for s in stories]
+        times = [s.time.timestamp() for s in stories]
+        with self._stage(topic, "claim"):
+            if announce:
+                claimed_ids = set(
+                    self.coordinator.claim_and_announce(topic, pubsub_repo, ids, times)
+                )
+            else:
+                claimed_ids = set(pubsub_repo.claim_unpublished(ids, times))
+        if len(claimed_ids) < len(stories):
+            logger.info(
+                f"{len(stories) - len(claimed_ids)} {topic.name} stories "
+                "were already published"
+            )
+        return [s for s in stories if s.id in claimed_ids]
+
+    def _handle(
+        self,
+        topic: Topic,
+        subscribers: List[repos.Subscriber],
+        stories: List[items.ScoreableItem],
+    ):
+        if self.digest_window is None:
+            with self._stage(topic, "delivery"):
+                self.handlers[topic].handle_many(subscribers, stories)
+            return
+
+        now = datetime.now(timezone.utc)
+        digest = self.digests.setdefault(topic, [])
+        if not digest:
+            self.digest_started_at[topic] = now
+        digest.extend(stories)
+        metrics.set_gauge("hnread_digest_stories", len(digest), topic=topic.value)
+        if digest and now - self.digest_started_at[topic] >= self.digest_window:
+            logger.info(f"Send {topic.name} digest of {len(digest)} stories")
+            self.digests[topic] = []
+            metrics.set_gauge("hnread_digest_stories", 0, topic=topic.value)
+            with self._stage(topic, "delivery"):
+                self.handlers[topic].handle_digest(subscribers, digest)
+
+    def _deliver(
+        self,
+        topic: Topic,
+        subscribers: List[repos.Subscriber],
+        stories: List[items.ScoreableItem],
+    ):
+        """
+        Hand the stories over before claiming them, a crash in between sends
+        them again rather than losing them. Digests are only held in memory,
+        their stories are claimed first so no cycle buffers them twice.
+        """
+        if self.digest_window is not None:
+            self._handle(topic, subscribers, self._claim(topic, stories))
+            return
+        self._handle(topic, subscribers, stories)
+        self._claim(topic, stories)
+
+    async def _apreview(self, topic: Topic, stories: List[items.ScoreableItem]):
+        if not self.preview_comments:
+            return
+        stale_stories = [
+            story
+            for story in stories
+            if getattr(story, "descendants", 0)
+            and not items.comment_previews.fresh(story.id, story.descendants)
+        ]
+        if not stale_stories:
+            return
+        with self._stage(topic, "comments"):
+            trees = await self.hn_repo.acomment_trees(
+                {story.id: getattr(story, "kids", []) for story in stale_stories},
+                max_depth=1,
+                max_fanout=self.preview_comments,
+                max_concurrency=self.preview_concurrency,
+                deadline=self.preview_deadline,
             )
+        for story in stale_stories:
+            if comments := trees[story.id]:
+                items.comment_previews.set(
+                    story.id, story.descendants, comments[: self.preview_comments]
+                )
+
+    def publish_stories(self, topic: Topic) -> Optional[int]:
+        """
+        Return how many ids entered the topic since the previous call.
+        """
+        with metrics.timer("hnread_cycle_seconds", topic=topic.value):
+            with self._stage(topic, "list_fetch"):
+                stories_ids = self.stories[topic]()
+            new_ids = self._count_new_ids(topic, stories_ids)
+            pubsub_repo = self.pubsub_repo.for_topic(topic)
+
+            with self._stage(topic, "membership_check"):
+                unpublished_stories_ids = pubsub_repo.has_not_published(stories_ids)
+            with self._stage(topic, "item_fetch"):
+                unpublished_stories = self.hn_repo.ofIds(
+                    *unpublished_stories_ids, sort=True
+                )
+            selected_stories = self._select_stories(topic, unpublished_stories)
+
+            subscribers = pubsub_repo.get_subscribers()
+
+            self._deliver(topic, subscribers, selected_stories)
+        return new_ids
+
+    async def apublish_stories(self, topic: Topic) -> Optional[int]:
+        """
+        Same as `publish_stories`, meant to run on a long-lived event loop.
+
+        Blocking Redis calls and deliveries run in the loop's default executor,
+        so publishing several topics on the same loop overlaps their work.
+        Only the topic's own lists are fetched, shared with the other topics
+        reading them, see `share_snapshots`. With a change feed, items come from its store and
+        only new or changed items are fetched.
+
+        With a coordinator, only the topic's leader selects and claims stories,
+        every replica delivers them to its share of the subscribers.
+        """
+        with metrics.timer("hnread_cycle_seconds", topic=topic.value):
+            if self.coordinator is None:
+                return await self._apublish_stories(topic)
+            return await self._apublish_coordinated(topic)
+
+    async def _apublish_coordinated(self, topic: Topic) -> Optional[int]:
+        loop = asyncio.get_running_loop()
+        new_ids = None
+        if await loop.run_in_executor(None, self.coordinator.is_leader, topic):
+            new_ids, selected_stories, _ = await self._aselect(topic)
+            await loop.run_in_executor(None, self._claim, topic, selected_stories, True)
+
+        batches = await loop.run_in_executor(None, self.coordinator.announced, topic)
+        if not batches:
+            return new_ids
+        aofIds = self.feed.aofIds if self.feed is not None else self.hn_repo.aofIds
+        subscribers = await loop.run_in_executor(
+            None, self.pubsub_repo.for_topic(topic).get_subscribers
         )
+        for batch_id, ids, replicas in batches:
+            with self._stage(topic, "item_fetch"):
+                stories = await aofIds(*ids, sort=True)
+            # Stories may have died or been deleted since they were announced.
+            stories = filter_only_scoreable(filter_valid(stories))
+            shard = [s for s in subscribers if self.coordinator.owns(s.id, replicas)]
+            await self._apreview(topic, stories)
+            await loop.run_in_executor(None, self._handle, topic, shard, stories)
+            self.coordinator.delivered(topic, batch_id)
+        return new_ids
 
-        unpublished_scoreable_stories = self.filter(
-            filter_only_scoreable(unpublished_stories)
+    async def _apublish_stories(self, topic: Topic) -> Optional[int]:
+        new_ids, selected_stories, subscribers = await self._aselect(topic)
+        await self._apreview(topic, selected_stories)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._deliver, topic, subscribers, selected_stories
         )
+        return new_ids
+
+    async def _aselect(
+        self, topic: Topic
+    ) -> Tuple[Optional[int], List[items.ScoreableItem], List[repos.Subscriber]]:
+        loop = asyncio.get_running_loop()
+        with self._stage(topic, "list_fetch"):
+            if self.feed is not None:
+                snapshot, _ = await asyncio.gather(
+                    self.hn_repo.asnapshot(
+                        *self.stream_resources[topic],
+                        afetch=self.feed.aofIds,
+                        max_age=self.snapshot_max_age,
+                    ),
+                    self.feed.apoll(),
+                )
+            else:
+                snapshot = await self.hn_repo.asnapshot(
+                    *self.stream_resources[topic], max_age=self.snapshot_max_age
+                )
+        stories_ids = self.snapshot_ids[topic](snapshot)
+        new_ids = self._count_new_ids(topic, stories_ids)
+
+        pubsub_repo = self.pubsub_repo.for_topic(topic)
+
+        with self._stage(topic, "membership_check"):
+            unpublished_stories_ids = await loop.run_in_executor(
+                None, pubsub_repo.has_not_published, stories_ids
+            )
+        with self._stage(topic, "item_fetch"):
+            unpublished_stories, subscribers = await asyncio.gather(
+                snapshot.aresolve(unpublished_stories_ids),
+                loop.run_in_executor(None, pubsub_repo.get_subscribers),
+            )
+        unpublished_stories = sorted(unpublished_stories, key=lambda item: item.time)
+        selected_stories = self._select_stories(topic, unpublished_stories)
+        return new_ids, selected_stories, subscribers
+
+    async def apublish_topics(self, *topics: Topic) -> List[Optional[int]]:
+        """
+        Publish topics concurrently, each from a snapshot of its own lists.
+        Give each topic its own filter with `add_handler`.
+        """
+        return await asyncio.gather(*map(self.apublish_stories, topics))
+
+    async def apublish_on_change(
+        self,
+        topic: Topic,
+        debounce: float = 5.0,
+        trigger: Optional[Callable[[Topic], Any]] = None,
+    ):
+        """
+        Publish `topic` whenever a story enters it.
 
-        logger.info(f"Found {len(unpublished_scoreable_stories)} {topic.name} stories")
+        Stories are read from the live snapshots of `hn_repo.astart_streaming`,
+        changes arriving within `debounce` seconds are published together.
+        With `trigger`, like `PublishScheduler.trigger`, it is called instead
+        of publishing.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        resource_streams = [
+            self.hn_repo.streams[resource] for resource in self.stream_resources[topic]
+        ]
+        for stream in resource_streams:
+            stream.subscribe(queue)
+        try:
+            stories_ids = set(await self.astories[topic]())
+            while True:
+                await queue.get()
+                await asyncio.sleep(debounce)
+                metrics.set_gauge(
+                    "hnread_change_queue_depth", queue.qsize(), topic=topic.value
+                )
+                while not queue.empty():
+                    queue.get_nowait()
+                last_stories_ids = stories_ids
+                stories_ids = set(await self.astories[topic]())
+                if not stories_ids - last_stories_ids:
+                    continue
+                if trigger is not None:
+                    trigger(topic)
+                else:
+                    await self.apublish_stories(topic)
+        finally:
+            for stream in resource_streams:
+                stream.unsubscribe(queue)
 
-        subscribers = self.pubsub_repo.get_subscribers()
 
-        for story in unpublished_scoreable_stories:
-            handler = self.handlers[topic]
-            handler.handle(subscribers, story)
+class KeywordPublishService:
+    """
+    Routes new stories to the subscribers of the keywords and domains they
+    match, each story once.
+    """
 
-        self.pubsub_repo.mark_published([s.id for s in unpublished_scoreable_stories])
+    def __init__(
+        self,
+        hn_repo: repos.HNRepository,
+        keyword_repo: repos.RedisKeywordRepository,
+        handler: EventHandler,
+        resource: str = "newstories",
+        max_age: timedelta = timedelta(days=1),
+    ) -> None:
+        self.hn_repo = hn_repo
+        self.keyword_repo = keyword_repo
+        self.handler = handler
+        self.resource = resource
+        self.max_age = max_age
+        self.snapshot_max_age = 0.0
+
+    def share_snapshots(self, max_age: float) -> KeywordPublishService:
+        """
+        See `NHPublishService.share_snapshots`.
+        """
+        self.snapshot_max_age = max_age
+        return self
+
+    def route(self, stories: List[Any]) -> Dict[int, List[int]]:
+        """
+        The ids of the subscribers each story matches, by story id.
+        """
+        routes = {}
+        for story in stories:
+            if (title := getattr(story, "title", None)) is None:
+                continue
+            if matches := self.keyword_repo.match(title, getattr(story, "url", None)):
+                routes[story.id] = list(matches)
+        return routes
+
+    def _deliver(self, stories: List[Any]) -> int:
+        """
+        Route and hand over the stories, then claim them, see
+        `NHPublishService._deliver`.
+        """
+        routes = self.route(stories)
+        for story in stories:
+            if story.id in routes:
+                self.handler.handle(
+                    [repos.Subscriber(id=id) for id in routes[story.id]], story
+                )
+        self.keyword_repo.claim_unrouted(
+            [s.id for s in stories], [s.time.timestamp() for s in stories]
+        )
+        return len(routes)
+
+    async def apublish(self) -> int:
+        """
+        Route the stories of `resource` not routed yet, return how many
+        matched a subscription.
+        """
+        loop = asyncio.get_running_loop()
+        snapshot, _ = await asyncio.gather(
+            self.hn_repo.asnapshot(self.resource, max_age=self.snapshot_max_age),
+            loop.run_in_executor(None, self.keyword_repo.refresh),
+        )
+        ids = await loop.run_in_executor(
+            None, self.keyword_repo.has_not_routed, snapshot.ids(self.resource)
+        )
+        now = datetime.now(timezone.utc)
+        stories = filter_valid(
+            [
+                story
+                for story in await snapshot.aresolve(ids)
+                if now - story.time <= self.max_age
+            ]
+        )
+        with metrics.timer("hnread_stage_seconds", topic="keywords", stage="delivery"):
+            routed = await loop.run_in_executor(None, self._deliver, stories)
+        logger.info(f"Routed {routed} of {len(stories)} new stories to keywords")
+        return routed
 
 
 class BackgroundService:
     def __init__(
-        self, hn_repo: repos.HNRepository, pubsub_repo: repos.IPubSubRepository
+        self,
+        hn_repo: repos.HNRepository,
+        pubsub_repo: repos.IPubSubRepository,
+        retention: timedelta = timedelta(days=5),
     ) -> None:
         self.hn_repo = hn_repo
         self.pubsub_repo = pubsub_repo
+        self.retention = retention
 
     def reduce_published_set_size(self, topic: Topic):
-        self.pubsub_repo.set_topic(topic)
-        ids = self.pubsub_repo.get_published()
-        abandoned_items = items.PublishedItems(
-            self.hn_repo.ofIds(*ids)
-        ).abandoned_items()
-        if abandoned_items:
-            logger.info(f"Reduce {len(abandoned_items)} {topic} published items")
-            self.pubsub_repo.delete_published([i.id for i in abandoned_items])
+        oldest = datetime.now(timezone.utc) - self.retention
+        deleted = self.pubsub_repo.for_topic(topic).delete_published_before(
+            oldest.timestamp()
+        )
+        if deleted:
+            logger.info(f"Reduce {deleted} {topic} published items")
+
+    async def areduce_published_set_size(self, topic: Topic):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.reduce_published_set_size, topic)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import redis
+
+
+class ISnapshotStore(ABC):
+    """
+    Stores JSON serializable state by name.
+    """
+
+    @abstractmethod
+    def save(self, name: str, data: dict):
+        pass
+
+    @abstractmethod
+    def load(self, name: str) -> Optional[dict]:
+        pass
+
+
+class RedisSnapshotStore(ISnapshotStore):
+    def __init__(self, r: redis.Redis, prefix: str = "snapshot") -> None:
+        self.r = r
+        self.prefix = prefix
+
+    def _snapshot_key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    def save(self, name: str, data: dict):
+        self.r.set(self._snapshot_key(name), json.dumps(data))
+
+    def load(self, name: str) -> Optional[dict]:
+        if (raw := self.r.get(self._snapshot_key(name))) is None:
+            return None
+        return json.loads(raw)
+
+
+class FileSnapshotStore(ISnapshotStore):
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _snapshot_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json")
+
+    def save(self, name: str, data: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._snapshot_path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self, name: str) -> Optional[dict]:
+        try:
+            with open(self._snapshot_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
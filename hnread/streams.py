@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Union
+
+logger = logging.getLogger(__name__)
+
+
+class ServerSentEvent:
+    def __init__(self, event: str = "message", data: str = "") -> None:
+        self.event = event
+        self.data = data
+
+    def json(self) -> Any:
+        return json.loads(self.data)
+
+    def __repr__(self) -> str:
+        return f"ServerSentEvent(event={self.event!r}, data={self.data!r})"
+
+
+async def aiter_sse(lines: AsyncIterator[str]) -> AsyncIterator[ServerSentEvent]:
+    """
+    Parse a `text/event-stream` body, one event per blank line separated block.
+    """
+    event = "message"
+    data: List[str] = []
+    async for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield ServerSentEvent(event, "\n".join(data))
+            event, data = "message", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "event":
+            event = value
+        elif field == "data":
+            data.append(value)
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+class ListChange:
+    def __init__(
+        self, resource: str, ids: List[int], added: Set[int], removed: Set[int]
+    ):
+        self.resource = resource
+        self.ids = ids
+        self.added = added
+        self.removed = removed
+
+    def __repr__(self) -> str:
+        return (
+            f"ListChange(resource={self.resource!r}, added={len(self.added)}, "
+            f"removed={len(self.removed)})"
+        )
+
+
+class ListStream:
+    """
+    A live snapshot of a HN list endpoint, such as `topstories`, kept in sync
+    from the Firebase streaming API.
+
+    Firebase sends the whole list in a first `put` event, then `put` and
+    `patch` events for the positions that changed. Every change in list
+    membership is pushed as a ListChange to the subscribed queues. `ids` is
+    None while the stream is disconnected.
+    """
+
+    def __init__(
+        self,
+        resource: str,
+        connect: Callable[[str], AsyncIterator[ServerSentEvent]],
+        reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 60.0,
+    ) -> None:
+        self.resource = resource
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.ids: Optional[List[int]] = None
+        self._positions: Dict[int, Any] = {}
+        self._queues: List[asyncio.Queue] = []
+
+    def subscribe(self, queue: Optional[asyncio.Queue] = None) -> asyncio.Queue:
+        queue = queue if queue is not None else asyncio.Queue()
+        self._queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._queues.remove(queue)
+
+    def _set(self, path: str, value: Union[None, int, list, dict]):
+        index = path.strip("/")
+        if not index:
+            self._positions = {}
+            if isinstance(value, list):
+                self._positions = {i: id for i, id in enumerate(value) if id}
+            elif isinstance(value, dict):
+                self._positions = {int(i): id for i, id in value.items() if id}
+        elif value is None:
+            self._positions.pop(int(index), None)
+        else:
+            self._positions[int(index)] = value
+
+    def apply(self, event: ServerSentEvent) -> Optional[ListChange]:
+        if event.event in ("cancel", "auth_revoked"):
+            raise StreamCancelled(f"{self.resource} stream: {event.event}")
+        if event.event not in ("put", "patch"):
+            return None
+
+        payload = event.json()
+        if event.event == "put":
+            self._set(payload["path"], payload["data"])
+        else:
+            base = payload["path"].rstrip("/")
+            for index, value in payload["data"].items():
+                self._set(f"{base}/{index}", value)
+
+        old_ids = set(self.ids) if self.ids is not None else set()
+        self.ids = [int(self._positions[i]) for i in sorted(self._positions)]
+        new_ids = set(self.ids)
+        if new_ids == old_ids and old_ids:
+            return None
+        return ListChange(self.resource, self.ids, new_ids - old_ids, old_ids - new_ids)
+
+    async def run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async for event in self.connect(self.resource):
+                    if (change := self.apply(event)) is not None:
+                        for queue in self._queues:
+                            queue.put_nowait(change)
+                    delay = self.reconnect_delay
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"{self.resource} stream failed: {e!r}")
+            # Until the stream is back, list fetches poll instead of reading a
+            # snapshot that no longer follows the list.
+            self.ids = None
+            self._positions = {}
+            logger.info(f"Reconnect {self.resource} stream in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
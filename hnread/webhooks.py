@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import queue
+from typing import Dict, Optional, Tuple
+
+from telegram import Bot, Update
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+}
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates on an asyncio HTTP endpoint and puts them on
+    the dispatcher's `update_queue`.
+
+    Only POSTs to `path` carrying `secret_token`, when set, are accepted.
+    Connections are kept alive between updates and closed after `timeout`
+    seconds without a complete request.
+    """
+
+    def __init__(
+        self,
+        bot: Optional[Bot],
+        update_queue: queue.Queue,
+        path: str = "/telegram",
+        secret_token: Optional[str] = None,
+        host: str = "0.0.0.0",
+        port: int = 8443,
+        max_body_size: int = 1 << 20,
+        timeout: float = 60.0,
+    ) -> None:
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.max_body_size = max_body_size
+        self.timeout = timeout
+        self._port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> int:
+        if self._server is not None:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def astart(self) -> WebhookServer:
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self._port
+        )
+        logger.info(f"Webhook listening on port {self.port}")
+        return self
+
+    async def astop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return method, path, headers
+
+    def _put_update(self, body: bytes) -> int:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if (
+            not isinstance(data, dict)
+            or (update := Update.de_json(data, self.bot)) is None
+        ):
+            return 400
+        self.update_queue.put(update)
+        return 200
+
+    async def _handle_request(
+        self,
+        reader: asyncio.StreamReader,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+    ) -> int:
+        if "transfer-encoding" in headers:
+            return 411
+        length = int(headers.get("content-length", 0))
+        if length > self.max_body_size:
+            return 413
+        body = await reader.readexactly(length)
+
+        if path.split("?")[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token is not None and not hmac.compare_digest(
+            headers.get(SECRET_TOKEN_HEADER, ""), self.secret_token
+        ):
+            return 403
+        return self._put_update(body)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                request = await asyncio.wait_for(
+                    self._read_request(reader), self.timeout
+                )
+                if request is None:
+                    break
+                method, path, headers = request
+                status = await asyncio.wait_for(
+                    self._handle_request(reader, method, path, headers), self.timeout
+                )
+                metrics.increment("hnread_webhook_requests_total", status=str(status))
+                keep_alive = status not in (411, 413) and (
+                    headers.get("connection", "").lower() != "close"
+                )
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    "Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                    "\r\n".encode("latin-1")
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except ConnectionError:
+            logger.debug("Webhook connection lost")
+        finally:
+            writer.close()
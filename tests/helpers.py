@@ -0,0 +1,60 @@
+from time import time
+from typing import List, Optional
+
+import httpx
+
+from hnread import services
+
+
+class RecordingEventHandler(services.EventHandler):
+    def __init__(self) -> None:
+        self.sent: List[tuple] = []
+        self.digests: List[tuple] = []
+
+    def handle(self, subscribers, item):
+        for subscriber in subscribers:
+            self.sent.append((subscriber.id, item.id))
+
+    def handle_digest(self, subscribers, stories):
+        for subscriber in subscribers:
+            self.digests.append((subscriber.id, sorted(s.id for s in stories)))
+
+
+def story_data(id: int, score: Optional[int] = None, age: float = 0) -> dict:
+    """
+    A story posted `age` seconds ago, scored `id` unless given a `score`.
+    """
+    return {
+        "id": id,
+        "type": "story",
+        "by": "pg",
+        "time": int(time() - age),
+        "title": f"story {id}",
+        "score": id if score is None else score,
+        "descendants": 0,
+    }
+
+
+def hn_resource(request: httpx.Request) -> str:
+    """
+    The HN API resource requested, like "topstories" or "item/1".
+    """
+    return request.url.path.split("/v0/")[-1][: -len(".json")]
+
+
+def hn_item_id(request: httpx.Request) -> int:
+    return int(hn_resource(request).split("/")[-1])
+
+
+def hn_transport(topstories: List[int], newstories: List[int]) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        if resource == "topstories":
+            return httpx.Response(200, json=topstories)
+        elif resource == "newstories":
+            return httpx.Response(200, json=newstories)
+        elif resource == "beststories":
+            return httpx.Response(200, json=topstories)
+        return httpx.Response(200, json=story_data(hn_item_id(request)))
+
+    return httpx.MockTransport(handler)
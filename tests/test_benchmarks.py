@@ -0,0 +1,26 @@
+from benchmarks import bench_publish
+
+
+def test_run_benchmark():
+    report = bench_publish.run_benchmark(
+        stories=20, subscribers=3, cycles=2, threshold=0.0
+    )
+    assert report["failed_cycles"] == 0
+    assert report["sent"] == 2 * 20 * 3
+    assert report["p99"] >= report["p50"] > 0
+
+
+def test_run_benchmark_with_errors():
+    report = bench_publish.run_benchmark(
+        stories=20, subscribers=3, cycles=2, error_rate=1.0
+    )
+    assert report["errors"] == report["requests"] > 0
+    assert report["sent"] == 0
+
+
+def test_run_async_benchmark():
+    report = bench_publish.run_benchmark(
+        stories=20, subscribers=3, cycles=2, threshold=0.0, use_async=True
+    )
+    assert report["failed_cycles"] == 0
+    assert report["sent"] == 2 * 20 * 3
@@ -1,7 +1,7 @@
 from time import time
 
 from bot import BestStoriesEventHandler, TopStoriesEventHandler
-from hnread import items, repos
+from hnread import delivery, items, repos
 
 
 def test_top_story_display():
@@ -30,3 +30,33 @@ def test_top_story_display():
             id=0, title="", type=items.Type.story, time=time(), descendants=0, score=0
         ),
     )
+
+
+def test_handle_many_with_engine():
+    sent = []
+
+    class MockBot:
+        def send_message(self, id: int, text: str, parse_mode: str):
+            sent.append((id, text))
+
+    bot = MockBot()
+    engine = delivery.DeliveryEngine(
+        bot.send_message, global_rate=1000, per_chat_rate=1000
+    )
+    handler = TopStoriesEventHandler(bot, engine)
+    handler.handle_many(
+        [repos.Subscriber(id=0), repos.Subscriber(id=1)],
+        [
+            items.Story(
+                id=id,
+                title="",
+                type=items.Type.story,
+                time=time(),
+                descendants=0,
+                score=0,
+            )
+            for id in range(3)
+        ],
+    )
+    engine.close()
+    assert len(sent) == 6
@@ -0,0 +1,71 @@
+import threading
+import time
+from unittest import TestCase
+
+import fakeredis
+
+from hnread import caches
+
+
+def payload(id: int, age: float = 0) -> dict:
+    return {"id": id, "type": "story", "time": int(time.time() - age)}
+
+
+class LRUItemCacheTest(TestCase):
+    def test_evict_least_recently_used(self):
+        cache = caches.LRUItemCache(max_size=2)
+        cache.set(1, payload(1), ttl=60)
+        cache.set(2, payload(2), ttl=60)
+        cache.get(1)
+        cache.set(3, payload(3), ttl=60)
+        assert cache.get(1) is not None
+        assert cache.get(2) is None
+        assert len(cache) == 2
+
+    def test_expire(self):
+        cache = caches.LRUItemCache()
+        cache.set(1, payload(1), ttl=0)
+        assert cache.get(1) is None
+
+
+class ItemCacheTest(TestCase):
+    def test_stats(self):
+        cache = caches.ItemCache([caches.LRUItemCache()])
+        assert cache.get(1) is None
+        cache.set(1, payload(1))
+        assert cache.get(1) == payload(1)
+        assert cache.stats.hits == 1
+        assert cache.stats.misses == 1
+        assert cache.stats.hit_ratio() == 0.5
+
+    def test_stats_across_threads(self):
+        cache = caches.ItemCache([caches.LRUItemCache()])
+        cache.set(1, payload(1))
+
+        def get():
+            for _ in range(1000):
+                cache.get(1)
+                cache.get(2)
+
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert cache.stats.hits == cache.stats.misses == 4000
+
+    def test_backfill_faster_tier(self):
+        lru = caches.LRUItemCache()
+        redis_cache = caches.RedisItemCache(fakeredis.FakeRedis())
+        redis_cache.set(1, payload(1), ttl=60)
+        cache = caches.ItemCache([lru, redis_cache])
+        assert cache.get(1) == payload(1)
+        assert lru.get(1) == payload(1)
+
+
+def test_age_based_ttl():
+    assert caches.age_based_ttl(payload(1)) < caches.age_based_ttl(
+        payload(1, age=3 * 24 * 3600)
+    )
+    assert caches.age_based_ttl({"id": 1, "deleted": True}) == caches.MAX_TTL
+    assert caches.age_based_ttl({"id": 1}) < caches.MAX_TTL
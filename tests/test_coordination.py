@@ -0,0 +1,160 @@
+import asyncio
+import json
+
+import fakeredis
+import httpx
+import pytest
+
+from hnread import coordination, filters, repos, services
+from hnread.topics import Topic
+from tests.helpers import RecordingEventHandler, hn_item_id, hn_transport, story_data
+
+
+def test_leader_lease():
+    server = fakeredis.FakeServer()
+    a = coordination.Coordinator(fakeredis.FakeRedis(server=server), "a")
+    b = coordination.Coordinator(fakeredis.FakeRedis(server=server), "b")
+
+    assert a.is_leader(Topic.top)
+    assert a.is_leader(Topic.top)
+    assert not b.is_leader(Topic.top)
+    assert b.is_leader(Topic.best)
+
+    a.leave()
+    assert b.is_leader(Topic.top)
+    assert b.leading == {Topic.top, Topic.best}
+
+
+def test_replicas():
+    server = fakeredis.FakeServer()
+    a = coordination.Coordinator(fakeredis.FakeRedis(server=server), "a")
+    b = coordination.Coordinator(fakeredis.FakeRedis(server=server), "b")
+    a.join()
+    b.join()
+    assert a.replicas() == ["a", "b"]
+    b.leave()
+    assert a.replicas() == ["a"]
+
+
+def test_rendezvous_sharding():
+    replicas = ["a", "b", "c"]
+    owners = {id: coordination.rendezvous_owner(id, replicas) for id in range(300)}
+    assert set(owners.values()) == set(replicas)
+
+    moved = [
+        id
+        for id in range(300)
+        if coordination.rendezvous_owner(id, ["a", "b"]) != owners[id]
+    ]
+    assert all(owners[id] == "c" for id in moved)
+
+
+def test_replicas_deliver_each_story_once():
+    server = fakeredis.FakeServer()
+    pubsub = repos.RedisPubSubRepository(r=fakeredis.FakeRedis(server=server))
+    for id in range(20):
+        pubsub.for_topic(Topic.top).add_subscriber(id)
+
+    replicas = []
+    for replica_id in ["a", "b"]:
+        coordinator = coordination.Coordinator(
+            fakeredis.FakeRedis(server=server), replica_id
+        )
+        coordinator.join()
+        handler = RecordingEventHandler()
+        service = services.NHPublishService(
+            repos.HNRepository(transport=hn_transport([1, 2, 3], [])),
+            pubsub,
+            filters.NormalDistributionFilter(threshold=0),
+            coordinator=coordinator,
+        ).add_handler(Topic.top, handler)
+        replicas.append((service, handler))
+
+    async def publish():
+        for service, _ in replicas:
+            await service.apublish_stories(Topic.top)
+        for service, _ in replicas:
+            await service.apublish_stories(Topic.top)
+
+    asyncio.run(publish())
+
+    sent = [message for _, handler in replicas for message in handler.sent]
+    assert sorted(sent) == sorted(
+        (subscriber, story) for subscriber in range(20) for story in [1, 2, 3]
+    )
+    assert all(handler.sent for _, handler in replicas)
+
+
+def test_join_reads_positions_before_registering():
+    server = fakeredis.FakeServer()
+    leader = coordination.Coordinator(fakeredis.FakeRedis(server=server), "a")
+    leader.join()
+    replica = coordination.Coordinator(fakeredis.FakeRedis(server=server), "b")
+
+    heartbeat = replica.heartbeat
+
+    def announce_on_heartbeat():
+        heartbeat()
+        leader.announce(Topic.top, [1])
+
+    replica.heartbeat = announce_on_heartbeat
+    replica.join()
+    assert [batch[1:] for batch in replica.announced(Topic.top)] == [([1], ["a", "b"])]
+
+
+def test_announce_only_claimed_stories():
+    server = fakeredis.FakeServer()
+    pubsub = repos.BitmapPubSubRepository(r=fakeredis.FakeRedis(server=server))
+    pubsub.for_topic(Topic.top).mark_published([2])
+    leader = coordination.Coordinator(fakeredis.FakeRedis(server=server), "a")
+    leader.join()
+    service = services.NHPublishService(
+        repos.HNRepository(transport=hn_transport([1, 2, 3], [])),
+        pubsub,
+        filters.NormalDistributionFilter(threshold=0),
+        coordinator=leader,
+    ).add_handler(Topic.top, RecordingEventHandler())
+
+    asyncio.run(service.apublish_stories(Topic.top))
+    batches = leader.r.xrange(leader._batches_key(Topic.top))
+    assert [json.loads(fields[b"ids"]) for _, fields in batches] == [[1, 3]]
+
+
+def test_retry_failed_batches_without_dead_stories():
+    def handler(request: httpx.Request) -> httpx.Response:
+        data = story_data(hn_item_id(request))
+        if data["id"] == 2:
+            data["dead"] = True
+        return httpx.Response(200, json=data)
+
+    class FailingOnceEventHandler(RecordingEventHandler):
+        failures = 1
+
+        def handle_many(self, subscribers, stories):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("Telegram unreachable")
+            super().handle_many(subscribers, stories)
+
+    server = fakeredis.FakeServer()
+    pubsub = repos.RedisPubSubRepository(r=fakeredis.FakeRedis(server=server))
+    pubsub.for_topic(Topic.top).add_subscriber(10)
+    leader = coordination.Coordinator(fakeredis.FakeRedis(server=server), "a")
+    leader.join()
+    assert leader.is_leader(Topic.top)
+    follower = coordination.Coordinator(fakeredis.FakeRedis(server=server), "b")
+    follower.join()
+    leader.announce(Topic.top, [1, 2])
+    recorder = FailingOnceEventHandler()
+    service = services.NHPublishService(
+        repos.HNRepository(transport=httpx.MockTransport(handler)),
+        pubsub,
+        filters.NormalDistributionFilter(threshold=0),
+        coordinator=follower,
+    ).add_handler(Topic.top, recorder)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(service.apublish_stories(Topic.top))
+    asyncio.run(service.apublish_stories(Topic.top))
+    asyncio.run(service.apublish_stories(Topic.top))
+    assert recorder.sent == [(10, 1)]
@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import List, Tuple
+from unittest import TestCase
+
+from hnread import delivery
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(TestCase):
+    def test_reserve(self):
+        clock = FakeClock()
+        bucket = delivery.TokenBucket(rate=2, capacity=2, clock=clock)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0.5
+        clock.now = 1.5
+        assert bucket.reserve() == 0
+
+    def test_pause(self):
+        clock = FakeClock()
+        bucket = delivery.TokenBucket(rate=1, capacity=5, clock=clock)
+        bucket.pause(3)
+        assert bucket.reserve() == 4
+        assert not bucket.is_full()
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after: float) -> None:
+        self.retry_after = retry_after
+
+
+class FakeSender:
+    def __init__(self, fail_chats=(), rate_limited: int = 0) -> None:
+        self.sent: List[Tuple[int, str]] = []
+        self.fail_chats = fail_chats
+        self.rate_limited = rate_limited
+        self._lock = threading.Lock()
+
+    def __call__(self, chat_id: int, text: str, parse_mode: str = None):
+        with self._lock:
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise RetryAfter(0.01)
+            if chat_id in self.fail_chats:
+                raise ValueError("chat not found")
+            self.sent.append((chat_id, text))
+
+
+class DeliveryEngineTest(TestCase):
+    def messages(self, chats: int, texts: int) -> List[delivery.Message]:
+        return [
+            delivery.Message(chat_id, f"{i}", parse_mode="HTML")
+            for i in range(texts)
+            for chat_id in range(chats)
+        ]
+
+    def test_deliver_in_order_per_chat(self):
+        sender = FakeSender()
+        engine = delivery.DeliveryEngine(
+            sender, workers=4, global_rate=1000, per_chat_rate=1000
+        )
+        report = engine.deliver(self.messages(chats=10, texts=5))
+        engine.close()
+
+        assert report.sent == 50
+        for chat_id in range(10):
+            texts = [text for id, text in sender.sent if id == chat_id]
+            assert texts == ["0", "1", "2", "3", "4"]
+
+    def test_retry_after(self):
+        sender = FakeSender(rate_limited=2)
+        engine = delivery.DeliveryEngine(sender, global_rate=1000, per_chat_rate=1000)
+        report = engine.deliver(self.messages(chats=1, texts=2))
+
+        assert report.sent == 2
+        assert report.retried == 2
+        assert report.failed == 0
+
+    def test_failed(self):
+        sender = FakeSender(fail_chats={1})
+        engine = delivery.DeliveryEngine(sender, global_rate=1000, per_chat_rate=1000)
+        report = engine.deliver(self.messages(chats=3, texts=1))
+
+        assert report.sent == 2
+        assert report.failed == 1
+
+    def test_global_rate_limit(self):
+        sender = FakeSender()
+        engine = delivery.DeliveryEngine(
+            sender, workers=8, global_rate=100, per_chat_rate=1000
+        )
+        engine.global_bucket = delivery.TokenBucket(100, capacity=1)
+        started_at = time.monotonic()
+        engine.deliver(self.messages(chats=20, texts=1))
+
+        assert time.monotonic() - started_at >= 0.15
+
+    def test_throughput_follows_global_rate(self):
+        sender = FakeSender()
+        engine = delivery.DeliveryEngine(
+            sender, workers=2, global_rate=200, per_chat_rate=10
+        )
+        engine.global_bucket = delivery.TokenBucket(200, capacity=1)
+        report = engine.deliver(self.messages(chats=20, texts=5))
+        engine.close()
+
+        # Sending chat by chat, 2 workers would take 10 chats x 0.4s each.
+        assert report.sent == 100
+        assert report.elapsed < 1.5
+        for chat_id in range(20):
+            texts = [text for id, text in sender.sent if id == chat_id]
+            assert texts == ["0", "1", "2", "3", "4"]
@@ -0,0 +1,99 @@
+import asyncio
+import json
+from datetime import timedelta
+from typing import Dict, List, Set
+from unittest import IsolatedAsyncioTestCase
+
+import httpx
+
+from hnread import caches, feeds, repos
+from tests.helpers import hn_resource, story_data
+
+
+class FakeHN:
+    def __init__(self) -> None:
+        self.items: Dict[int, dict] = {}
+        self.updates: List[int] = []
+        self.item_requests: List[int] = []
+        self.errors: Set[int] = set()
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        if resource == "maxitem":
+            return httpx.Response(200, text=str(max(self.items)))
+        elif resource == "updates":
+            return httpx.Response(200, json={"items": self.updates, "profiles": []})
+        id = int(resource.split("/")[-1])
+        self.item_requests.append(id)
+        if id in self.errors:
+            return httpx.Response(503, json={"error": "Service Unavailable"})
+        return httpx.Response(200, content=json.dumps(self.items.get(id)))
+
+
+class ChangeFeedTest(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.hn = FakeHN()
+        self.hn.items = {id: story_data(id) for id in range(1, 6)}
+        self.hn_repo = repos.HNRepository(
+            transport=httpx.MockTransport(self.hn.handler)
+        )
+        self.feed = feeds.ChangeFeed(self.hn_repo)
+
+    async def asyncTearDown(self) -> None:
+        await self.hn_repo.aclose()
+
+    async def test_fetch_only_changes(self):
+        await self.feed.apoll()
+        stories = await self.feed.aofIds(1, 2, 3)
+        assert [s.id for s in stories] == [1, 2, 3]
+        assert sorted(self.hn.item_requests) == [1, 2, 3]
+
+        self.hn.item_requests.clear()
+        self.hn.items[2] = story_data(2, score=100)
+        self.hn.updates = [2, 5]
+        assert await self.feed.apoll() == {2}
+        stories = await self.feed.aofIds(1, 2, 3, 4)
+        assert sorted(self.hn.item_requests) == [2, 4]
+        assert stories[1].score == 100
+
+    async def test_refetch_stale_items(self):
+        self.feed.max_staleness = 0
+        await self.feed.aofIds(1)
+        await asyncio.sleep(0.01)
+        await self.feed.aofIds(1)
+        assert self.hn.item_requests == [1, 1]
+
+    async def test_missing_items_use_cache(self):
+        self.hn_repo.cache = caches.ItemCache([caches.LRUItemCache()])
+        await self.hn_repo.aitem_payload(1)
+        self.hn.item_requests.clear()
+
+        await self.feed.aofIds(1, 2)
+        assert self.hn.item_requests == [2]
+
+    async def test_skip_missing_items(self):
+        stories = await self.feed.aofIds(1, 42)
+        assert [s.id for s in stories] == [1]
+
+    async def test_skip_bad_items(self):
+        self.hn.errors = {2}
+        self.hn.items[3] = {"id": 3, "type": "story"}
+        stories = await self.feed.aofIds(1, 2, 3)
+        assert [s.id for s in stories] == [1]
+        assert 2 not in self.feed.store and 3 not in self.feed.store
+
+        self.hn.errors = set()
+        stories = await self.feed.aofIds(1, 2)
+        assert [s.id for s in stories] == [1, 2]
+
+
+def test_prune_idle_items():
+    now = [0.0]
+    store = feeds.ItemStore(clock=lambda: now[0])
+    store.put(1, story_data(1, age=3 * 24 * 3600))
+    store.put(2, story_data(2))
+    now[0] = 2 * 24 * 3600
+    assert store.get(1) is not None
+    now[0] = 2 * 24 * 3600 + 1
+    assert store.prune(timedelta(days=2)) == 1
+    assert 1 in store and 2 not in store
@@ -1,8 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from statistics import mean, variance
 from unittest import TestCase
 
 from hnread import filters
 from hnread.items import ScoreableItem, Type
+from hnread.topics import Topic
 
 
 class TestNormalDistributionFilter(TestCase):
@@ -15,3 +17,87 @@ class TestNormalDistributionFilter(TestCase):
         ]
         res = f(items)
         assert len(res) == 5
+
+
+class TestRunningStats(TestCase):
+    def test_window(self):
+        stats = filters.RunningStats(capacity=5)
+        for x in range(12):
+            stats.add(x)
+            window = stats.window()
+            assert len(stats) == len(window)
+            assert abs(stats.mean - mean(window)) < 1e-9
+            if len(window) > 1:
+                assert abs(stats.variance() - variance(window)) < 1e-9
+        assert stats.window() == [7, 8, 9, 10, 11]
+
+
+def test_filters_per_topic():
+    assert filters.norm_filters[Topic.top] is not filters.norm_filters[Topic.best]
+
+
+def test_equal_scores():
+    f = filters.NormalDistributionFilter()
+    items = [
+        ScoreableItem(id=0, type=Type.story, time=datetime.utcnow(), score=1)
+        for _ in range(3)
+    ]
+    assert f(items) == []
+
+
+def test_velocity_filter():
+    f = filters.VelocityFilter(min_velocity=10)
+    now = datetime.now(timezone.utc)
+    items = [
+        ScoreableItem(id=0, type=Type.story, time=now - timedelta(hours=10), score=50),
+        ScoreableItem(id=1, type=Type.story, time=now - timedelta(hours=1), score=50),
+    ]
+    assert [item.id for item in f(items)] == [1]
+    assert len(f.store) == 2
+
+
+class TestFilterSnapshot(TestCase):
+    def scored(self, scores):
+        return [
+            ScoreableItem(id=0, type=Type.story, time=datetime.utcnow(), score=score)
+            for score in scores
+        ]
+
+    def test_restore(self):
+        f = filters.NormalDistributionFilter(capacity=10)
+        f(self.scored(range(15)))
+
+        restored = filters.NormalDistributionFilter(capacity=10)
+        assert restored.restore(f.snapshot())
+        assert restored.stats.window() == f.stats.window()
+        assert restored.cutoff() == f.cutoff()
+        assert len(restored(self.scored([0]))) == 0
+
+    def test_restore_other_capacity(self):
+        f = filters.NormalDistributionFilter(capacity=10)
+        f(self.scored(range(10)))
+
+        restored = filters.NormalDistributionFilter(capacity=4)
+        assert restored.restore(f.snapshot())
+        assert restored.stats.window() == [6, 7, 8, 9]
+        assert restored.stats.mean == 7.5
+
+    def test_ignore_other_version(self):
+        f = filters.NormalDistributionFilter(capacity=10)
+        f(self.scored(range(5)))
+        snapshot = {**f.snapshot(), "version": filters.SNAPSHOT_VERSION + 1}
+
+        restored = filters.NormalDistributionFilter(capacity=10)
+        assert not restored.restore(snapshot)
+        assert len(restored.stats) == 0
+
+    def test_reset_after_bad_snapshot(self):
+        f = filters.NormalDistributionFilter(capacity=10)
+        snapshot = f.snapshot()
+        snapshot["stats"] = {"values": [1.0, 2.0]}
+
+        with self.assertRaises(KeyError):
+            f.restore(snapshot)
+        f.reset()
+        assert len(f.stats) == 0
+        assert f.stats.capacity == 10
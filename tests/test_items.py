@@ -10,3 +10,143 @@ def test_published_abandon():
     )
     published_items = items.PublishedItems([item1, item2])
     assert 1 == len(published_items.abandoned_items())
+
+
+def test_split_messages():
+    texts = ["a" * 10, "b" * 10, "c" * 10]
+    assert items.split_messages(texts, limit=21) == [
+        "a" * 10 + "\n" + "b" * 10,
+        "c" * 10,
+    ]
+    assert items.split_messages(texts, limit=100) == ["\n".join(texts)]
+    assert items.split_messages(["d" * 30], limit=21) == ["d" * 20 + "…"]
+    assert items.split_messages([]) == []
+
+
+def test_truncate_html():
+    text = '<a href="https://x.y"><b>Rust &amp; C</b></a>\n<i>pg</i>: text'
+    assert items.truncate_html(text, 100) == text
+    assert items.truncate_html(text, 36) == '<a href="https://x.y"><b>Ru…</b></a>'
+    assert items.truncate_html(text, 43) == '<a href="https://x.y"><b>Rust …</b></a>'
+    assert items.truncate_html(text, 44) == (
+        '<a href="https://x.y"><b>Rust &amp;…</b></a>'
+    )
+    for limit in range(len(text)):
+        cut = items.truncate_html(text, limit)
+        assert len(cut) <= limit or cut == "…"
+        assert cut.count("<b>") == cut.count("</b>")
+        assert cut.count("<a ") == cut.count("</a>")
+
+
+def test_display_cache():
+    cache = items.DisplayCache(max_size=2)
+    story = items.Story(
+        id=1,
+        title="title",
+        type=items.Type.story,
+        time=datetime.now(timezone.utc) - timedelta(hours=3),
+        descendants=0,
+        score=10,
+    )
+    text = cache.render(items.TopStoryDisplay, story)
+    assert text == str(items.TopStoryDisplay(story))
+    assert cache.render(items.TopStoryDisplay, story) is text
+    assert "Best" in cache.render(items.BestStoryDisplay, story)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    story.score = 11
+    assert "11 points" in cache.render(items.TopStoryDisplay, story)
+    assert len(cache._texts) == 2
+
+
+def test_lazy_item_factory():
+    data = {
+        "id": 1,
+        "type": "story",
+        "by": "pg",
+        "time": int((datetime.now(timezone.utc) - timedelta(hours=3)).timestamp()),
+        "title": "title",
+        "score": 10,
+        "descendants": 2,
+        "kids": [2, 3],
+        "url": "https://example.com",
+    }
+    record = items.LazyItemFactory().from_dict(data)
+    assert isinstance(record, items.ItemRecord)
+    assert (record.id, record.type, record.score) == (1, items.Type.story, 10)
+    assert record.time == items.ItemFactory().from_dict(data).time
+    assert record._model is None
+
+    assert record.kids == [2, 3]
+    assert isinstance(record.model(), items.Story)
+    assert str(items.TopStoryDisplay(record)) == str(
+        items.TopStoryDisplay(items.ItemFactory().from_dict(data))
+    )
+
+    comment = items.LazyItemFactory().from_dict(
+        {"id": 2, "type": "comment", "time": data["time"], "parent": 1, "text": "t"}
+    )
+    assert not hasattr(comment, "score")
+    deleted = items.LazyItemFactory().from_dict({**data, "deleted": True})
+    assert isinstance(deleted, items.DeletedItem)
+
+
+def test_comment_previews():
+    story = items.Story(
+        id=100,
+        title="title",
+        type=items.Type.story,
+        time=datetime.now(timezone.utc),
+        descendants=1,
+        score=10,
+    )
+    comment = items.Comment(
+        id=101,
+        type=items.Type.comment,
+        by="pg",
+        time=datetime.now(timezone.utc),
+        parent=100,
+        text='Use <i>a &lt; b</i><p>See <a href="https://x.y">this</a>',
+    )
+    cache = items.DisplayCache()
+    without_preview = cache.render(items.TopStoryDisplay, story)
+
+    items.comment_previews.set(story.id, 1, [comment])
+    try:
+        assert items.comment_previews.fresh(story.id, 1)
+        assert not items.comment_previews.fresh(story.id, 2)
+        text = cache.render(items.TopStoryDisplay, story)
+        assert text != without_preview
+        assert text.endswith("<i>pg</i>: Use a &lt; b See this\n")
+    finally:
+        items.comment_previews = items.CommentPreviews()
+
+    assert items.comment_snippet(comment, limit=8) == "Use a &lt;…"
+
+
+def test_comment_previews_escape_authors():
+    story = items.Story(
+        id=200,
+        title="title",
+        type=items.Type.story,
+        time=datetime.now(timezone.utc),
+        descendants=2,
+        score=10,
+    )
+    comments = [
+        items.Comment(
+            id=id,
+            type=items.Type.comment,
+            by=by,
+            time=datetime.now(timezone.utc),
+            parent=200,
+            text="text",
+        )
+        for id, by in [(201, None), (202, "<b>x&y")]
+    ]
+    items.comment_previews.set(story.id, 2, comments)
+    try:
+        text = items.TopStoryDisplay(story).render()
+        assert text.endswith("</a>\n<i>&lt;b&gt;x&amp;y</i>: text\n")
+    finally:
+        items.comment_previews = items.CommentPreviews()
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+
+import pytest
+
+from hnread import loops
+
+
+def test_run_on_loop_thread():
+    async def current_thread():
+        await asyncio.sleep(0)
+        return threading.current_thread().name
+
+    with loops.EventLoopThread(name="test-loop") as event_loop:
+        assert event_loop.run(current_thread()) == "test-loop"
+        assert event_loop.run(current_thread()) == "test-loop"
+    assert not event_loop.is_running()
+
+
+def test_shared_loop():
+    async def running_loop():
+        return asyncio.get_running_loop()
+
+    with loops.EventLoopThread() as event_loop:
+        assert event_loop.run(running_loop()) is event_loop.run(running_loop())
+
+
+def test_submit_before_start():
+    event_loop = loops.EventLoopThread()
+
+    async def noop():
+        pass
+
+    coro = noop()
+    with pytest.raises(RuntimeError):
+        event_loop.submit(coro)
+    coro.close()
@@ -0,0 +1,85 @@
+import urllib.request
+from typing import List
+
+import fakeredis
+import httpx
+
+from hnread import metrics, repos, services
+from hnread.topics import Topic
+
+
+class RecordingEventHandler(services.EventHandler):
+    def __init__(self) -> None:
+        self.sent: List[int] = []
+
+    def handle(self, subscribers, item):
+        self.sent.append(item.id)
+
+
+def test_render():
+    sink = metrics.PrometheusSink(buckets=(0.1, 1.0))
+    sink.increment("messages_total", 2, topic="top", status="sent")
+    sink.increment("messages_total", topic="top", status="sent")
+    sink.set_gauge("pending", 3)
+    sink.observe("stage_seconds", 0.05, stage="filter")
+    sink.observe("stage_seconds", 0.5, stage="filter")
+    sink.observe("stage_seconds", 5, stage="filter")
+
+    lines = sink.render().splitlines()
+    assert 'messages_total{topic="top",status="sent"} 3.0' in lines
+    assert "pending 3" in lines
+    assert 'stage_seconds_bucket{stage="filter",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="filter",le="1.0"} 2' in lines
+    assert 'stage_seconds_bucket{stage="filter",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="filter"} 3' in lines
+
+
+def test_publish_stories_metrics():
+    sink = metrics.PrometheusSink()
+    metrics.set_sink(sink)
+    try:
+        r = metrics.InstrumentedRedis(
+            connection_pool=fakeredis.FakeRedis().connection_pool
+        )
+        pubsub_repo = repos.RedisPubSubRepository(r=r)
+        pubsub_repo.for_topic(Topic.top).add_subscriber(1)
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.endswith("stories.json"):
+                return httpx.Response(200, json=[])
+            return httpx.Response(404)
+
+        hn_repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+        services.NHPublishService(
+            hn_repo, pubsub_repo, lambda items: items
+        ).add_handler(Topic.top, RecordingEventHandler()).publish_stories(Topic.top)
+        hn_repo.close()
+    finally:
+        metrics.set_sink(metrics.NullSink())
+
+    stages = {
+        dict(labels)["stage"] for labels in sink.histograms["hnread_stage_seconds"]
+    }
+    assert {"list_fetch", "membership_check", "item_fetch", "filter"} <= stages
+    assert (("topic", Topic.top.value),) in sink.histograms["hnread_cycle_seconds"]
+    endpoints = {
+        dict(labels)["endpoint"]
+        for labels in sink.histograms["hnread_hn_request_seconds"]
+    }
+    assert endpoints == {"topstories", "newstories"}
+    commands = {
+        dict(labels)["command"] for labels in sink.histograms["hnread_redis_op_seconds"]
+    }
+    assert {"PIPELINE", "SMEMBERS"} <= commands
+
+
+def test_metrics_server():
+    sink = metrics.PrometheusSink()
+    sink.increment("requests_total")
+    server = metrics.MetricsServer(sink, host="127.0.0.1", port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as resp:
+            assert "requests_total 1.0" in resp.read().decode()
+    finally:
+        server.stop()
@@ -0,0 +1,102 @@
+import fakeredis
+
+from hnread import delivery, outbox
+
+
+class FlakyBot:
+    def __init__(self, failing_chat_ids=()) -> None:
+        self.failing_chat_ids = set(failing_chat_ids)
+        self.sent = []
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        if chat_id in self.failing_chat_ids:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+        self.sent.append((chat_id, text, kwargs))
+
+
+def build(bot: FlakyBot, **kwargs):
+    box = outbox.Outbox(fakeredis.FakeRedis(), **kwargs)
+    box.create_group()
+    box.create_group()
+    engine = delivery.DeliveryEngine(bot.send_message, workers=2, global_rate=1000)
+    return box, outbox.OutboxWorker(box, engine, "worker-0", block=0)
+
+
+def test_deliver_and_ack():
+    bot = FlakyBot()
+    box, worker = build(bot)
+    box.enqueue(
+        [delivery.Message(1, "a", parse_mode="HTML"), delivery.Message(2, "b")],
+        topic="topstories",
+    )
+    assert box.backlog()["lag"] == 2
+
+    assert worker.run_once() == 2
+    assert sorted(bot.sent) == [(1, "a", {"parse_mode": "HTML"}), (2, "b", {})]
+    assert box.backlog() == {"lag": 0, "pending": 0, "dead": 0}
+    assert worker.run_once() == 0
+
+
+def test_retry_then_dead_letter():
+    bot = FlakyBot(failing_chat_ids=[2])
+    box, worker = build(bot, min_idle=0, max_attempts=2)
+    box.enqueue([delivery.Message(1, "a"), delivery.Message(2, "b")])
+
+    assert worker.run_once() == 2
+    assert box.backlog()["pending"] == 1
+
+    assert worker.run_once() == 1
+    assert box.backlog() == {"lag": 0, "pending": 0, "dead": 1}
+    assert bot.sent == [(1, "a", {})]
+
+
+def test_reclaim_from_crashed_consumer():
+    bot = FlakyBot()
+    box, worker = build(bot, min_idle=0)
+    box.enqueue([delivery.Message(1, "a")])
+    assert len(box.read("crashed-worker")) == 1
+
+    assert worker.run_once() == 1
+    assert bot.sent == [(1, "a", {})]
+    assert box.backlog()["pending"] == 0
+
+
+def test_dead_letter_permanent_errors():
+    bot = FlakyBot(failing_chat_ids=[2])
+    box, _ = build(bot, max_attempts=5)
+    engine = delivery.DeliveryEngine(bot.send_message, workers=2, global_rate=1000)
+    worker = outbox.OutboxWorker(
+        box, engine, "worker-0", block=0, permanent_errors=(RuntimeError,)
+    )
+    box.enqueue([delivery.Message(1, "a"), delivery.Message(2, "b")])
+
+    assert worker.run_once() == 2
+    assert box.backlog() == {"lag": 0, "pending": 0, "dead": 1}
+
+
+def test_dead_letter_malformed_jobs():
+    bot = FlakyBot()
+    box, worker = build(bot)
+    box.r.xadd(box.stream, {"chat_id": 1, "text": "a", "kwargs": "{"})
+    box.enqueue([delivery.Message(2, "b")])
+
+    assert worker.run_once() == 1
+    assert bot.sent == [(2, "b", {})]
+    assert box.backlog() == {"lag": 0, "pending": 0, "dead": 1}
+
+
+def test_worker_survives_errors():
+    class BrokenEngine:
+        def deliver(self, messages):
+            raise RuntimeError("boom")
+
+    box = outbox.Outbox(fakeredis.FakeRedis())
+    box.create_group()
+    box.enqueue([delivery.Message(1, "a")])
+    worker = outbox.OutboxWorker(box, BrokenEngine(), "worker-0", block=0.01)
+    worker.start()
+    try:
+        worker._stop.wait(0.1)
+        assert worker._thread.is_alive()
+    finally:
+        worker.stop()
@@ -1,8 +1,17 @@
+import asyncio
+import threading
+from datetime import datetime
+from time import time
+from typing import List
 from unittest import IsolatedAsyncioTestCase, TestCase
 
+import fakeredis
+import httpx
 import pytest
 
-from hnread import repos
+from hnread import caches, items, repos
+from hnread.topics import Topic
+from tests.helpers import hn_item_id, hn_resource, story_data
 
 
 @pytest.mark.slow
@@ -46,3 +55,349 @@ class HNRepositoryAsyncTest(IsolatedAsyncioTestCase):
         max_id = self.repo.max_id()
         item = await self.repo.aofId(max_id)
         assert item.id
+
+
+class HNRepositoryClientTest(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.requests = 0
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            return httpx.Response(200, json=story_data(hn_item_id(request)))
+
+        self.repo = repos.HNRepository(
+            max_in_flight=3, transport=httpx.MockTransport(handler)
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.repo.aclose()
+
+    async def test_reuse_client(self):
+        await self.repo.aofId(1)
+        client = self.repo.aclient
+        await self.repo.aofId(2)
+        assert client is self.repo.aclient
+
+    async def test_bounded_in_flight(self):
+        stories = await self.repo.aofIds(*range(10))
+        assert [s.id for s in stories] == list(range(10))
+        assert self.max_in_flight == 3
+
+    async def test_single_flight(self):
+        stories = await asyncio.gather(*[self.repo.aofId(1) for _ in range(5)])
+        assert {s.id for s in stories} == {1}
+        assert self.requests == 1
+
+    async def test_cache(self):
+        self.repo.cache = caches.ItemCache([caches.LRUItemCache()])
+        await self.repo.aofIds(1, 2)
+        await self.repo.aofIds(1, 2, 3)
+        assert self.requests == 3
+        assert self.repo.cache.stats.hits == 2
+
+    async def test_blocking_cache_off_loop(self):
+        class RedisCache(caches.RedisItemCache):
+            def get(self, id: int):
+                threads.add(threading.get_ident())
+                return super().get(id)
+
+        threads = set()
+        self.repo.cache = caches.ItemCache([RedisCache(fakeredis.FakeRedis())])
+        await self.repo.aofIds(1, 2)
+        await self.repo.aofIds(1, 2)
+        assert self.requests == 2
+        assert threads and threading.get_ident() not in threads
+
+    async def test_aclose(self):
+        await self.repo.aofId(1)
+        await self.repo.aclose()
+        assert not self.repo._loop_states
+
+
+def test_sync_client_lifecycle():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, text="42"))
+    with repos.HNRepository(transport=transport) as repo:
+        assert repo.max_id() == 42
+        assert repo.max_id() == 42
+        assert repo._client is not None
+    assert repo._client is None
+
+
+def test_error_responses_are_not_cached():
+    responses = [httpx.Response(503, json={"error": "Service Unavailable"})]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return responses.pop() if responses else httpx.Response(200, json=story_data(1))
+
+    repo = repos.HNRepository(
+        transport=httpx.MockTransport(handler),
+        cache=caches.ItemCache([caches.LRUItemCache()]),
+    )
+    with pytest.raises(httpx.HTTPStatusError):
+        repo.ofIds(1)
+    assert repo.cache.get(1) is None
+    assert [story.id for story in repo.ofIds(1)] == [1]
+    assert repo.cache.get(1)["id"] == 1
+
+
+class RedisPubSubRepositoryTest(TestCase):
+    def setUp(self) -> None:
+        self.repo = repos.RedisPubSubRepository(
+            topic=Topic.top, r=fakeredis.FakeRedis()
+        )
+
+    def test_claim_unpublished(self):
+        self.repo.mark_published([1])
+        assert self.repo.claim_unpublished([1, 2, 3]) == [2, 3]
+        assert self.repo.claim_unpublished([2, 3, 4]) == [4]
+        assert self.repo.claim_unpublished([]) == []
+        assert sorted(self.repo.get_published()) == [1, 2, 3, 4]
+
+    def test_subscribers(self):
+        self.repo.add_subscriber(1)
+        assert [s.id for s in self.repo.get_subscribers()] == [1]
+        assert self.repo.subscribed_topics(1) == [Topic.top]
+        self.repo.remove_subscriber(1)
+        assert self.repo.get_subscribers() == []
+        assert self.repo.subscribed_topics(1) == []
+
+    def test_delete_published_before(self):
+        self.repo.mark_published([1, 2, 3], [100, 200, 300])
+        assert self.repo.claim_unpublished([3, 4], [300, 400]) == [4]
+        assert self.repo.delete_published_before(300) == 2
+        assert sorted(self.repo.get_published()) == [3, 4]
+
+    def test_migrate_published(self):
+        self.repo.r.sadd(self.repo._published_set_key(), 1, 2)
+        assert self.repo.migrate_published() == 2
+        assert self.repo.has_published([1, 2, 3]) == [1, 2]
+        assert not self.repo.r.exists(self.repo._published_set_key())
+
+    def test_for_topic(self):
+        best = self.repo.for_topic(Topic.best)
+        best.mark_published([1])
+        assert best.r is self.repo.r
+        assert self.repo.topic == Topic.top
+        assert self.repo.has_not_published([1]) == [1]
+        assert best.has_not_published([1]) == []
+
+
+def test_shared_connection_pool():
+    url = "redis://localhost:6379/15"
+    assert repos.connection_pool(url) is repos.connection_pool(url)
+    assert (
+        repos.RedisPubSubRepository(url).r.connection_pool
+        is repos.RedisPubSubRepository(url).r.connection_pool
+    )
+
+
+class BitmapPubSubRepositoryTest(TestCase):
+    def setUp(self) -> None:
+        self.repo = repos.BitmapPubSubRepository(
+            topic=Topic.top, r=fakeredis.FakeRedis(), segment_size=64
+        )
+
+    def test_published(self):
+        assert self.repo.empty_published()
+        self.repo.mark_published([1, 70, 200])
+        assert self.repo.has_not_published([1, 2, 70, 200, 201]) == [2, 201]
+        assert self.repo.has_published([1, 2, 70]) == [1, 70]
+        assert self.repo.claim_unpublished([1, 2, 2, 3]) == [2, 3]
+        assert sorted(self.repo.get_published()) == [1, 2, 3, 70, 200]
+        self.repo.delete_published([2])
+        assert sorted(self.repo.get_published()) == [1, 3, 70, 200]
+        self.repo.clear_published()
+        assert self.repo.empty_published()
+
+    def test_delete_published_before(self):
+        self.repo.mark_published([1, 2, 70, 130], [100, 200, 100, 300])
+        assert self.repo.delete_published_before(250) == 3
+        assert self.repo.get_published() == [130]
+
+    def test_migrate_published(self):
+        legacy = repos.RedisPubSubRepository(topic=Topic.top, r=self.repo.r)
+        legacy.mark_published([5, 6], [100, 200])
+        self.repo.r.sadd(legacy._published_set_key(), 7)
+        assert self.repo.migrate_published() == 3
+        assert sorted(self.repo.get_published()) == [5, 6, 7]
+        assert legacy.empty_published()
+
+    def test_for_topic(self):
+        best = self.repo.for_topic(Topic.best)
+        best.mark_published([1])
+        assert best.segment_size == 64
+        assert self.repo.has_not_published([1]) == [1]
+
+
+def test_asnapshot():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        requests.append(resource)
+        return httpx.Response(200, json=[1, 2])
+
+    async def fetch(*ids):
+        fetched.extend(ids)
+        return [
+            items.ScoreableItem(id=id, type="story", time=datetime.now(), score=1)
+            for id in ids
+        ]
+
+    fetched = []
+    repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+
+    async def snapshots():
+        first, second = await asyncio.gather(
+            repo.asnapshot("topstories", "newstories", afetch=fetch),
+            repo.asnapshot("newstories", "topstories", afetch=fetch),
+        )
+        assert first is second
+        assert first.ids("topstories") == [1, 2]
+        assert [item.id for item in await first.aresolve([1, 2])] == [1, 2]
+        assert [item.id for item in await first.aresolve([2])] == [2]
+
+        assert await repo.asnapshot("topstories", "newstories", max_age=60) is first
+        assert await repo.asnapshot("topstories", "newstories") is not first
+        newest = await repo.asnapshot("newstories", max_age=60)
+        assert newest.ids("newstories") == [1, 2]
+        await repo.aclose()
+
+    asyncio.run(snapshots())
+    assert sorted(requests) == ["newstories", "newstories", "topstories", "topstories"]
+    assert fetched == [1, 2]
+
+
+def test_keyword_index():
+    index = repos.KeywordIndex(["rust", "he", "she", "hers", "rust compiler"])
+
+    assert index.find("a new rust compiler") == {"rust", "rust compiler"}
+    assert index.find("she sells") == {"she"}
+    assert index.find("ushers trust rusty") == set()
+    assert index.find("hers, he said") == {"hers", "he"}
+
+    index.remove("rust")
+    index.add("go")
+    assert len(index) == 5
+    assert index.find("rust and go") == {"go"}
+    assert "rust" not in index and "go" in index
+
+
+def test_keyword_index_rebuilds_trie():
+    index = repos.KeywordIndex(f"keyword{i}" for i in range(100))
+    for i in range(90):
+        index.remove(f"keyword{i}")
+
+    assert len(index._goto) < 100
+    assert index.find("keyword95 keyword5") == {"keyword95"}
+
+
+def test_keyword_repository():
+    server = fakeredis.FakeServer()
+    repo = repos.RedisKeywordRepository(r=fakeredis.FakeRedis(server=server))
+    other = repos.RedisKeywordRepository(r=fakeredis.FakeRedis(server=server))
+    other.refresh()
+
+    assert repo.add_keyword(1, "  Rust ") == "rust"
+    assert repo.add_keyword(2, "site:https://www.GitHub.com/") == "site:github.com"
+    repo.add_keyword(2, "rust")
+    other.refresh()
+
+    assert other.match("Rust in the kernel") == {1: ["rust"], 2: ["rust"]}
+    assert other.match("Show HN", "https://blog.github.com/post") == {
+        2: ["site:github.com"]
+    }
+    assert other.match("A rusty nail", "https://example.com") == {}
+    assert repo.subscribed_keywords(2) == ["rust", "site:github.com"]
+
+    assert repo.remove_keyword(1, "rust") == "rust"
+    assert repo.remove_keyword(2, "RUST") == "rust"
+    assert repo.remove_keyword(2, "rust") is None
+    assert repo.remove_keyword(3, "site:github.com") is None
+    other.refresh()
+    assert other.match("Rust in the kernel") == {}
+    assert repo.r.smembers("keywords") == {b"site:github.com"}
+
+    fresh = repos.RedisKeywordRepository(r=fakeredis.FakeRedis(server=server))
+    fresh.load()
+    assert fresh.subscribers == {"site:github.com": {2}}
+
+
+def test_keyword_repository_reloads_trimmed_changes():
+    server = fakeredis.FakeServer()
+    repo = repos.RedisKeywordRepository(
+        r=fakeredis.FakeRedis(server=server), max_changes=2
+    )
+    repo.refresh()
+    for i in range(4):
+        repo.add_keyword(i, f"keyword{i}")
+    repo.refresh()
+
+    assert sorted(repo.subscribers) == [f"keyword{i}" for i in range(4)]
+
+
+def test_keyword_repository_claim_unrouted():
+    repo = repos.RedisKeywordRepository(r=fakeredis.FakeRedis())
+
+    assert repo.claim_unrouted([1, 2], [100.0, 200.0]) == [1, 2]
+    assert repo.claim_unrouted([2, 3], [200.0, 300.0]) == [3]
+    assert repo.has_not_routed([1, 4]) == [4]
+    assert repo.delete_routed_before(250.0) == 2
+    assert repo.has_not_routed([1, 3]) == [1]
+
+
+def comment_tree_transport(requested: List[int], delay: float = 0.0):
+    kids = {1: [2, 3, 4, 5], 2: [6, 7, 8], 4: [9]}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        id = hn_item_id(request)
+        requested.append(id)
+        if id >= 6:
+            await asyncio.sleep(delay)
+        data = {"id": id, "type": "comment", "by": "pg", "time": int(time())}
+        if id == 1:
+            data.update(type="story", title="story", score=1, descendants=8)
+        elif id == 3:
+            data["deleted"] = True
+        else:
+            data.update(parent=1, text=f"comment {id}")
+        data["kids"] = kids.get(id, [])
+        return httpx.Response(200, json=data)
+
+    return httpx.MockTransport(handler)
+
+
+def test_acomment_trees():
+    requested: List[int] = []
+    repo = repos.HNRepository(
+        transport=comment_tree_transport(requested),
+        cache=caches.ItemCache([caches.LRUItemCache()]),
+    )
+
+    trees = asyncio.run(
+        repo.acomment_trees({1: [2, 3, 4, 5]}, max_depth=2, max_fanout=2)
+    )
+    assert [c.id for c in trees[1]] == [2, 6, 7]
+    assert all(isinstance(c, items.Comment) for c in trees[1])
+    assert sorted(requested) == [2, 3, 6, 7]
+
+    requested.clear()
+    trees = asyncio.run(repo.acomment_trees({1: [2, 3, 4, 5]}, max_fanout=3))
+    assert [c.id for c in trees[1]] == [2, 4]
+    assert requested == [4]
+
+
+def test_acomment_trees_deadline():
+    repo = repos.HNRepository(transport=comment_tree_transport([], delay=1.0))
+
+    trees = asyncio.run(
+        repo.acomment_trees({1: [2, 3, 4, 5]}, max_depth=2, deadline=0.2)
+    )
+    assert [c.id for c in trees[1]] == [2, 4]
@@ -0,0 +1,72 @@
+import asyncio
+
+from hnread import schedulers
+from hnread.topics import Topic
+
+
+def test_adaptive_interval():
+    interval = schedulers.AdaptiveInterval(60, 30, 120, jitter=0.0)
+    assert interval.update(None, 1.0) == 60
+    assert interval.update(0, 1.0) == 90
+    assert interval.update(0, 1.0) == 120
+    assert interval.update(0, 1.0) == 120
+    assert interval.update(2, 1.0) == 120
+    assert interval.update(10, 1.0) == 80
+    assert round(interval.update(10, 1.0), 2) == 53.33
+    assert interval.update(10, 200.0) == 200
+
+
+def test_adaptive_interval_bounds_and_jitter():
+    interval = schedulers.AdaptiveInterval(60, 30, 120, jitter=0.1, random=lambda: 1.0)
+    for _ in range(10):
+        interval.update(10, 0.0)
+    assert interval.interval == 30
+    assert round(interval.update(10, 0.0), 6) == 33
+
+
+def test_runs_do_not_overlap_and_triggers_coalesce():
+    async def run():
+        running = 0
+        runs = []
+
+        async def publish(topic: Topic):
+            nonlocal running
+            running += 1
+            assert running == 1
+            runs.append(topic)
+            await asyncio.sleep(0.05)
+            running -= 1
+            return 0
+
+        scheduler = schedulers.PublishScheduler(
+            publish, {Topic.top: schedulers.AdaptiveInterval(10, 0, 10, jitter=0.0)}
+        )
+        task = asyncio.ensure_future(scheduler.arun())
+        await asyncio.sleep(0.01)
+        for _ in range(5):
+            scheduler.trigger(Topic.top)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        return runs
+
+    assert asyncio.run(run()) == [Topic.top, Topic.top]
+
+
+def test_failed_run_keeps_scheduling():
+    async def run():
+        runs = 0
+
+        async def publish(topic: Topic):
+            nonlocal runs
+            runs += 1
+            raise RuntimeError()
+
+        scheduler = schedulers.PublishScheduler(
+            publish, {Topic.top: schedulers.AdaptiveInterval(0, 0, 0, jitter=0.0)}
+        )
+        task = asyncio.ensure_future(scheduler.arun())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return runs
+
+    assert asyncio.run(run()) > 1
@@ -0,0 +1,47 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from hnread import series
+from hnread.items import Story, Type
+
+
+def story(id: int, score: int, age: timedelta = timedelta(hours=1)) -> Story:
+    return Story(
+        id=id,
+        type=Type.story,
+        time=datetime.now(timezone.utc) - age,
+        title="",
+        descendants=score // 2,
+        score=score,
+    )
+
+
+def test_ring():
+    s = series.ScoreSeries(max_points=3)
+    for i in range(5):
+        s.append(i, i * 10, i)
+    assert len(s) == 3
+    assert s.first() == (2, 20, 2)
+    assert s.last() == (4, 40, 4)
+    assert s.points() == [(2, 20, 2), (3, 30, 3), (4, 40, 4)]
+
+
+def test_record():
+    store = series.ScoreSeriesStore(max_items=2, min_interval=10)
+    store.record([story(1, 10), story(2, 10)], now=100)
+    store.record([story(1, 20)], now=105)
+    store.record([story(1, 30), story(3, 1)], now=120)
+    assert len(store) == 2
+    assert store.get(2) is None
+    assert store.get(1).points() == [(100, 10, 5), (120, 30, 15)]
+
+
+def test_velocity():
+    store = series.ScoreSeriesStore()
+    now = time.time()
+    assert round(store.velocity(story(1, 11), now), 3) == 10
+    assert store.velocity(story(2, 11, age=timedelta(minutes=1)), now) == 20
+
+    store.record([story(1, 11)], now=now)
+    store.record([story(1, 41)], now=now + 1800)
+    assert store.velocity(story(1, 41), now + 1800) == 60
@@ -0,0 +1,286 @@
+import asyncio
+from datetime import timedelta
+from time import time
+
+import fakeredis
+import httpx
+import pytest
+
+from hnread import filters, items, repos, services
+from hnread.topics import Topic
+from tests.helpers import (
+    RecordingEventHandler,
+    hn_item_id,
+    hn_resource,
+    hn_transport,
+    story_data,
+)
+
+
+def pubsub_repo() -> repos.RedisPubSubRepository:
+    return repos.RedisPubSubRepository(r=fakeredis.FakeRedis())
+
+
+def test_apublish_stories():
+    hn_repo = repos.HNRepository(transport=hn_transport([1, 2, 3, 4], [4]))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.top).add_subscriber(10)
+    handler = RecordingEventHandler()
+    service = services.NHPublishService(
+        hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+    ).add_handler(Topic.top, handler)
+
+    assert asyncio.run(service.apublish_stories(Topic.top)) is None
+
+    assert sorted(handler.sent) == [(10, 1), (10, 2), (10, 3)]
+    assert sorted(pubsub.for_topic(Topic.top).get_published()) == [1, 2, 3]
+
+    handler.sent.clear()
+    assert asyncio.run(service.apublish_stories(Topic.top)) == 0
+    assert handler.sent == []
+
+
+def test_apublish_stories_claims_after_delivery():
+    class FailingOnceEventHandler(RecordingEventHandler):
+        failures = 1
+
+        def handle_many(self, subscribers, stories):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("outbox unreachable")
+            super().handle_many(subscribers, stories)
+
+    hn_repo = repos.HNRepository(transport=hn_transport([1, 2], []))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.top).add_subscriber(10)
+    handler = FailingOnceEventHandler()
+    service = services.NHPublishService(
+        hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+    ).add_handler(Topic.top, handler)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(service.apublish_stories(Topic.top))
+    assert pubsub.for_topic(Topic.top).get_published() == []
+
+    asyncio.run(service.apublish_stories(Topic.top))
+    assert sorted(handler.sent) == [(10, 1), (10, 2)]
+    assert sorted(pubsub.for_topic(Topic.top).get_published()) == [1, 2]
+
+
+def test_publish_stories():
+    hn_repo = repos.HNRepository(transport=hn_transport([1, 2], []))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.best).add_subscriber(10)
+    handler = RecordingEventHandler()
+    service = services.NHPublishService(
+        hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+    ).add_handler(Topic.best, handler)
+
+    service.publish_stories(Topic.best)
+
+    assert sorted(handler.sent) == [(10, 1), (10, 2)]
+
+
+def test_publish_digest():
+    hn_repo = repos.HNRepository(transport=hn_transport([1, 2], []))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.best).add_subscriber(10)
+    handler = RecordingEventHandler()
+    service = (
+        services.NHPublishService(
+            hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+        )
+        .add_handler(Topic.best, handler)
+        .enable_digest()
+    )
+
+    service.publish_stories(Topic.best)
+
+    assert handler.sent == []
+    assert handler.digests == [(10, [1, 2])]
+
+
+def test_publish_digest_window():
+    hn_repo = repos.HNRepository(transport=hn_transport([1, 2], []))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.best).add_subscriber(10)
+    handler = RecordingEventHandler()
+    service = (
+        services.NHPublishService(
+            hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+        )
+        .add_handler(Topic.best, handler)
+        .enable_digest(timedelta(hours=1))
+    )
+
+    service.publish_stories(Topic.best)
+
+    assert handler.digests == []
+    assert service.digests[Topic.best]
+    assert sorted(pubsub.for_topic(Topic.best).get_published()) == [1, 2]
+
+
+def test_apublish_topics_fetches_own_lists():
+    requests = []
+    transport = hn_transport([1, 2, 3], [3])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(hn_resource(request))
+        return transport.handler(request)
+
+    hn_repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+    pubsub = pubsub_repo()
+    service = services.NHPublishService(
+        hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+    )
+    for topic in Topic:
+        pubsub.for_topic(topic).add_subscriber(10)
+        service.add_handler(
+            topic,
+            RecordingEventHandler(),
+            filters.NormalDistributionFilter(threshold=0),
+        )
+
+    asyncio.run(service.apublish_topics(*Topic))
+
+    assert sorted(service.handlers[Topic.top].sent) == [(10, 1), (10, 2)]
+    assert sorted(service.handlers[Topic.best].sent) == [(10, 1), (10, 2), (10, 3)]
+    assert sorted(r for r in requests if not r.startswith("item/")) == [
+        "beststories",
+        "newstories",
+        "topstories",
+    ]
+    assert service.topic_filters[Topic.top] is not service.topic_filters[Topic.best]
+
+
+def test_keyword_service_shares_new_stories():
+    requests = []
+    transport = hn_transport([1, 2], [3])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(hn_resource(request))
+        return transport.handler(request)
+
+    hn_repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+    pubsub = pubsub_repo()
+    service = (
+        services.NHPublishService(
+            hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+        )
+        .add_handler(Topic.top, RecordingEventHandler())
+        .share_snapshots(60)
+    )
+    keyword_service = services.KeywordPublishService(
+        hn_repo,
+        repos.RedisKeywordRepository(r=fakeredis.FakeRedis()),
+        RecordingEventHandler(),
+    ).share_snapshots(60)
+
+    async def publish():
+        await service.apublish_stories(Topic.top)
+        await keyword_service.apublish()
+
+    asyncio.run(publish())
+    assert requests.count("newstories") == 1
+
+
+def test_keyword_publish_service():
+    def handler(request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        if resource == "newstories":
+            return httpx.Response(200, json=[1, 2, 3])
+        data = story_data(int(resource.split("/")[-1]))
+        data["title"] = {1: "Rust 2.0", 2: "Go 2.0", 3: "A new editor"}[data["id"]]
+        if data["id"] == 3:
+            data["url"] = "https://github.com/editor"
+        return httpx.Response(200, json=data)
+
+    hn_repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+    keyword_repo = repos.RedisKeywordRepository(r=fakeredis.FakeRedis())
+    keyword_repo.add_keyword(10, "rust")
+    keyword_repo.add_keyword(11, "site:github.com")
+    keyword_repo.add_keyword(11, "rust")
+    recorder = RecordingEventHandler()
+    service = services.KeywordPublishService(hn_repo, keyword_repo, recorder)
+
+    assert asyncio.run(service.apublish()) == 2
+    assert sorted(recorder.sent) == [(10, 1), (11, 1), (11, 3)]
+
+    recorder.sent.clear()
+    assert asyncio.run(service.apublish()) == 0
+    assert recorder.sent == []
+
+
+def test_apublish_stories_with_comment_previews():
+    def handler(request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        if resource in ("topstories", "beststories"):
+            return httpx.Response(200, json=[1])
+        elif resource == "newstories":
+            return httpx.Response(200, json=[])
+        id = int(resource.split("/")[-1])
+        if id == 1:
+            data = story_data(1)
+            data.update(descendants=3, kids=[2, 3, 4])
+            return httpx.Response(200, json=data)
+        return httpx.Response(
+            200,
+            json={
+                "id": id,
+                "type": "comment",
+                "by": "pg",
+                "time": int(time()),
+                "parent": 1,
+                "text": f"comment {id}",
+            },
+        )
+
+    hn_repo = repos.HNRepository(transport=httpx.MockTransport(handler))
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.top).add_subscriber(10)
+    recorder = RecordingEventHandler()
+    service = (
+        services.NHPublishService(
+            hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+        )
+        .add_handler(Topic.top, recorder)
+        .enable_comment_previews(count=2)
+    )
+
+    try:
+        asyncio.run(service.apublish_stories(Topic.top))
+        assert recorder.sent == [(10, 1)]
+        assert [c.id for c in items.comment_previews.get(1)] == [2, 3]
+        assert items.comment_previews.fresh(1, 3)
+    finally:
+        items.comment_previews = items.CommentPreviews()
+
+
+def test_apublish_stories_skips_invalid_items():
+    def handler(request: httpx.Request) -> httpx.Response:
+        resource = hn_resource(request)
+        if resource in ("topstories", "beststories"):
+            return httpx.Response(200, json=[1, 2, 3])
+        elif resource == "newstories":
+            return httpx.Response(200, json=[])
+        data = story_data(int(resource.split("/")[-1]))
+        if data["id"] == 1:
+            data["url"] = "http://intranet"
+        elif data["id"] == 3:
+            del data["score"]
+        return httpx.Response(200, json=data)
+
+    hn_repo = repos.HNRepository(
+        transport=httpx.MockTransport(handler), item_factory=items.LazyItemFactory()
+    )
+    pubsub = pubsub_repo()
+    pubsub.for_topic(Topic.top).add_subscriber(10)
+    recorder = RecordingEventHandler()
+    service = services.NHPublishService(
+        hn_repo, pubsub, filters.NormalDistributionFilter(threshold=0)
+    ).add_handler(Topic.top, recorder)
+
+    asyncio.run(service.apublish_stories(Topic.top))
+
+    assert recorder.sent == [(10, 2)]
+    assert pubsub.for_topic(Topic.top).get_published() == [2]
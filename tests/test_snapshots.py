@@ -0,0 +1,34 @@
+import tempfile
+
+import fakeredis
+
+from hnread import filters, snapshots
+from hnread.topics import Topic
+
+
+def check_store(store: snapshots.ISnapshotStore):
+    assert store.load("top:norm_filter") is None
+    store.save("top:norm_filter", {"version": 1, "values": [1.0, 2.0]})
+    assert store.load("top:norm_filter") == {"version": 1, "values": [1.0, 2.0]}
+
+
+def test_redis_store():
+    check_store(snapshots.RedisSnapshotStore(fakeredis.FakeRedis()))
+
+
+def test_file_store():
+    with tempfile.TemporaryDirectory() as directory:
+        check_store(snapshots.FileSnapshotStore(f"{directory}/snapshots"))
+
+
+def test_save_and_restore_filters():
+    store = snapshots.RedisSnapshotStore(fakeredis.FakeRedis())
+    saved = {topic: filters.NormalDistributionFilter() for topic in Topic}
+    for x in range(5):
+        saved[Topic.top].stats.add(x)
+    filters.save_filters(store, saved)
+
+    restored = {topic: filters.NormalDistributionFilter() for topic in Topic}
+    filters.restore_filters(store, restored)
+    assert restored[Topic.top].stats.window() == [0, 1, 2, 3, 4]
+    assert len(restored[Topic.best].stats) == 0
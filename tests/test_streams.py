@@ -0,0 +1,112 @@
+import asyncio
+import json
+from typing import List
+from unittest import IsolatedAsyncioTestCase
+
+from hnread import repos, streams
+
+
+def sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class SSEServer:
+    """
+    A stand-in for the Firebase streaming API, it sends `events` to every
+    stream request and records the requested paths.
+    """
+
+    def __init__(self, events: List[bytes]) -> None:
+        self.events = events
+        self.paths: List[str] = []
+        self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        request_line = (await reader.readline()).decode()
+        self.paths.append(request_line.split()[1])
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        for event in self.events:
+            writer.write(event)
+            await writer.drain()
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(10)
+        writer.close()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v0"
+
+    async def stop(self):
+        self.server.close()
+
+
+class StreamingTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.server = SSEServer(
+            [
+                sse("put", {"path": "/", "data": [1, 2, 3]}),
+                sse("keep-alive", None),
+                sse("patch", {"path": "/", "data": {"1": 4}}),
+                sse("put", {"path": "/3", "data": 5}),
+            ]
+        )
+        self.repo = repos.HNRepository()
+        self.repo.base_url = await self.server.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.repo.aclose()
+        await self.server.stop()
+
+    async def test_list_snapshot(self):
+        await self.repo.astart_streaming("beststories")
+        queue = self.repo.streams["beststories"].subscribe()
+
+        changes = [await asyncio.wait_for(queue.get(), 1) for _ in range(3)]
+
+        assert changes[0].added == {1, 2, 3}
+        assert changes[1].added == {4} and changes[1].removed == {2}
+        assert changes[2].added == {5}
+        assert await self.repo.abeststories_id() == [1, 4, 3, 5]
+        assert self.server.paths == ["/v0/beststories.json"]
+
+
+async def aiter_lines(text: str):
+    for line in text.splitlines(keepends=True):
+        yield line
+
+
+class SSEParserTest(IsolatedAsyncioTestCase):
+    async def test_parse(self):
+        text = ": comment\nevent: put\ndata: 1\ndata: 2\n\ndata: x\n\n"
+        events = [e async for e in streams.aiter_sse(aiter_lines(text))]
+        assert [(e.event, e.data) for e in events] == [
+            ("put", "1\n2"),
+            ("message", "x"),
+        ]
+
+    async def test_cancel(self):
+        stream = streams.ListStream("topstories", connect=None)
+        with self.assertRaises(streams.StreamCancelled):
+            stream.apply(streams.ServerSentEvent("cancel", "null"))
+
+    async def test_forget_snapshot_on_disconnect(self):
+        async def connect(resource: str):
+            yield streams.ServerSentEvent("put", json.dumps({"path": "/", "data": [1]}))
+            raise ConnectionError("stream closed")
+
+        stream = streams.ListStream("topstories", connect, reconnect_delay=10)
+        queue = stream.subscribe()
+        task = asyncio.ensure_future(stream.run())
+        try:
+            await asyncio.wait_for(queue.get(), 1)
+            await asyncio.sleep(0)
+            assert stream.ids is None
+        finally:
+            task.cancel()
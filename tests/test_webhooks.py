@@ -0,0 +1,59 @@
+import asyncio
+import queue
+
+import httpx
+from telegram import Bot, Update
+
+from hnread import webhooks
+
+
+def update_data(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 10, "type": "private"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+
+
+def test_webhook_server_puts_updates():
+    update_queue: queue.Queue = queue.Queue()
+
+    async def post_updates():
+        server = await webhooks.WebhookServer(
+            Bot("123:token"),
+            update_queue,
+            secret_token="secret",
+            host="127.0.0.1",
+            port=0,
+        ).astart()
+        url = f"http://127.0.0.1:{server.port}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+        try:
+            async with httpx.AsyncClient(base_url=url) as client:
+                responses = [
+                    await client.post(
+                        "/telegram", json=update_data(1, "/ping"), headers=headers
+                    ),
+                    await client.post(
+                        "/telegram", json=update_data(2, "/watch"), headers=headers
+                    ),
+                    await client.post("/telegram", json=update_data(3, "/ping")),
+                    await client.post("/other", json={}, headers=headers),
+                    await client.get("/telegram", headers=headers),
+                    await client.post("/telegram", content=b"{", headers=headers),
+                ]
+        finally:
+            await server.astop()
+        return [response.status_code for response in responses]
+
+    assert asyncio.run(post_updates()) == [200, 200, 403, 404, 405, 400]
+
+    updates = [update_queue.get_nowait() for _ in range(update_queue.qsize())]
+    assert all(isinstance(update, Update) for update in updates)
+    assert [update.message.text for update in updates] == ["/ping", "/watch"]
+    assert updates[0].effective_chat.id == 10